@@ -1,34 +1,92 @@
-from openai import OpenAI
+import asyncio
+import hashlib
 import os
-from dotenv import load_dotenv
+import time
 import logging
 import json
+import re
+import threading
+import uuid
+from datetime import datetime, timezone
 try:
+    from ..infrastructure.admission import llm_admission
+    from ..infrastructure.cache import LRUTTLCache
+    from ..infrastructure.metrics import LLM_TOKENS, STAGE_LATENCY
+    from ..infrastructure.settings import load_env
     from ..infrastructure.firebase_service import (
-        list_purchase_orders,
-        get_purchase_order_by_id,
-        get_product_by_detail,
+        query_purchase_orders_async,
+        InvalidCursorError,
+        get_purchase_order_by_id_async,
+        get_purchase_orders_by_ids_async,
+        get_product_by_detail_async,
+        search_products_async,
+        get_spend_summary_async,
+        BATCH_MAX_ITEMS,
     )
 except ImportError:
+    from infrastructure.admission import llm_admission
+    from infrastructure.cache import LRUTTLCache
+    from infrastructure.metrics import LLM_TOKENS, STAGE_LATENCY
+    from infrastructure.settings import load_env
     from infrastructure.firebase_service import (
-        list_purchase_orders,
-        get_purchase_order_by_id,
-        get_product_by_detail,
+        query_purchase_orders_async,
+        InvalidCursorError,
+        get_purchase_order_by_id_async,
+        get_purchase_orders_by_ids_async,
+        get_product_by_detail_async,
+        search_products_async,
+        get_spend_summary_async,
+        BATCH_MAX_ITEMS,
     )
 
 
 # Cargar variables de entorno desde .env
+load_env()
 
-# Cargar variables de entorno desde .env
-load_dotenv()
-
-# Configuración básica de logging
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 logger = logging.getLogger("agent")
 
 
-# Usar la variable de entorno OPENAI_API_KEY definida en .env
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Cliente async: la llamada al modelo no bloquea el event loop de FastAPI. Se
+# crea con el primer uso (o en el warm-up) para no pagar el import de openai
+# ni exigir OPENAI_API_KEY al importar el módulo.
+client = None
+_client_lock = threading.Lock()
+# Warm-up: abrir la conexión a OpenAI antes del primer request (1 = sí)
+AGENT_WARMUP_CONNECT = os.getenv("AGENT_WARMUP_CONNECT", "0") == "1"
+
+
+def get_client():
+    global client
+    if client is None:
+        with _client_lock:
+            if client is None:
+                from openai import AsyncOpenAI
+
+                # Usar la variable de entorno OPENAI_API_KEY definida en .env
+                client = AsyncOpenAI(
+                    api_key=os.getenv("OPENAI_API_KEY"),
+                    timeout=float(os.getenv("OPENAI_TIMEOUT", "60")),
+                )
+    return client
+
+
+async def warm_up_agent():
+    llm = get_client()
+    if AGENT_WARMUP_CONNECT:
+        try:
+            await llm.models.retrieve(OPENAI_MODEL)
+        except Exception as e:
+            logger.warning("Warm-up de OpenAI falló: %s", e)
+
+OPENAI_MODEL = "gpt-4o-mini"
+# Presupuesto del bucle de herramientas por turno
+AGENT_MAX_STEPS = int(os.getenv("AGENT_MAX_STEPS", "4"))
+AGENT_MAX_SECONDS = float(os.getenv("AGENT_MAX_SECONDS", "30"))
+# Pre-router determinista para comandos frecuentes (0 = desactivado)
+AGENT_FAST_PATH = os.getenv("AGENT_FAST_PATH", "1") != "0"
+# Candidatos ofrecidos cuando el detail no identifica un producto único
+MATCH_TOP_K = int(os.getenv("PRODUCT_MATCH_TOP_K", "5"))
+MATCH_MIN_SCORE = float(os.getenv("PRODUCT_MATCH_MIN_SCORE", "0.2"))
 
 tools = [
     {
@@ -63,8 +121,11 @@ tools = [
                 {
                     "user_id":{"type":"string"},
                     "date":{"type":"string", "description":"Fecha en formato YYYY-MM-DD"},
+                    "date_from":{"type":"string", "description":"Inicio del rango (YYYY-MM-DD, inclusive)"},
+                    "date_to":{"type":"string", "description":"Fin del rango (YYYY-MM-DD, inclusive)"},
                     "status":{"type":"string"},
-                    "limit":{"type":"integer"}
+                    "limit":{"type":"integer"},
+                    "cursor":{"type":"string", "description":"Cursor de la página anterior para continuar el listado"}
                 }
             }
         }
@@ -86,146 +147,856 @@ tools = [
                 "required":["purchase_order_id"]
             }
         }
+    },
+    {
+        "type":"function",
+        "function":
+        {
+            "name":"create_purchase_orders_batch",
+            "description":"Crear varias órdenes de compra con una sola aprobación humana",
+            "parameters":
+            {
+                "type":"object",
+                "properties":
+                {
+                    "items":{
+                        "type":"array",
+                        "items":{
+                            "type":"object",
+                            "properties":
+                            {
+                                "detail":{"type":"string"},
+                                "quantity":{"type":"integer"}
+                            },
+                            "required":["detail","quantity"]
+                        }
+                    },
+                    "justification":{"type":"string"}
+                },
+                "required":["items"]
+            }
+        }
+    },
+    {
+        "type":"function",
+        "function":
+        {
+            "name":"delete_purchase_orders_batch",
+            "description":(
+                "Eliminar varias órdenes de compra con una sola aprobación humana, por IDs "
+                "o por filtros (fecha, rango o estado) sobre las órdenes del usuario"
+            ),
+            "parameters":
+            {
+                "type":"object",
+                "properties":
+                {
+                    "purchase_order_ids":{"type":"array", "items":{"type":"string"}},
+                    "date":{"type":"string", "description":"Fecha en formato YYYY-MM-DD"},
+                    "date_from":{"type":"string", "description":"Inicio del rango (YYYY-MM-DD, inclusive)"},
+                    "date_to":{"type":"string", "description":"Fin del rango (YYYY-MM-DD, inclusive)"},
+                    "status":{"type":"string"},
+                    "reason":{"type":"string"}
+                }
+            }
+        }
+    },
+    {
+        "type":"function",
+        "function":
+        {
+            "name":"get_spend_summary",
+            "description":(
+                "Total gastado y cantidad de órdenes del usuario, opcionalmente de un producto, "
+                "en un día, un mes o un rango de fechas (por defecto el mes en curso)"
+            ),
+            "parameters":
+            {
+                "type":"object",
+                "properties":
+                {
+                    "detail":{"type":"string", "description":"Producto a consultar; omitir para todos"},
+                    "date":{"type":"string", "description":"Fecha en formato YYYY-MM-DD"},
+                    "month":{"type":"string", "description":"Mes en formato YYYY-MM"},
+                    "date_from":{"type":"string", "description":"Inicio del rango (YYYY-MM-DD, inclusive)"},
+                    "date_to":{"type":"string", "description":"Fin del rango (YYYY-MM-DD, inclusive)"}
+                }
+            }
+        }
     }
 ]
 
 
 
 
-def run_agent(messages, user_id=None):
-    logger.info("Mensajes enviados a OpenAI:")
-    for m in messages:
-        logger.info(m)
-    logger.info(f"OPENAI_API_KEY usado: {os.getenv('OPENAI_API_KEY')}")
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            tools=tools
-        )
-        logger.info(f"Respuesta OpenAI: {response}")
-    except Exception as e:
-        logger.error(f"Error al llamar OpenAI: {e}")
-        raise
+# Caché de decisiones del primer paso del modelo: guarda solo la herramienta y
+# sus argumentos, nunca los resultados; los handlers se vuelven a ejecutar con
+# datos frescos del catálogo y las órdenes. Cualquier cambio en `tools`
+# cambia la versión del esquema y con ella todas las claves.
+DECISION_CACHE_ENABLED = os.getenv("AGENT_DECISION_CACHE", "1") != "0"
+DECISION_CACHE_TTL_SECONDS = float(os.getenv("AGENT_DECISION_CACHE_TTL_SECONDS", "600"))
+DECISION_CACHE_MAX_ENTRIES = int(os.getenv("AGENT_DECISION_CACHE_MAX_ENTRIES", "1024"))
+# Mensajes más largos se consideran únicos y no se cachean
+DECISION_CACHE_MAX_CHARS = int(os.getenv("AGENT_DECISION_CACHE_MAX_CHARS", "200"))
+TOOL_SCHEMA_VERSION = hashlib.sha256(json.dumps(tools, sort_keys=True).encode()).hexdigest()[:12]
+
+_decision_cache = LRUTTLCache(
+    ttl_seconds=DECISION_CACHE_TTL_SECONDS,
+    max_entries=DECISION_CACHE_MAX_ENTRIES,
+    max_bytes=4 * 1024 * 1024,
+)
+
+# Referencias a turnos anteriores ("la segunda", "esa orden", "sí"): la
+# decisión depende del historial y no solo del mensaje
+_STATEFUL_PATTERN = re.compile(
+    r"\b(?:s[ií]|no|ok|dale|confirmo|es[ea]s?|es[oa]|aquel(?:la)?s?|est[ea]s?(?!\s+(?:mes|semana|a[nñ]o))|esto"
+    r"|mism[oa]s?|anterior(?:es)?|[uú]ltim[oa]s?|primer[oa]?|segund[oa]|tercer[oa]|otr[oa]s?|tambi[eé]n"
+    r"|cu[aá]l(?:es)?)\b",
+    re.IGNORECASE,
+)
+
+# Respuestas del asistente que esperan una respuesta del usuario
+_OPEN_TURN_MARKERS = ("?", "Indica cuál", "pendiente de aprobación")
+
+
+def _normalize_turn(message):
+    return " ".join(str((message or {}).get("content") or "").split()).casefold()
 
-    msg = response.choices[0].message
 
-    if msg.tool_calls:
-        tool_call = msg.tool_calls[0].function
-        tool_name = tool_call.name
-        raw_args = tool_call.arguments
-        # OpenAI tool arguments come as a JSON string; parse before returning.
+def _decision_key(messages):
+    # Clave: mensaje del usuario y el turno anterior (usuario y asistente)
+    # normalizados + versión del esquema + modelo + fecha UTC (las fechas
+    # relativas como "hoy" cambian de valor cada día). El turno anterior evita
+    # reutilizar la decisión de un seguimiento elíptico ("y de monitores") en
+    # otra conversación. None = no cachear: mensaje largo o estado pendiente.
+    if not DECISION_CACHE_ENABLED or not messages or messages[-1].get("role") != "user":
+        return None
+    text = _normalize_turn(messages[-1])
+    if not text or len(text) > DECISION_CACHE_MAX_CHARS or _STATEFUL_PATTERN.search(text):
+        return None
+    earlier = messages[:-1]
+    previous = next((m for m in reversed(earlier) if m.get("role") == "assistant"), None)
+    previous_user = next((m for m in reversed(earlier) if m.get("role") == "user"), None)
+    if previous and any(marker in str(previous.get("content") or "") for marker in _OPEN_TURN_MARKERS):
+        # El asistente dejó una pregunta, una elección o una aprobación abierta
+        return None
+    today = datetime.now(timezone.utc).date().isoformat()
+    raw = json.dumps(
+        [TOOL_SCHEMA_VERSION, OPENAI_MODEL, today, _normalize_turn(previous_user), _normalize_turn(previous), text],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _cacheable_decision(tool_calls):
+    # Solo decisiones con herramientas conocidas y argumentos JSON válidos
+    known = {tool["function"]["name"] for tool in tools}
+    decision = []
+    for call in tool_calls:
+        if call["name"] not in known:
+            return None
         try:
-            payload = json.loads(raw_args) if isinstance(raw_args, str) else raw_args
+            arguments = json.loads(call["arguments"] or "{}")
         except json.JSONDecodeError:
-            logger.error(f"Tool arguments no son JSON válido: {raw_args}")
-            payload = raw_args
-
-        if tool_name == "create_purchase_order":
-            safe_payload = payload if isinstance(payload, dict) else {}
-            detail = safe_payload.get("detail")
-            quantity = safe_payload.get("quantity")
-            if not detail:
-                return {
-                    "type": "NORMAL",
-                    "content": "Para crear la orden necesito `detail` del producto."
-                }
-            try:
-                quantity_value = int(quantity)
-            except (TypeError, ValueError):
-                return {
-                    "type": "NORMAL",
-                    "content": "La cantidad debe ser un número entero válido."
-                }
-            if quantity_value <= 0:
-                return {
-                    "type": "NORMAL",
-                    "content": "La cantidad debe ser mayor a 0."
-                }
+            return None
+        decision.append({"name": call["name"], "arguments": arguments})
+    return decision
 
-            product = get_product_by_detail(detail)
-            if not product:
-                return {
-                    "type": "NORMAL",
-                    "content": f"No encontré un producto único con detail `{detail}` en la base de datos."
-                }
 
-            unit_price = float(product.get("price", 0))
-            enriched_payload = {
-                "action": "CREATE_PURCHASE_ORDER",
-                "product_id": product["product_id"],
-                "detail": product.get("detail", ""),
-                "unit_price": unit_price,
-                "quantity": quantity_value,
-                "total_amount": round(quantity_value * unit_price, 2),
-                "justification": safe_payload.get("justification", ""),
+def decision_cache_stats():
+    return {**_decision_cache.stats(), "schema_version": TOOL_SCHEMA_VERSION}
+
+
+def _log_request(messages):
+    logger.info("Llamada a OpenAI con %s mensajes", len(messages))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Mensajes enviados a OpenAI: %s", messages, extra={"route": "agent"})
+
+
+def _disambiguation_message(detail, quantity, candidates):
+    lines = [f"No encontré un producto único para `{detail}`. Estos son los más parecidos:"]
+    for position, candidate in enumerate(candidates, start=1):
+        product = candidate["product"]
+        lines.append(
+            f"{position}. {product.get('detail', '')} (`{product['product_id']}`) — "
+            f"precio {float(product.get('price', 0)):.2f} — similitud {candidate['score']:.2f}"
+        )
+    lines.append(f"Indica cuál quieres para crear la orden de {quantity} unidades.")
+    return "\n".join(lines)
+
+
+async def _resolve_order_item(args):
+    # Valida detail/quantity y resuelve el producto: (item, None) o (None, resultado NORMAL)
+    detail = args.get("detail")
+    quantity = args.get("quantity")
+    if not detail:
+        return None, {
+            "type": "NORMAL",
+            "content": "Para crear la orden necesito `detail` del producto."
+        }
+    try:
+        quantity_value = int(quantity)
+    except (TypeError, ValueError):
+        return None, {
+            "type": "NORMAL",
+            "content": "La cantidad debe ser un número entero válido."
+        }
+    if quantity_value <= 0:
+        return None, {
+            "type": "NORMAL",
+            "content": "La cantidad debe ser mayor a 0."
+        }
+
+    product = await get_product_by_detail_async(detail)
+    if not product:
+        candidates = await search_products_async(detail, k=MATCH_TOP_K, min_score=MATCH_MIN_SCORE)
+        if not candidates:
+            return None, {
+                "type": "NORMAL",
+                "content": f"No encontré un producto único con detail `{detail}` en la base de datos."
             }
+        return None, {
+            "type": "NORMAL",
+            "content": _disambiguation_message(detail, quantity_value, candidates),
+            "candidates": candidates
+        }
+
+    unit_price = float(product.get("price", 0))
+    return {
+        "product_id": product["product_id"],
+        "detail": product.get("detail", ""),
+        "unit_price": unit_price,
+        "quantity": quantity_value,
+        "total_amount": round(quantity_value * unit_price, 2),
+        "justification": args.get("justification", ""),
+    }, None
+
+
+def _batch_size_error(count):
+    if not count:
+        return {"type": "NORMAL", "content": "No hay órdenes para procesar en el lote."}
+    if count > BATCH_MAX_ITEMS:
+        return {
+            "type": "NORMAL",
+            "content": f"Un lote admite como máximo {BATCH_MAX_ITEMS} órdenes; recibí {count}. Divide la solicitud.",
+        }
+    return None
+
+
+async def _create_batch(args):
+    # Todas las líneas deben resolverse; si alguna falla no se pide aprobación
+    raw_items = args.get("items") if isinstance(args.get("items"), list) else []
+    error = _batch_size_error(len(raw_items))
+    if error:
+        return error
+
+    items, problems = [], []
+    for position, raw_item in enumerate(raw_items, start=1):
+        item, item_error = await _resolve_order_item({
+            **(raw_item if isinstance(raw_item, dict) else {}),
+            "justification": args.get("justification", ""),
+        })
+        if item_error:
+            problems.append(f"Línea {position}: {item_error['content']}")
+        else:
+            items.append(item)
+    if problems:
+        return {
+            "type": "NORMAL",
+            "content": "No puedo preparar el lote:\n" + "\n".join(problems),
+        }
+
+    return _create_batch_result(items, args.get("justification", ""))
+
+
+def _create_batch_result(items, justification):
+    total_amount = round(sum(item["total_amount"] for item in items), 2)
+    enriched_payload = {
+        "action": "CREATE_PURCHASE_ORDERS_BATCH",
+        "items": items,
+        "total_amount": total_amount,
+        "justification": justification,
+    }
+    return {
+        "type": "UNSAFE",
+        "payload": enriched_payload,
+        "approval": {
+            "action": "CREATE_PURCHASE_ORDERS_BATCH",
+            "impact": f"Se crearán {len(items)} órdenes de compra por un total de {total_amount:.2f}.",
+            "record": {"items": items, "count": len(items), "total_amount": total_amount},
+        }
+    }
+
+
+async def _delete_batch(args, user_id):
+    order_ids = [str(i) for i in args.get("purchase_order_ids") or [] if i]
+    filters = {key: args.get(key) for key in ("date", "date_from", "date_to", "status") if args.get(key)}
+    if order_ids:
+        error = _batch_size_error(len(order_ids))
+        if error:
+            return error
+        targets = await get_purchase_orders_by_ids_async(order_ids)
+        missing = sorted(set(order_ids) - {order["id"] for order in targets})
+        if missing:
             return {
-                "type": "UNSAFE",
-                "payload": enriched_payload,
-                "approval": {
-                    "action": "CREATE_PURCHASE_ORDER",
-                    "impact": "Se creará una nueva orden de compra en la base de datos.",
-                    "record": enriched_payload
-                }
+                "type": "NORMAL",
+                "content": "No existen órdenes con estos ids: " + ", ".join(f"`{i}`" for i in missing),
+            }
+        if user_id and any(order.get("user_id") and order["user_id"] != user_id for order in targets):
+            return {
+                "type": "NORMAL",
+                "content": "No puedes eliminar órdenes que pertenecen a otro usuario."
+            }
+    elif filters:
+        # Solo órdenes del propio usuario; una página más de lo permitido = lote demasiado grande
+        try:
+            page = await query_purchase_orders_async(user_id=user_id, limit=BATCH_MAX_ITEMS, **filters)
+        except ValueError:
+            return {"type": "NORMAL", "content": "Las fechas deben tener formato YYYY-MM-DD."}
+        if page.get("next_cursor"):
+            return {
+                "type": "NORMAL",
+                "content": f"Hay más de {BATCH_MAX_ITEMS} órdenes con esos filtros; acota la fecha o el estado.",
+            }
+        targets = page["orders"]
+        if not targets:
+            return {"type": "NORMAL", "content": "No se encontraron órdenes de compra con esos filtros."}
+    else:
+        return {
+            "type": "NORMAL",
+            "content": "Para eliminar en lote necesito `purchase_order_ids` o filtros de fecha o estado."
+        }
+    return _delete_batch_result(targets, args.get("reason", ""))
+
+
+def _delete_batch_result(targets, reason):
+    total_amount = round(sum(float(order.get("total_amount") or 0) for order in targets), 2)
+    return {
+        "type": "UNSAFE",
+        "payload": {
+            "action": "DELETE_PURCHASE_ORDERS_BATCH",
+            "purchase_order_ids": [order["id"] for order in targets],
+            "reason": reason
+        },
+        "approval": {
+            "action": "DELETE_PURCHASE_ORDERS_BATCH",
+            "impact": (
+                f"Se eliminarán permanentemente {len(targets)} órdenes de compra "
+                f"por un total de {total_amount:.2f}."
+            ),
+            "record": {"orders": targets, "count": len(targets), "total_amount": total_amount},
+        }
+    }
+
+
+async def _spend_summary(args, user_id):
+    # Solo lectura: responde desde los agregados, sin listar órdenes
+    product = None
+    detail = args.get("detail")
+    if detail:
+        resolved = await _resolve_detail(detail)
+        if not resolved:
+            candidates = await search_products_async(detail, k=MATCH_TOP_K, min_score=MATCH_MIN_SCORE)
+            names = ", ".join(f"`{c['product']['detail']}`" for c in candidates)
+            return {
+                "type": "TOOL_RESULT",
+                "content": {
+                    "error": f"No encontré un producto único para `{detail}`.",
+                    "candidates": names or None,
+                },
+            }
+        product = await get_product_by_detail_async(resolved)
+    try:
+        summary = await get_spend_summary_async(
+            user_id,
+            product_id=product["product_id"] if product else None,
+            date=args.get("date"),
+            month=args.get("month"),
+            date_from=args.get("date_from"),
+            date_to=args.get("date_to"),
+        )
+    except ValueError as e:
+        return {"type": "TOOL_RESULT", "content": {"error": f"Período inválido: {e}"}}
+    if product:
+        summary["detail"] = product.get("detail", detail)
+    return {"type": "TOOL_RESULT", "content": summary}
+
+
+async def _handle_tool_call(tool_name, raw_args, user_id=None):
+    # OpenAI tool arguments come as a JSON string; parse before returning.
+    try:
+        payload = json.loads(raw_args) if isinstance(raw_args, str) else raw_args
+    except json.JSONDecodeError:
+        logger.error("Tool arguments no son JSON válido: %s", raw_args)
+        payload = raw_args
+
+    if tool_name == "create_purchase_order":
+        safe_payload = payload if isinstance(payload, dict) else {}
+        item, error = await _resolve_order_item(safe_payload)
+        if error:
+            return error
+        enriched_payload = {"action": "CREATE_PURCHASE_ORDER", **item}
+        return {
+            "type": "UNSAFE",
+            "payload": enriched_payload,
+            "approval": {
+                "action": "CREATE_PURCHASE_ORDER",
+                "impact": "Se creará una nueva orden de compra en la base de datos.",
+                "record": enriched_payload
             }
+        }
+
+    if tool_name == "create_purchase_orders_batch":
+        safe_payload = payload if isinstance(payload, dict) else {}
+        return await _create_batch(safe_payload)
+
+    if tool_name == "delete_purchase_orders_batch":
+        safe_payload = payload if isinstance(payload, dict) else {}
+        return await _delete_batch(safe_payload, user_id)
+
+    if tool_name == "get_spend_summary":
+        safe_payload = payload if isinstance(payload, dict) else {}
+        return await _spend_summary(safe_payload, user_id)
 
-        if tool_name == "list_purchase_orders":
-            safe_payload = payload if isinstance(payload, dict) else {}
-            orders = list_purchase_orders(
+    if tool_name == "list_purchase_orders":
+        safe_payload = payload if isinstance(payload, dict) else {}
+        try:
+            page = await query_purchase_orders_async(
                 user_id=safe_payload.get("user_id") or user_id,
                 date=safe_payload.get("date"),
+                date_from=safe_payload.get("date_from"),
+                date_to=safe_payload.get("date_to"),
                 status=safe_payload.get("status"),
                 limit=safe_payload.get("limit", 20),
+                cursor=safe_payload.get("cursor"),
             )
+        except InvalidCursorError:
+            return {
+                "type": "TOOL_RESULT",
+                "content": {"error": "El cursor de paginación no es válido."}
+            }
+        except ValueError:
+            return {
+                "type": "TOOL_RESULT",
+                "content": {"error": "Las fechas deben tener formato YYYY-MM-DD."}
+            }
 
-            if not orders:
-                return {
-                    "type": "NORMAL",
-                    "content": "No se encontraron órdenes de compra con esos filtros."
-                }
+        return {
+            "type": "TOOL_RESULT",
+            "content": page
+        }
 
+    if tool_name == "delete_purchase_order":
+        safe_payload = payload if isinstance(payload, dict) else {}
+        order_id = safe_payload.get("purchase_order_id")
+        if not order_id:
             return {
                 "type": "NORMAL",
-                "content": "Órdenes de compra encontradas:\n```json\n"
-                + json.dumps(orders, ensure_ascii=False, indent=2)
-                + "\n```"
-            }
-
-        if tool_name == "delete_purchase_order":
-            safe_payload = payload if isinstance(payload, dict) else {}
-            order_id = safe_payload.get("purchase_order_id")
-            if not order_id:
-                return {
-                    "type": "NORMAL",
-                    "content": "Para eliminar, necesito el `purchase_order_id`."
-                }
-
-            target = get_purchase_order_by_id(order_id)
-            if not target:
-                return {
-                    "type": "NORMAL",
-                    "content": f"No existe una orden con id `{order_id}`."
-                }
+                "content": "Para eliminar, necesito el `purchase_order_id`."
+            }
 
-            if user_id and target.get("user_id") and target.get("user_id") != user_id:
-                return {
-                    "type": "NORMAL",
-                    "content": "No puedes eliminar una orden que pertenece a otro usuario."
-                }
+        target = await get_purchase_order_by_id_async(order_id)
+        if not target:
+            return {
+                "type": "NORMAL",
+                "content": f"No existe una orden con id `{order_id}`."
+            }
 
+        if user_id and target.get("user_id") and target.get("user_id") != user_id:
             return {
-                "type": "UNSAFE",
-                "payload": {
-                    "action": "DELETE_PURCHASE_ORDER",
-                    "purchase_order_id": order_id,
-                    "reason": safe_payload.get("reason", "")
-                },
-                "approval": {
-                    "action": "DELETE_PURCHASE_ORDER",
-                    "impact": "Se eliminará permanentemente el registro de la orden de compra.",
-                    "record": target
-                }
+                "type": "NORMAL",
+                "content": "No puedes eliminar una orden que pertenece a otro usuario."
+            }
+
+        return {
+            "type": "UNSAFE",
+            "payload": {
+                "action": "DELETE_PURCHASE_ORDER",
+                "purchase_order_id": order_id,
+                "reason": safe_payload.get("reason", "")
+            },
+            "approval": {
+                "action": "DELETE_PURCHASE_ORDER",
+                "impact": "Se eliminará permanentemente el registro de la orden de compra.",
+                "record": target
+            }
+        }
+
+    return {
+        "type": "TOOL_RESULT",
+        "content": {"error": f"Herramienta desconocida: {tool_name}"}
+    }
+
+
+_UUID = r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}"
+
+_CREATE_PATTERN = re.compile(
+    r"^(?:(?:crear|crea|generar|genera|registrar|registra)\s+(?:una\s+)?(?:nueva\s+)?orden"
+    r"(?:\s+de\s+compra)?\s+(?:de|por|para)|(?:quiero\s+)?comprar?)"
+    r"\s+(?P<quantity>\d+)\s+(?:unidades?\s+de\s+)?(?P<detail>[^,;:?!]+?)\s*[.!]?$",
+    re.IGNORECASE,
+)
+_DELETE_PATTERN = re.compile(
+    r"^(?:eliminar|elimina|borrar|borra)\s+(?:la\s+)?orden(?:\s+de\s+compra)?\s+"
+    r"(?:con\s+)?(?:id\s+)?`?(?P<order_id>" + _UUID + r")`?\s*[.!]?$",
+    re.IGNORECASE,
+)
+_LIST_PATTERN = re.compile(
+    r"^(?:listar|lista|mostrar|muestra|mu[eé]strame|ver|dame)\s+(?:mis\s+|las\s+)?[oó]rdenes"
+    r"(?:\s+de\s+compra)?(?:\s+(?:del|de|el)\s+(?:d[ií]a\s+)?(?P<date>\d{4}-\d{2}-\d{2}))?\s*[.!?]?$",
+    re.IGNORECASE,
+)
+
+_fast_path_lock = threading.Lock()
+# Conteo y latencia acumulada por ruta: [requests, segundos]
+_path_stats = {"fast_path": [0, 0.0], "model": [0, 0.0]}
+
+
+def _record_path(path, seconds):
+    with _fast_path_lock:
+        _path_stats[path][0] += 1
+        _path_stats[path][1] += seconds
+
+
+def fast_path_stats():
+    with _fast_path_lock:
+        (hits, hit_seconds), (model, model_seconds) = _path_stats["fast_path"], _path_stats["model"]
+    total = hits + model
+    return {
+        "fast_path_hits": hits,
+        "model_requests": model,
+        "fast_path_hit_rate": round(hits / total, 4) if total else 0.0,
+        "fast_path_avg_ms": round(hit_seconds / hits * 1000, 3) if hits else 0.0,
+        "model_avg_ms": round(model_seconds / model * 1000, 3) if model else 0.0,
+    }
+
+
+async def _resolve_detail(detail):
+    # "10 laptops" -> "laptop": solo se acepta si el catálogo da un producto único
+    candidates = [detail]
+    lowered = detail.lower()
+    if lowered.endswith("es"):
+        candidates.append(detail[:-2])
+    if lowered.endswith("s"):
+        candidates.append(detail[:-1])
+    for candidate in candidates:
+        if await get_product_by_detail_async(candidate):
+            return candidate
+    return None
+
+
+def _format_orders(page):
+    orders = page["orders"]
+    if not orders:
+        return "No se encontraron órdenes de compra con esos filtros."
+    content = (
+        "Órdenes de compra encontradas:\n```json\n"
+        + json.dumps(orders, ensure_ascii=False, indent=2)
+        + "\n```"
+    )
+    if page.get("next_cursor"):
+        content += f"\n\nHay más resultados. Cursor para la siguiente página: `{page['next_cursor']}`"
+    return content
+
+
+async def _fast_path(messages, user_id=None):
+    # Comandos de plantilla (ver app_audit.log) se resuelven sin llamar al
+    # modelo; cualquier caso ambiguo devuelve None y sigue al LLM.
+    if not AGENT_FAST_PATH or not messages or messages[-1].get("role") != "user":
+        return None
+    text = " ".join(str(messages[-1].get("content") or "").split())
+
+    match = _CREATE_PATTERN.match(text)
+    if match:
+        detail = await _resolve_detail(match.group("detail").strip())
+        if not detail:
+            return None
+        args = {"detail": detail, "quantity": int(match.group("quantity"))}
+        return await _handle_tool_call("create_purchase_order", args, user_id)
+
+    match = _DELETE_PATTERN.match(text)
+    if match:
+        args = {"purchase_order_id": match.group("order_id").lower()}
+        return await _handle_tool_call("delete_purchase_order", args, user_id)
+
+    match = _LIST_PATTERN.match(text)
+    if match:
+        args = {"date": match.group("date")} if match.group("date") else {}
+        result = await _handle_tool_call("list_purchase_orders", args, user_id)
+        if "error" in result["content"]:
+            return None
+        return {"type": "NORMAL", "content": _format_orders(result["content"])}
+
+    return None
+
+
+def _record_usage(usage):
+    if usage:
+        LLM_TOKENS.inc(usage.prompt_tokens or 0, model=OPENAI_MODEL, type="prompt")
+        LLM_TOKENS.inc(usage.completion_tokens or 0, model=OPENAI_MODEL, type="completion")
+
+
+async def _complete(conversation, final_step, stream):
+    # Cada llamada ocupa un slot de llm_admission mientras dura (en stream,
+    # hasta consumir el último fragmento).
+    async with llm_admission.slot():
+        async for event in _request_completion(conversation, final_step, stream):
+            yield event
+
+
+async def _request_completion(conversation, final_step, stream):
+    # Devuelve (texto, tool_calls) del paso; en modo stream además emite los
+    # fragmentos de texto como eventos DELTA.
+    options = {"tool_choice": "none"} if final_step else {}
+    if stream:
+        options["stream_options"] = {"include_usage": True}
+    started = time.perf_counter()
+    try:
+        response = await get_client().chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=conversation,
+            tools=tools,
+            stream=stream,
+            **options
+        )
+    except Exception as e:
+        STAGE_LATENCY.observe(time.perf_counter() - started, stage="llm_call")
+        logger.error("Error al llamar OpenAI: %s", e)
+        raise
+
+    if not stream:
+        STAGE_LATENCY.observe(time.perf_counter() - started, stage="llm_call")
+        _record_usage(response.usage)
+        logger.debug("Respuesta OpenAI: %s", response, extra={"route": "agent"})
+        msg = response.choices[0].message
+        tool_calls = [
+            {"id": call.id, "name": call.function.name, "arguments": call.function.arguments}
+            for call in msg.tool_calls or []
+        ]
+        yield {"type": "STEP", "content": msg.content, "tool_calls": tool_calls}
+        return
+
+    content_parts = []
+    tool_calls = {}
+    try:
+        async for chunk in response:
+            if getattr(chunk, "usage", None):
+                _record_usage(chunk.usage)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                content_parts.append(delta.content)
+                yield {"type": "DELTA", "content": delta.content}
+            for tool_delta in delta.tool_calls or []:
+                entry = tool_calls.setdefault(tool_delta.index, {"id": "", "name": "", "arguments": ""})
+                if tool_delta.id:
+                    entry["id"] = tool_delta.id
+                if tool_delta.function and tool_delta.function.name:
+                    entry["name"] += tool_delta.function.name
+                if tool_delta.function and tool_delta.function.arguments:
+                    entry["arguments"] += tool_delta.function.arguments
+    finally:
+        STAGE_LATENCY.observe(time.perf_counter() - started, stage="llm_call")
+    yield {
+        "type": "STEP",
+        "content": "".join(content_parts) or None,
+        "tool_calls": [tool_calls[index] for index in sorted(tool_calls)],
+    }
+
+
+async def _timed_tool_call(call, user_id):
+    with STAGE_LATENCY.time(stage=f"tool:{call['name']}"):
+        return await _handle_tool_call(call["name"], call["arguments"], user_id)
+
+
+_CREATE_ACTIONS = {"CREATE_PURCHASE_ORDER", "CREATE_PURCHASE_ORDERS_BATCH"}
+_DELETE_ACTIONS = {"DELETE_PURCHASE_ORDER", "DELETE_PURCHASE_ORDERS_BATCH"}
+
+
+def _combine_unsafe(unsafe, notices):
+    """Una sola aprobación para todas las acciones UNSAFE de una respuesta.
+
+    Altas (o bajas) sueltas y en lote se funden en un único lote; si se
+    mezclan altas y bajas se pide aprobación de la primera y el impacto indica
+    qué acciones quedaron sin ejecutar. Los avisos NORMAL de otras llamadas
+    también se agregan al impacto para que no se pierdan.
+    """
+    actions = {result["payload"]["action"] for result in unsafe}
+    skipped = []
+    if len(unsafe) == 1:
+        combined = unsafe[0]
+    elif actions <= _CREATE_ACTIONS:
+        items = []
+        for result in unsafe:
+            payload = result["payload"]
+            if payload["action"] == "CREATE_PURCHASE_ORDERS_BATCH":
+                items.extend(payload["items"])
+            else:
+                items.append({key: value for key, value in payload.items() if key != "action"})
+        error = _batch_size_error(len(items))
+        if error:
+            return error
+        justification = next((r["payload"]["justification"] for r in unsafe if r["payload"].get("justification")), "")
+        combined = _create_batch_result(items, justification)
+    elif actions <= _DELETE_ACTIONS:
+        targets = {}
+        for result in unsafe:
+            record = result["approval"]["record"]
+            for order in record["orders"] if result["payload"]["action"] == "DELETE_PURCHASE_ORDERS_BATCH" else [record]:
+                targets.setdefault(order["id"], order)
+        error = _batch_size_error(len(targets))
+        if error:
+            return error
+        reason = next((r["payload"]["reason"] for r in unsafe if r["payload"].get("reason")), "")
+        combined = _delete_batch_result(list(targets.values()), reason)
+    else:
+        combined = unsafe[0]
+        skipped = [result["payload"]["action"] for result in unsafe[1:]]
+
+    notes = [notice["content"] for notice in notices]
+    if skipped:
+        notes.append(
+            "No se ejecutaron en esta aprobación: " + ", ".join(f"`{action}`" for action in skipped)
+            + ". Pídelas por separado."
+        )
+    if not notes:
+        return combined
+    approval = {**combined["approval"], "impact": "\n\n".join([combined["approval"]["impact"], *notes])}
+    if skipped:
+        approval["skipped_actions"] = skipped
+    return {**combined, "approval": approval}
+
+
+def _with_candidates(result, candidates):
+    if candidates:
+        result["candidates"] = candidates
+    return result
+
+
+def _combine_notices(notices):
+    # Todas las llamadas terminaron en un aviso: se muestran todos, no solo el primero
+    if len(notices) == 1:
+        return notices[0]
+    return _with_candidates(
+        {"type": "NORMAL", "content": "\n\n".join(notice["content"] for notice in notices)},
+        [c for notice in notices for c in notice.get("candidates") or []],
+    )
+
+
+async def _agent_events(messages, user_id=None, stream=False):
+    # Bucle del agente: ejecuta todas las tool calls de cada respuesta (en
+    # paralelo), devuelve los resultados al modelo y repite hasta obtener una
+    # respuesta final o agotar el presupuesto de pasos/tiempo. Las acciones
+    # UNSAFE cortan el bucle para la aprobación humana.
+    started = time.perf_counter()
+    fast_result = await _fast_path(messages, user_id)
+    STAGE_LATENCY.observe(time.perf_counter() - started, stage="fast_path")
+    if fast_result:
+        _record_path("fast_path", time.perf_counter() - started)
+        logger.info("Fast path: %s", fast_result["type"])
+        yield fast_result
+        return
+
+    try:
+        async for event in _model_events(messages, user_id, stream):
+            yield event
+    finally:
+        _record_path("model", time.perf_counter() - started)
+
+
+async def _model_events(messages, user_id, stream):
+    _log_request(messages)
+    conversation = list(messages)
+    deadline = time.monotonic() + AGENT_MAX_SECONDS
+    content = None
+    # Candidatos de avisos que volvieron al modelo; se adjuntan a la respuesta final
+    candidates = []
+
+    decision_key = _decision_key(messages) if AGENT_MAX_STEPS > 1 else None
+
+    for step in range(AGENT_MAX_STEPS):
+        final_step = step == AGENT_MAX_STEPS - 1 or time.monotonic() >= deadline
+        step_result = None
+        cached = _decision_cache.get(decision_key) if step == 0 and decision_key else None
+        if cached:
+            logger.info("Decisión cacheada: %s", [call["name"] for call in cached])
+            step_result = {
+                "content": None,
+                "tool_calls": [
+                    {
+                        "id": f"call_{uuid.uuid4().hex[:24]}",
+                        "name": call["name"],
+                        "arguments": json.dumps(call["arguments"], ensure_ascii=False),
+                    }
+                    for call in cached
+                ],
             }
+        else:
+            async for event in _complete(conversation, final_step, stream):
+                if event["type"] == "DELTA":
+                    yield event
+                else:
+                    step_result = event
+            if step == 0 and decision_key and step_result["tool_calls"]:
+                decision = _cacheable_decision(step_result["tool_calls"])
+                if decision:
+                    _decision_cache.put(decision_key, decision)
+
+        content = step_result["content"]
+        tool_calls = step_result["tool_calls"]
+        if not tool_calls:
+            yield _with_candidates({"type": "NORMAL", "content": content}, candidates)
+            return
+
+        results = await asyncio.gather(*[_timed_tool_call(call, user_id) for call in tool_calls])
+        unsafe = [result for result in results if result["type"] == "UNSAFE"]
+        notices = [result for result in results if result["type"] == "NORMAL"]
+        if unsafe:
+            yield _combine_unsafe(unsafe, notices)
+            return
+        if len(notices) == len(results):
+            yield _combine_notices(notices)
+            return
+        # Avisos junto a resultados de otras herramientas: el modelo recibe
+        # ambos y responde con todo (los avisos van como resultado de su llamada)
+        candidates.extend(c for notice in notices for c in notice.get("candidates") or [])
+
+        conversation.append({
+            "role": "assistant",
+            "content": content,
+            "tool_calls": [
+                {
+                    "id": call["id"],
+                    "type": "function",
+                    "function": {"name": call["name"], "arguments": call["arguments"]},
+                }
+                for call in tool_calls
+            ],
+        })
+        for call, result in zip(tool_calls, results):
+            conversation.append({
+                "role": "tool",
+                "tool_call_id": call["id"],
+                "content": json.dumps(result["content"], ensure_ascii=False, default=str),
+            })
+        logger.info("Paso %s del agente: %s", step + 1, [call["name"] for call in tool_calls])
+
+    yield _with_candidates({
+        "type": "NORMAL",
+        "content": content or "No pude completar la consulta dentro del límite de pasos del agente."
+    }, candidates)
+
+
+async def run_agent(messages, user_id=None):
+    result = None
+    async for event in _agent_events(messages, user_id=user_id):
+        result = event
+    return result
+
 
-    return {"type":"NORMAL","content":msg.content}
+async def stream_agent(messages, user_id=None):
+    # Emite el texto del asistente a medida que llega (eventos DELTA) y cierra
+    # con el mismo resultado estructurado que run_agent (NORMAL o UNSAFE).
+    async for event in _agent_events(messages, user_id=user_id, stream=True):
+        yield event
@@ -0,0 +1,56 @@
+import os
+import re
+
+
+# Presupuesto de tokens del historial enviado al modelo
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CHAT_CONTEXT_TOKEN_BUDGET", "3000"))
+# Turnos más recientes que se envían sin compactar
+RECENT_TURNS = int(os.getenv("CHAT_RECENT_TURNS", "6"))
+# Máximo de caracteres de un turno antiguo compactado
+COMPACT_MAX_CHARS = 280
+
+_CODE_BLOCK = re.compile(r"```.*?(```|$)", re.DOTALL)
+
+
+def estimate_tokens(text):
+    # Aproximación de ~4 caracteres por token más el overhead por mensaje
+    return len(text or "") // 4 + 4
+
+
+def compact_message(message):
+    content = _CODE_BLOCK.sub("[bloque omitido]", message.get("content") or "")
+    content = " ".join(content.split())
+    if len(content) > COMPACT_MAX_CHARS:
+        content = content[:COMPACT_MAX_CHARS] + "…"
+    return {"role": message["role"], "content": content}
+
+
+def build_context(history, new_message, token_budget=CONTEXT_TOKEN_BUDGET, recent_turns=RECENT_TURNS):
+    # Recorre el historial del más nuevo al más antiguo: los turnos recientes
+    # van completos, los antiguos compactados y el resto se descarta cuando
+    # se agota el presupuesto.
+    messages = [{"role": m["role"], "content": m.get("content") or ""} for m in history]
+    budget = token_budget - estimate_tokens(new_message["content"])
+    window = []
+    for position, message in enumerate(reversed(messages)):
+        if position >= recent_turns:
+            message = compact_message(message)
+        cost = estimate_tokens(message["content"])
+        if cost > budget:
+            if position < recent_turns:
+                message = compact_message(message)
+                cost = estimate_tokens(message["content"])
+            if cost > budget:
+                break
+        window.append(message)
+        budget -= cost
+
+    omitted = len(messages) - len(window)
+    window.reverse()
+    if omitted:
+        window.insert(0, {
+            "role": "system",
+            "content": f"Se omitieron {omitted} mensajes anteriores de la conversación.",
+        })
+    window.append({"role": new_message["role"], "content": new_message["content"]})
+    return window
@@ -0,0 +1,395 @@
+import itertools
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from functools import cmp_to_key
+from types import SimpleNamespace
+
+from google.api_core import exceptions as google_exceptions
+from google.cloud.firestore_v1.transforms import SERVER_TIMESTAMP, Increment
+
+
+# Subconjunto del cliente de Firestore que usa firebase_service, en memoria.
+# Cada llamada que en producción es un round-trip duerme `latency` segundos
+# para simular la red.
+
+_DESCENDING = "DESCENDING"
+_OPERATORS = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a is not None and a < b,
+    "<=": lambda a, b: a is not None and a <= b,
+    ">": lambda a, b: a is not None and a > b,
+    ">=": lambda a, b: a is not None and a >= b,
+    "in": lambda a, b: a in b,
+}
+_EPOCH = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+
+def _compare(a, b):
+    if a == b:
+        return 0
+    if a is None:
+        return -1
+    if b is None:
+        return 1
+    return -1 if a < b else 1
+
+
+class _Snapshot:
+    def __init__(self, reference, data, update_time):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+        self.update_time = update_time
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+class _Collection:
+    # Documentos de una colección más índices de igualdad creados a demanda
+    # (así una consulta por user_id no recorre 100k documentos).
+
+    def __init__(self):
+        self.docs = {}
+        self.update_times = {}
+        self.indexes = {}
+        self.watchers = []
+
+    def index(self, field):
+        index = self.indexes.get(field)
+        if index is None:
+            index = self.indexes[field] = {}
+            for doc_id, data in self.docs.items():
+                self._index_add(index, data.get(field), doc_id)
+        return index
+
+    @staticmethod
+    def _index_add(index, value, doc_id):
+        try:
+            index.setdefault(value, set()).add(doc_id)
+        except TypeError:
+            pass
+
+    def put(self, doc_id, data, update_time):
+        self.remove(doc_id)
+        self.docs[doc_id] = data
+        self.update_times[doc_id] = update_time
+        for field, index in self.indexes.items():
+            self._index_add(index, data.get(field), doc_id)
+
+    def remove(self, doc_id):
+        data = self.docs.pop(doc_id, None)
+        self.update_times.pop(doc_id, None)
+        if data is None:
+            return None
+        for field, index in self.indexes.items():
+            try:
+                ids = index.get(data.get(field))
+            except TypeError:
+                continue
+            if ids is not None:
+                ids.discard(doc_id)
+        return data
+
+
+class FakeFirestore:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self._lock = threading.RLock()
+        self._collections = {}
+        self._clock = itertools.count(1)
+        self.round_trips = 0
+
+    def _round_trip(self):
+        with self._lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _next_update_time(self):
+        return _EPOCH + timedelta(microseconds=next(self._clock))
+
+    def _collection_data(self, path):
+        with self._lock:
+            collection = self._collections.get(path)
+            if collection is None:
+                collection = self._collections[path] = _Collection()
+            return collection
+
+    def collection(self, name):
+        return CollectionReference(self, name)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def get_all(self, references):
+        # BatchGetDocuments: un round trip para todas las referencias
+        self._round_trip()
+        with self._lock:
+            snapshots = []
+            for reference in references:
+                collection = self._collection_data(reference.parent_path)
+                data = collection.docs.get(reference.id)
+                snapshots.append(
+                    _Snapshot(reference, dict(data) if data is not None else None, collection.update_times.get(reference.id))
+                )
+        return snapshots
+
+    def write_option(self, last_update_time=None, exists=None):
+        return SimpleNamespace(last_update_time=last_update_time, exists=exists)
+
+    def close(self):
+        pass
+
+    # -- escrituras (con el lock tomado) --
+
+    def _check(self, reference, option):
+        if option is None:
+            return
+        data = self._collection_data(reference.parent_path)
+        exists = reference.id in data.docs
+        if option.exists is True and not exists:
+            raise google_exceptions.NotFound(f"No document to update: {reference.path}")
+        if option.exists is False and exists:
+            raise google_exceptions.AlreadyExists(f"Document already exists: {reference.path}")
+        if option.last_update_time is not None:
+            if not exists:
+                raise google_exceptions.NotFound(f"No document to update: {reference.path}")
+            if data.update_times[reference.id] != option.last_update_time:
+                raise google_exceptions.FailedPrecondition(f"update_time precondition failed: {reference.path}")
+
+    def _apply(self, kind, reference, data=None, merge=False):
+        collection = self._collection_data(reference.parent_path)
+        if kind == "delete":
+            previous = collection.remove(reference.id)
+            change_type = "REMOVED" if previous is not None else None
+            snapshot = _Snapshot(reference, previous, None)
+        else:
+            if kind == "update" and reference.id not in collection.docs:
+                raise google_exceptions.NotFound(f"No document to update: {reference.path}")
+            previous = collection.docs.get(reference.id, {}) if kind == "update" or merge else {}
+            data = {key: self._transform(value, previous.get(key)) for key, value in data.items()}
+            data = {**previous, **data}
+            change_type = "MODIFIED" if reference.id in collection.docs else "ADDED"
+            update_time = self._next_update_time()
+            collection.put(reference.id, dict(data), update_time)
+            snapshot = _Snapshot(reference, dict(data), update_time)
+        if change_type and collection.watchers:
+            change = SimpleNamespace(type=SimpleNamespace(name=change_type), document=snapshot)
+            for callback in list(collection.watchers):
+                callback([], [change], datetime.now(timezone.utc))
+
+
+    @staticmethod
+    def _transform(value, previous):
+        if value is SERVER_TIMESTAMP:
+            return datetime.now(timezone.utc)
+        if isinstance(value, Increment):
+            return (previous if isinstance(previous, (int, float)) else 0) + value.value
+        return value
+
+
+class DocumentReference:
+    def __init__(self, client, parent_path, doc_id):
+        self._client = client
+        self.parent_path = parent_path
+        self.id = doc_id
+        self.path = f"{parent_path}/{doc_id}"
+
+    def collection(self, name):
+        return CollectionReference(self._client, f"{self.path}/{name}")
+
+    def get(self):
+        self._client._round_trip()
+        collection = self._client._collection_data(self.parent_path)
+        with self._client._lock:
+            data = collection.docs.get(self.id)
+            return _Snapshot(self, dict(data) if data is not None else None, collection.update_times.get(self.id))
+
+    def set(self, data, merge=False):
+        self._client._round_trip()
+        with self._client._lock:
+            self._client._apply("set", self, data, merge)
+
+    def update(self, data):
+        self._client._round_trip()
+        with self._client._lock:
+            self._client._apply("update", self, data)
+
+    def create(self, data):
+        self._client._round_trip()
+        with self._client._lock:
+            self._client._check(self, self._client.write_option(exists=False))
+            self._client._apply("set", self, data)
+
+    def delete(self, option=None):
+        self._client._round_trip()
+        with self._client._lock:
+            self._client._check(self, option)
+            self._client._apply("delete", self)
+
+
+class Query:
+    def __init__(self, client, path, filters=(), orders=(), cursor=None, limit=None, fields=None):
+        self._client = client
+        self._path = path
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._cursor = cursor
+        self._limit = limit
+        self._fields = fields
+
+    def _copy(self, **changes):
+        state = {
+            "filters": self._filters,
+            "orders": self._orders,
+            "cursor": self._cursor,
+            "limit": self._limit,
+            "fields": self._fields,
+        }
+        state.update(changes)
+        return Query(self._client, self._path, **state)
+
+    def where(self, filter):
+        return self._copy(filters=self._filters + ((filter.field_path, filter.op_string, filter.value),))
+
+    def order_by(self, field, direction="ASCENDING"):
+        return self._copy(orders=self._orders + ((field, direction),))
+
+    def start_after(self, values):
+        return self._copy(cursor=dict(values))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def select(self, fields):
+        return self._copy(fields=tuple(fields))
+
+    def _candidates(self, collection):
+        equality = [(field, value) for field, op, value in self._filters if op == "=="]
+        if not equality:
+            return list(collection.docs)
+        sets = []
+        for field, value in equality:
+            try:
+                sets.append(collection.index(field).get(value, set()))
+            except TypeError:
+                return list(collection.docs)
+        sets.sort(key=len)
+        return list(set.intersection(*sets)) if len(sets) > 1 else list(sets[0])
+
+    def _sort_key(self, orders):
+        def compare(a, b):
+            for field, direction in orders:
+                left = a[0] if field == "__name__" else a[1].get(field)
+                right = b[0] if field == "__name__" else b[1].get(field)
+                result = _compare(left, right)
+                if result:
+                    return -result if direction == _DESCENDING else result
+            return 0
+        return cmp_to_key(compare)
+
+    def _after_cursor(self, item, orders):
+        for field, direction in orders:
+            if field not in self._cursor:
+                continue
+            value = item[0] if field == "__name__" else item[1].get(field)
+            result = _compare(value, self._cursor[field])
+            if result:
+                return (result < 0) if direction == _DESCENDING else (result > 0)
+        return False
+
+    def stream(self):
+        self._client._round_trip()
+        collection = self._client._collection_data(self._path)
+        with self._client._lock:
+            items = []
+            for doc_id in self._candidates(collection):
+                data = collection.docs[doc_id]
+                if all(_OPERATORS[op](data.get(field), value) for field, op, value in self._filters):
+                    items.append((doc_id, data, collection.update_times[doc_id]))
+
+        orders = self._orders
+        if not any(field == "__name__" for field, _ in orders):
+            orders = orders + (("__name__", orders[-1][1] if orders else "ASCENDING"),)
+        items.sort(key=self._sort_key(orders))
+        if self._cursor is not None:
+            items = [item for item in items if self._after_cursor(item, orders)]
+        if self._limit is not None:
+            items = items[:self._limit]
+
+        for doc_id, data, update_time in items:
+            if self._fields is not None:
+                data = {field: data[field] for field in self._fields if field in data}
+            yield _Snapshot(DocumentReference(self._client, self._path, doc_id), dict(data), update_time)
+
+    def get(self):
+        return list(self.stream())
+
+
+class CollectionReference(Query):
+    def __init__(self, client, path):
+        super().__init__(client, path)
+
+    def document(self, doc_id=None):
+        return DocumentReference(self._client, self._path, doc_id or uuid.uuid4().hex)
+
+    def add(self, data):
+        reference = self.document()
+        reference.set(data)
+        return None, reference
+
+    def on_snapshot(self, callback):
+        # Entrega el snapshot inicial completo en un hilo aparte, como el
+        # listener real, y luego cada cambio de forma síncrona.
+        collection = self._client._collection_data(self._path)
+        with self._client._lock:
+            changes = [
+                SimpleNamespace(
+                    type=SimpleNamespace(name="ADDED"),
+                    document=_Snapshot(
+                        DocumentReference(self._client, self._path, doc_id), dict(data), collection.update_times[doc_id]
+                    ),
+                )
+                for doc_id, data in collection.docs.items()
+            ]
+            collection.watchers.append(callback)
+        threading.Thread(
+            target=callback, args=([], changes, datetime.now(timezone.utc)), daemon=True
+        ).start()
+        return SimpleNamespace(unsubscribe=lambda: collection.watchers.remove(callback))
+
+
+class WriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append(("set", reference, dict(data), None, merge))
+
+    def update(self, reference, data, option=None):
+        self._writes.append(("update", reference, dict(data), option, False))
+
+    def create(self, reference, data):
+        self._writes.append(("set", reference, dict(data), self._client.write_option(exists=False), False))
+
+    def delete(self, reference, option=None):
+        self._writes.append(("delete", reference, None, option, False))
+
+    def commit(self):
+        # Atómico: primero se verifican todas las precondiciones
+        self._client._round_trip()
+        with self._client._lock:
+            for _, reference, _, option, _ in self._writes:
+                self._client._check(reference, option)
+            for kind, reference, data, _, merge in self._writes:
+                self._client._apply(kind, reference, data, merge)
+        return []
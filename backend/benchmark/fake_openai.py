@@ -0,0 +1,79 @@
+import asyncio
+import json
+import re
+import time
+import uuid
+
+import httpx
+from fastapi import FastAPI
+from openai import AsyncOpenAI
+
+
+# Servidor local compatible con /v1/chat/completions. Si el último mensaje del
+# usuario pide "<n> unidades de <detail>" responde con una llamada a
+# create_purchase_order; si no, con texto. La latencia es configurable.
+
+_ORDER_REQUEST = re.compile(r"(?P<quantity>\d+)\s+unidades\s+de\s+(?P<detail>.+?)(?:\s+para\b|[.?!]|$)", re.IGNORECASE)
+
+
+def _last_user_message(messages):
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            return message.get("content") or ""
+    return ""
+
+
+def _usage(messages, completion_tokens):
+    prompt_tokens = sum(len(str(m.get("content") or "")) for m in messages) // 4
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def create_fake_openai_app(latency=0.0):
+    app = FastAPI(title="Fake OpenAI")
+    app.state.latency = latency
+    app.state.requests = 0
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(body: dict):
+        app.state.requests += 1
+        if app.state.latency:
+            await asyncio.sleep(app.state.latency)
+
+        messages = body.get("messages", [])
+        match = _ORDER_REQUEST.search(_last_user_message(messages))
+        if match and body.get("tool_choice") != "none" and messages[-1].get("role") == "user":
+            arguments = {"detail": match.group("detail").strip(), "quantity": int(match.group("quantity"))}
+            message = {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [{
+                    "id": f"call_{uuid.uuid4().hex[:12]}",
+                    "type": "function",
+                    "function": {"name": "create_purchase_order", "arguments": json.dumps(arguments)},
+                }],
+            }
+            finish_reason = "tool_calls"
+        else:
+            message = {"role": "assistant", "content": "Hola, ¿en qué puedo ayudarte con tus órdenes de compra?"}
+            finish_reason = "stop"
+
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+            "usage": _usage(messages, 20),
+        }
+
+    return app
+
+
+def fake_openai_client(app):
+    # Cliente del SDK real apuntando al servidor falso dentro del proceso
+    http_client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://fake-openai")
+    return AsyncOpenAI(api_key="benchmark", base_url="http://fake-openai/v1", http_client=http_client, max_retries=0)
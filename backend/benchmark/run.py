@@ -0,0 +1,330 @@
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+# Los registros por request distorsionan las mediciones
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+CURRENT_DIR = Path(__file__).resolve().parent
+BACKEND_DIR = CURRENT_DIR.parent
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+import httpx  # noqa: E402
+import numpy as np  # noqa: E402
+
+from application import agent  # noqa: E402
+from benchmark.fake_firestore import FakeFirestore  # noqa: E402
+from benchmark.fake_openai import create_fake_openai_app, fake_openai_client  # noqa: E402
+from infrastructure import firebase_service  # noqa: E402
+from infrastructure.bulk_loader import MAX_BATCH_SIZE  # noqa: E402
+from infrastructure.firestore_repository import FirestoreRepository  # noqa: E402
+from infrastructure.sqlite_repository import SQLiteRepository  # noqa: E402
+from presentation import api  # noqa: E402
+from script.seed import random_purchase  # noqa: E402
+from script.seed_products import random_product  # noqa: E402
+
+
+DEFAULT_SIZES = "1000,10000,100000"
+# Rechazos del control de admisión: se cuentan aparte y no entran en los
+# percentiles, donde sus respuestas inmediatas harían parecer más rápida una
+# corrida sobrecargada
+REJECTED_STATUSES = ("429", "503")
+
+
+def summarize(latencies, elapsed=None):
+    # Percentiles en milisegundos; `elapsed` (s) permite calcular el throughput
+    if not latencies:
+        return {"count": 0}
+    values = np.asarray(latencies) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    summary = {
+        "count": len(latencies),
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "max_ms": round(float(values.max()), 3),
+    }
+    if elapsed:
+        summary["elapsed_s"] = round(elapsed, 3)
+        summary["rps"] = round(len(latencies) / elapsed, 2)
+    return summary
+
+
+def use_storage(storage, datasets, latency=0.0):
+    # Backend nuevo para firebase_service, cargado con datasets = [(colección, docs, id_field)]
+    if storage == "sqlite":
+        path = Path(tempfile.mkdtemp(prefix="hitl-bench-")) / "bench.db"
+        repository = SQLiteRepository(str(path))
+    else:
+        repository = FirestoreRepository(FakeFirestore())
+    for collection, docs, id_field in datasets:
+        for i in range(0, len(docs), MAX_BATCH_SIZE):
+            repository.write_batch(collection, docs[i:i + MAX_BATCH_SIZE], id_field)
+    if storage != "sqlite":
+        repository.db.latency = latency
+    firebase_service.set_repository(repository)
+    # El dataset vive toda la medición: fuera del GC para no medir sus pausas
+    gc.collect()
+    gc.freeze()
+    return repository
+
+
+def round_trips(repository):
+    fake = getattr(repository, "db", None)
+    return fake.round_trips if isinstance(fake, FakeFirestore) else None
+
+
+def make_products(n):
+    return [random_product(i) for i in range(1, n + 1)]
+
+
+def make_orders(n, products, users, days=365):
+    now = datetime.now(timezone.utc)
+    orders = []
+    for i in range(n):
+        order = random_purchase(users[i % len(users)], products)
+        order["purchase_date"] = (now - timedelta(seconds=random.uniform(0, days * 86400))).isoformat()
+        orders.append(firebase_service.purchase_record(order))
+    return orders
+
+
+def time_calls(func, args_list):
+    latencies = []
+    started = time.perf_counter()
+    for args in args_list:
+        call_started = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - call_started)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+# ---------------------------------------------------------------------------
+# Micro-benchmarks
+# ---------------------------------------------------------------------------
+
+def bench_product_lookup(storage, size, iterations):
+    products = make_products(size)
+    use_storage(storage, [("products", products, "product_id")])
+
+    started = time.perf_counter()
+    firebase_service.start_product_catalog()
+    index_seconds = time.perf_counter() - started
+
+    sample = [random.choice(products) for _ in range(iterations)]
+    result = {
+        "index_build_ms": round(index_seconds * 1000, 3),
+        "exact": time_calls(firebase_service.get_product_by_detail, [(p["detail"].upper(),) for p in sample]),
+        # Sin el adjetivo ("Laptop 123"): pasa por el índice de trigramas
+        "partial": time_calls(
+            firebase_service.get_product_by_detail, [(p["detail"].split(" ", 1)[1],) for p in sample]
+        ),
+        "miss": time_calls(firebase_service.get_product_by_detail, [(f"inexistente {i}",) for i in range(iterations)]),
+    }
+    firebase_service.stop_product_catalog()
+    return result
+
+
+def bench_list_orders(storage, size, iterations, users_count, page_size):
+    products = make_products(min(size, 1000))
+    users = [f"user{i:04d}@empresa.com" for i in range(users_count)]
+    use_storage(storage, [("purchase_orders", make_orders(size, products, users), "id")])
+    cache = firebase_service._purchase_order_cache
+
+    def cold(user_id, **filters):
+        cache.clear()
+        return firebase_service.list_purchase_orders(user_id=user_id, limit=page_size, **filters)
+
+    def warm(user_id):
+        return firebase_service.list_purchase_orders(user_id=user_id, limit=page_size)
+
+    def next_page(user_id):
+        first = firebase_service.query_purchase_orders(user_id=user_id, limit=page_size)
+        if first["next_cursor"]:
+            cache.clear()
+            firebase_service.query_purchase_orders(user_id=user_id, limit=page_size, cursor=first["next_cursor"])
+
+    sample = [(random.choice(users),) for _ in range(iterations)]
+    day = (datetime.now(timezone.utc) - timedelta(days=30)).date().isoformat()
+    result = {
+        "orders_per_user": size // users_count,
+        "cold_first_page": time_calls(cold, sample),
+        "cold_single_day": time_calls(lambda user: cold(user, date=day), sample),
+    }
+    for user in set(u for (u,) in sample):
+        warm(user)
+    result["cached_first_page"] = time_calls(warm, sample)
+    result["cursor_second_page"] = time_calls(next_page, sample)
+    return result
+
+
+def run_micro(args):
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    results = {"get_product_by_detail": {}, "list_purchase_orders": {}}
+    for size in sizes:
+        print(f"[micro] get_product_by_detail n={size}", flush=True)
+        results["get_product_by_detail"][str(size)] = bench_product_lookup(args.storage, size, args.iterations)
+        print(f"[micro] list_purchase_orders n={size}", flush=True)
+        results["list_purchase_orders"][str(size)] = bench_list_orders(
+            args.storage, size, args.iterations, args.users, args.page_size
+        )
+    return results
+
+
+# ---------------------------------------------------------------------------
+# Prueba de carga de /chat y /execute
+# ---------------------------------------------------------------------------
+
+async def _drive(client, path, bodies, concurrency):
+    # `concurrency` clientes tomando requests de una cola común. Como un usuario
+    # real, ninguno tiene dos requests en curso: el siguiente turno de un
+    # usuario espera a la respuesta del anterior
+    queue = asyncio.Queue()
+    for body in bodies:
+        queue.put_nowait(body)
+    latencies, statuses, responses = [], {}, []
+    user_locks = {}
+
+    async def worker():
+        while True:
+            try:
+                body = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            async with user_locks.setdefault(body["user_id"], asyncio.Lock()):
+                started = time.perf_counter()
+                try:
+                    response = await client.post(path, json=body)
+                    status = str(response.status_code)
+                    payload = response.json() if response.status_code == 200 else None
+                except Exception as e:
+                    status, payload = type(e).__name__, None
+                elapsed = time.perf_counter() - started
+            if status not in REJECTED_STATUSES:
+                latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+            responses.append((body, payload))
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    summary = summarize(latencies, time.perf_counter() - started)
+    summary["status_codes"] = statuses
+    summary["rejected"] = {status: statuses[status] for status in REJECTED_STATUSES if status in statuses}
+    return summary, responses
+
+
+def chat_bodies(args, products):
+    users = [f"user{i:04d}@empresa.com" for i in range(args.users)]
+    bodies = []
+    # Usuarios en round-robin; _drive además serializa los turnos de cada
+    # usuario, que el backend rechazaría con 429 (CHAT_MAX_INFLIGHT_PER_USER)
+    for i in range(args.requests):
+        if random.random() < args.tool_ratio:
+            product = random.choice(products)
+            message = f"necesito {random.randint(1, 20)} unidades de {product['detail']} para el equipo"
+        else:
+            message = "hola, ¿qué puedes hacer por mí?"
+        bodies.append({"user_id": users[i % len(users)], "message": message})
+    return bodies
+
+
+async def run_load(args):
+    products = make_products(args.products)
+    repository = use_storage(
+        args.storage, [("products", products, "product_id")], latency=args.db_latency_ms / 1000
+    )
+    openai_app = create_fake_openai_app(latency=args.llm_latency_ms / 1000)
+    agent.client = fake_openai_client(openai_app)
+
+    transport = httpx.ASGITransport(app=api.app)
+    async with api.app.router.lifespan_context(api.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            print(f"[load] /chat requests={args.requests} concurrency={args.concurrency}", flush=True)
+            if args.users < args.concurrency:
+                print(
+                    f"[load] aviso: --users {args.users} < --concurrency {args.concurrency}; "
+                    f"como máximo {args.users} requests en curso a la vez",
+                    flush=True,
+                )
+            before = round_trips(repository)
+            chat, responses = await _drive(client, "/chat", chat_bodies(args, products), args.concurrency)
+            if before is not None:
+                chat["firestore_round_trips"] = round_trips(repository) - before
+                chat["firestore_round_trips_per_request"] = round(
+                    chat["firestore_round_trips"] / max(1, args.requests), 2
+                )
+            chat["llm_requests"] = openai_app.state.requests
+            chat["approval_required"] = sum(
+                1 for _, payload in responses if payload and payload.get("status") == "APPROVAL_REQUIRED"
+            )
+
+            executes = [
+                {"user_id": body["user_id"], "ticket_id": payload["ticket_id"]}
+                for body, payload in responses
+                if payload and payload.get("ticket_id")
+            ]
+            print(f"[load] /execute requests={len(executes)} concurrency={args.concurrency}", flush=True)
+            before = round_trips(repository)
+            execute, _ = await _drive(client, "/execute", executes, args.concurrency)
+            if before is not None:
+                execute["firestore_round_trips"] = round_trips(repository) - before
+                execute["firestore_round_trips_per_request"] = round(
+                    execute["firestore_round_trips"] / max(1, len(executes)), 2
+                )
+    return {"/chat": chat, "/execute": execute}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks reproducibles del backend con Firestore y OpenAI simulados en proceso."
+    )
+    parser.add_argument("suite", choices=["load", "micro", "all"])
+    parser.add_argument("--output", default="benchmark-results.json", help="Archivo JSON de resultados")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument(
+        "--storage", choices=["firestore", "sqlite"], default="firestore",
+        help="firestore: Firestore simulado en memoria; sqlite: SQLiteRepository sobre un archivo temporal",
+    )
+    load = parser.add_argument_group("load")
+    load.add_argument("--requests", type=int, default=500, help="Requests a /chat")
+    load.add_argument("--concurrency", type=int, default=50)
+    load.add_argument("--users", type=int, default=100)
+    load.add_argument("--products", type=int, default=1000, help="Tamaño del catálogo en la prueba de carga")
+    load.add_argument("--tool_ratio", type=float, default=0.5, help="Fracción de mensajes que piden crear una orden")
+    load.add_argument("--llm_latency_ms", type=float, default=300)
+    load.add_argument("--db_latency_ms", type=float, default=5, help="Latencia por round-trip (solo --storage firestore)")
+    micro = parser.add_argument_group("micro")
+    micro.add_argument("--sizes", default=DEFAULT_SIZES, help="Cantidades de documentos, separadas por coma")
+    micro.add_argument("--iterations", type=int, default=1000)
+    micro.add_argument("--page_size", type=int, default=firebase_service.DEFAULT_PAGE_SIZE)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    results = {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": vars(args),
+    }
+    if args.suite in ("micro", "all"):
+        results["micro"] = run_micro(args)
+    if args.suite in ("load", "all"):
+        results["load"] = asyncio.run(run_load(args))
+
+    Path(args.output).write_text(json.dumps(results, indent=2, ensure_ascii=False))
+    print(json.dumps({key: results[key] for key in ("micro", "load") if key in results}, indent=2))
+    print(f"Resultados guardados en {args.output}")
+
+
+if __name__ == "__main__":
+    main()
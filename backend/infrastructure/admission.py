@@ -0,0 +1,147 @@
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+try:
+    from .metrics import ADMISSION_REJECTIONS, STAGE_LATENCY
+    from .settings import load_env
+except ImportError:
+    from infrastructure.metrics import ADMISSION_REJECTIONS, STAGE_LATENCY
+    from infrastructure.settings import load_env
+
+load_env()
+
+# Límites por proceso (cada worker de uvicorn tiene los suyos)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "64"))
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", "10"))
+CHAT_MAX_INFLIGHT_PER_USER = int(os.getenv("CHAT_MAX_INFLIGHT_PER_USER", "1"))
+
+
+class AdmissionRejected(Exception):
+    """Rechazo rápido por sobrecarga: 429 (límite del usuario) o 503 (global)."""
+
+    def __init__(self, status_code, reason, retry_after, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+        self.detail = detail
+
+
+class AdmissionController:
+    """Control de admisión de turnos de chat y llamadas al LLM.
+
+    - `user_turn(user_id)`: a lo sumo `max_per_user` turnos en curso por usuario.
+    - `check(user_id)`: el mismo límite y la cola llena, sin ocupar nada.
+    - `slot()`: a lo sumo `max_concurrency` llamadas al LLM a la vez; las demás
+      esperan en una cola FIFO de `max_queue` puestos durante `queue_timeout`
+      segundos como máximo.
+
+    Todo corre en el event loop, así que no hace falta un lock. Retry-After se
+    estima con la duración media (EWMA) de las llamadas.
+    """
+
+    def __init__(self, max_concurrency, max_queue, queue_timeout, max_per_user):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_per_user = max_per_user
+        self._active = 0
+        self._waiters = deque()
+        self._turns = {}
+        self._service_seconds = 2.0
+
+    def retry_after(self):
+        backlog = len(self._waiters) + 1
+        return max(1, math.ceil(self._service_seconds * backlog / max(1, self.max_concurrency)))
+
+    def _reject(self, status_code, reason, detail):
+        ADMISSION_REJECTIONS.inc(reason=reason)
+        return AdmissionRejected(status_code, reason, self.retry_after(), detail)
+
+    def _check_user(self, user_id):
+        if self._turns.get(user_id, 0) >= self.max_per_user:
+            raise self._reject(429, "user_in_flight", "Ya hay una solicitud en curso para este usuario")
+
+    def check(self, user_id):
+        """Rechazo temprano, antes de guardar el mensaje o abrir el stream."""
+        self._check_user(user_id)
+        if self._active >= self.max_concurrency and len(self._waiters) >= self.max_queue:
+            raise self._reject(503, "queue_full", "El servicio está saturado; reintenta más tarde")
+
+    @asynccontextmanager
+    async def user_turn(self, user_id):
+        self._check_user(user_id)
+        self._turns[user_id] = self._turns.get(user_id, 0) + 1
+        try:
+            yield
+        finally:
+            remaining = self._turns[user_id] - 1
+            if remaining:
+                self._turns[user_id] = remaining
+            else:
+                del self._turns[user_id]
+
+    async def _acquire(self):
+        if self._active < self.max_concurrency and not self._waiters:
+            self._active += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            raise self._reject(503, "queue_full", "El servicio está saturado; reintenta más tarde")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            # El slot se cede directamente al waiter (_active no cambia)
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                self._release()
+            else:
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.TimeoutError):
+                raise self._reject(503, "queue_timeout", "Tiempo de espera agotado en la cola del modelo") from None
+            raise
+
+    def _release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._active -= 1
+
+    @asynccontextmanager
+    async def slot(self):
+        with STAGE_LATENCY.time(stage="llm_queue"):
+            await self._acquire()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._service_seconds = 0.8 * self._service_seconds + 0.2 * (time.monotonic() - started)
+            self._release()
+
+    def stats(self):
+        return {
+            "active": self._active,
+            "waiting": len(self._waiters),
+            "users_in_flight": len(self._turns),
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "service_seconds_ewma": round(self._service_seconds, 3),
+        }
+
+
+llm_admission = AdmissionController(
+    max_concurrency=LLM_MAX_CONCURRENCY,
+    max_queue=LLM_MAX_QUEUE,
+    queue_timeout=LLM_QUEUE_TIMEOUT_SECONDS,
+    max_per_user=CHAT_MAX_INFLIGHT_PER_USER,
+)
@@ -0,0 +1,173 @@
+import csv
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from itertools import islice
+try:
+    from .firebase_service import get_repository, purchase_record
+except ImportError:
+    from infrastructure.firebase_service import get_repository, purchase_record
+
+
+logger = logging.getLogger("bulk_loader")
+
+# Límite de operaciones por batch de Firestore (también usado con SQLite)
+MAX_BATCH_SIZE = 500
+DEFAULT_WORKERS = 8
+DEFAULT_MAX_RETRIES = 5
+
+# Conversión de columnas numéricas al leer CSV
+CSV_FIELD_TYPES = {
+    "price": float,
+    "unit_price": float,
+    "total_amount": float,
+    "quantity": int,
+}
+
+
+class BulkStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.written = 0
+        self.skipped = 0
+        self.failed = 0
+        self.batches = 0
+        self.retries = 0
+
+    def add(self, **counts):
+        # Los reintentos se cuentan desde los hilos del pool y el resto desde
+        # el que reporta el progreso: toda suma pasa por el mismo lock
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    @property
+    def throughput(self):
+        return self.written / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        return (
+            f"written={self.written} skipped={self.skipped} failed={self.failed} "
+            f"batches={self.batches} retries={self.retries} "
+            f"elapsed={self.elapsed:.1f}s throughput={self.throughput:.0f} docs/s"
+        )
+
+
+def content_hash(record):
+    canonical = {k: v for k, v in record.items() if k != "content_hash"}
+    raw = json.dumps(canonical, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def read_records(path):
+    # Lectura en streaming: nunca se carga el archivo completo en memoria
+    if str(path).lower().endswith(".csv"):
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                yield {
+                    key: CSV_FIELD_TYPES[key](value) if key in CSV_FIELD_TYPES and value != "" else value
+                    for key, value in row.items()
+                }
+    else:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _chunks(records, size):
+    iterator = iter(records)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _commit_batch(collection, docs, id_field, max_retries, stats):
+    for attempt in range(max_retries + 1):
+        try:
+            get_repository().write_batch(collection, docs, id_field)
+            return len(docs)
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            stats.add(retries=1)
+            delay = min(30, 2 ** attempt) * random.uniform(0.5, 1.5)
+            logger.warning("Batch de %s falló (%s); reintento %s en %.1fs", collection, e, attempt + 1, delay)
+            time.sleep(delay)
+
+
+def bulk_write(
+    collection,
+    records,
+    id_field,
+    batch_size=MAX_BATCH_SIZE,
+    workers=DEFAULT_WORKERS,
+    max_retries=DEFAULT_MAX_RETRIES,
+    progress=None,
+    stats=None,
+):
+    # Commits de batches en paralelo con un máximo de batches en vuelo, de
+    # modo que la memoria no crece con el tamaño de la entrada.
+    stats = stats or BulkStats()
+    batch_size = min(max(1, batch_size), MAX_BATCH_SIZE)
+
+    def collect(done):
+        for future in done:
+            try:
+                stats.add(written=future.result(), batches=1)
+            except Exception as e:
+                stats.add(failed=future.batch_len, batches=1)
+                logger.error("Batch de %s descartado tras %s reintentos: %s", collection, max_retries, e)
+            if progress:
+                progress(stats)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bulk") as pool:
+        pending = set()
+        for chunk in _chunks(records, batch_size):
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            future = pool.submit(_commit_batch, collection, chunk, id_field, max_retries, stats)
+            future.batch_len = len(chunk)
+            pending.add(future)
+        collect(wait(pending).done)
+    return stats
+
+
+def load_products(records, **options):
+    stats = options.pop("stats", None) or BulkStats()
+    existing = get_repository().product_content_hashes()
+
+    def changed():
+        for product in records:
+            digest = content_hash(product)
+            if existing.get(product["product_id"]) == digest:
+                stats.add(skipped=1)
+                continue
+            yield {**product, "content_hash": digest}
+
+    return bulk_write("products", changed(), "product_id", stats=stats, **options)
+
+
+def load_purchase_orders(records, **options):
+    def prepared():
+        for order in records:
+            order = dict(order)
+            order.setdefault("id", str(uuid.uuid4()))
+            order.setdefault("purchase_date", datetime.now(timezone.utc).isoformat())
+            yield purchase_record(order)
+
+    return bulk_write("purchase_orders", prepared(), "id", **options)
@@ -0,0 +1,119 @@
+import copy
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+def _estimate_size(value):
+    return len(json.dumps(value, ensure_ascii=False, default=str))
+
+
+class LRUTTLCache:
+    """Caché LRU con TTL, límite de entradas y de memoria aproximada.
+
+    Cada entrada lleva etiquetas (p. ej. el usuario dueño de las órdenes) para
+    invalidar con precisión todo lo que una escritura afecta.
+    """
+
+    def __init__(self, ttl_seconds, max_entries, max_bytes):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._keys_by_tag = {}
+        self._bytes = 0
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get_or_load(self, key, tags, loader):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(entry[1])
+            if entry:
+                self._remove(key)
+            self.misses += 1
+            version = self._version
+
+        value = loader()
+        with self._lock:
+            # Si hubo una invalidación durante la lectura el valor puede estar viejo
+            if version == self._version:
+                self._store(key, value, tags)
+        return copy.deepcopy(value)
+
+    def get(self, key):
+        # None si no está o venció
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(entry[1])
+            if entry:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, value, tags=()):
+        with self._lock:
+            self._store(key, value, tags)
+
+    def invalidate(self, *tags):
+        with self._lock:
+            self._version += 1
+            for tag in tags:
+                for key in list(self._keys_by_tag.get(tag, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
+            self._keys_by_tag.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+    def _store(self, key, value, tags):
+        size = _estimate_size(value)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, copy.deepcopy(value), size, tags)
+        self._bytes += size
+        for tag in tags:
+            self._keys_by_tag.setdefault(tag, set()).add(key)
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, _, size, tags = self._entries.pop(key)
+        self._bytes -= size
+        for tag in tags:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
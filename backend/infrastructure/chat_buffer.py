@@ -0,0 +1,221 @@
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+try:
+    from .metrics import CHAT_BUFFER_FLUSH_SIZE, CHAT_BUFFER_MESSAGES
+except ImportError:
+    from infrastructure.metrics import CHAT_BUFFER_FLUSH_SIZE, CHAT_BUFFER_MESSAGES
+
+logger = logging.getLogger("chat_buffer")
+
+# Tope de un batch de Firestore
+MAX_BATCH_SIZE = 500
+
+
+def _now_us():
+    return time.time_ns() // 1000
+
+
+class ChatWriteBuffer:
+    """Buffer write-behind de mensajes de chat, agrupados por usuario.
+
+    `add` asigna `seq` y `created_at` y vuelve de inmediato; un hilo en segundo
+    plano escribe cada usuario en un solo batch cuando acumula `flush_size`
+    mensajes o su mensaje más antiguo lleva `flush_interval` segundos
+    esperando. `seq` son microsegundos desde epoch, estrictamente crecientes
+    por usuario, así que también ordena el historial y sirve de id del
+    documento (un reintento del batch no duplica mensajes).
+    """
+
+    def __init__(self, write, flush_size=20, flush_interval=0.2, max_pending=10000, retry_interval=1.0):
+        self._write = write
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.retry_interval = retry_interval
+        self._condition = threading.Condition()
+        # user_id -> deque[(enqueued_at, record)]
+        self._pending = {}
+        self._last_seq = {}
+        self._size = 0
+        # user_ids con un batch en vuelo: sus mensajes se leen desde aquí
+        self._in_flight = {}
+        self._retry_at = {}
+        self._thread = None
+        self._closed = False
+        self.flushed = 0
+        self.dropped = 0
+        self.failures = 0
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="chat-write-buffer", daemon=True)
+            self._thread.start()
+
+    def add(self, user_id, message):
+        with self._condition:
+            seq = max(_now_us(), self._last_seq.get(user_id, 0) + 1)
+            self._last_seq[user_id] = seq
+            record = {
+                **message,
+                "seq": seq,
+                "created_at": datetime.fromtimestamp(seq / 1_000_000, tz=timezone.utc),
+            }
+            closed = self._closed
+        if closed:
+            # Durante el apagado ya no hay hilo de fondo: escritura directa
+            self._write(user_id, [record])
+            return record
+        with self._condition:
+            if self._size >= self.max_pending:
+                # El request nunca espera: si la BD no da abasto se pierde lo más viejo
+                self._drop_oldest()
+            self._pending.setdefault(user_id, deque()).append((time.monotonic(), record))
+            self._size += 1
+            self._ensure_thread()
+            if len(self._pending[user_id]) >= self.flush_size:
+                self._condition.notify()
+            return record
+
+    def _drop_oldest(self):
+        user_id = min(self._pending, key=lambda uid: self._pending[uid][0][0])
+        self._pending[user_id].popleft()
+        if not self._pending[user_id]:
+            del self._pending[user_id]
+        self._size -= 1
+        self.dropped += 1
+        CHAT_BUFFER_MESSAGES.inc(outcome="dropped")
+        logger.error("Buffer de chat lleno (%s); se descartó un mensaje de %s", self.max_pending, user_id)
+
+    def pending(self, user_id):
+        """Mensajes aún no persistidos del usuario (en vuelo incluidos), por seq."""
+        with self._condition:
+            records = list(self._in_flight.get(user_id, ()))
+            records.extend(record for _, record in self._pending.get(user_id, ()))
+            return [dict(record) for record in records]
+
+    def discard(self, user_id, timeout=10.0):
+        # Descarta lo pendiente y espera el batch en vuelo, para que no
+        # reaparezca un mensaje después de borrar el historial.
+        with self._condition:
+            removed = self._pending.pop(user_id, None)
+            if removed:
+                self._size -= len(removed)
+            self._retry_at.pop(user_id, None)
+            self._condition.wait_for(lambda: user_id not in self._in_flight, timeout)
+            return len(removed or ())
+
+    def _due(self, now, force):
+        # Usuarios listos para escribir y segundos hasta el próximo vencimiento
+        due, wait = [], self.flush_interval
+        for user_id, queue in self._pending.items():
+            if user_id in self._in_flight:
+                continue
+            retry_at = self._retry_at.get(user_id, 0)
+            if not force and retry_at > now:
+                wait = min(wait, retry_at - now)
+                continue
+            age = now - queue[0][0]
+            if force or len(queue) >= self.flush_size or age >= self.flush_interval:
+                due.append(user_id)
+            else:
+                wait = min(wait, self.flush_interval - age)
+        return due, max(wait, 0.001)
+
+    def _take(self, user_id):
+        queue = self._pending[user_id]
+        batch = [queue.popleft()[1] for _ in range(min(len(queue), MAX_BATCH_SIZE))]
+        if not queue:
+            del self._pending[user_id]
+        self._size -= len(batch)
+        self._in_flight[user_id] = batch
+        return batch
+
+    def _flush_user(self, user_id, batch):
+        try:
+            self._write(user_id, batch)
+        except Exception as e:
+            with self._condition:
+                # Vuelve al frente de la cola con su orden original
+                queue = self._pending.setdefault(user_id, deque())
+                queue.extendleft((time.monotonic(), record) for record in reversed(batch))
+                self._size += len(batch)
+                self._in_flight.pop(user_id, None)
+                self._retry_at[user_id] = time.monotonic() + self.retry_interval
+                self.failures += 1
+            CHAT_BUFFER_MESSAGES.inc(len(batch), outcome="retried")
+            logger.error("No se pudo persistir el chat de %s (%s mensajes): %s", user_id, len(batch), e)
+            return False
+        with self._condition:
+            self._in_flight.pop(user_id, None)
+            self._retry_at.pop(user_id, None)
+            self.flushed += len(batch)
+            if user_id not in self._pending and self._last_seq.get(user_id, 0) < _now_us():
+                # La hora ya supera al último seq; no hace falta recordarlo
+                self._last_seq.pop(user_id, None)
+            self._condition.notify_all()
+        CHAT_BUFFER_FLUSH_SIZE.observe(len(batch))
+        CHAT_BUFFER_MESSAGES.inc(len(batch), outcome="persisted")
+        return True
+
+    def _flush_due(self, force=False):
+        with self._condition:
+            due, wait = self._due(time.monotonic(), force)
+            batches = [(user_id, self._take(user_id)) for user_id in due]
+        failed = sum(not self._flush_user(user_id, batch) for user_id, batch in batches)
+        return wait, len(batches), failed
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._closed:
+                    return
+            wait, _, _ = self._flush_due()
+            with self._condition:
+                if not self._closed:
+                    self._condition.wait(wait)
+
+    def flush(self, timeout=10.0):
+        """Escribe todo lo pendiente; devuelve True si el buffer quedó vacío."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._condition:
+                if not self._size and not self._in_flight:
+                    return True
+            _, taken, failed = self._flush_due(force=True)
+            if not taken:
+                # Solo quedan batches en vuelo del hilo de fondo
+                with self._condition:
+                    self._condition.wait(0.05)
+            elif failed:
+                time.sleep(min(self.retry_interval, max(0.0, deadline - time.monotonic())))
+        with self._condition:
+            return not self._size and not self._in_flight
+
+    def close(self, timeout=10.0):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join(timeout)
+        flushed = self.flush(timeout)
+        if not flushed:
+            logger.error("Se cerró el buffer de chat con %s mensajes sin persistir", self._size)
+        return flushed
+
+    def stats(self):
+        now = time.monotonic()
+        with self._condition:
+            oldest = min((queue[0][0] for queue in self._pending.values()), default=now)
+            return {
+                "depth": self._size,
+                "users": len(self._pending),
+                "in_flight": sum(len(batch) for batch in self._in_flight.values()),
+                "oldest_age_seconds": round(now - oldest, 3),
+                "flushed": self.flushed,
+                "dropped": self.dropped,
+                "failures": self.failures,
+            }
@@ -1,149 +1,726 @@
 
-from dotenv import load_dotenv
-import firebase_admin
-from firebase_admin import credentials, firestore
+import asyncio
+import base64
+import contextvars
+import json
+import logging
 import os
-from pathlib import Path
-
-load_dotenv()
-
-# Usar la variable de entorno FIREBASE_KEY_PATH definida en .env
-raw_cred_path = os.getenv("FIREBASE_KEY_PATH", "firebase_key.json")
-
-
-def _resolve_cred_path(path_value):
-    candidate = Path(path_value)
-    if candidate.is_absolute() and candidate.exists():
-        return str(candidate)
-
-    backend_dir = Path(__file__).resolve().parents[1]
-    search_paths = [
-        Path.cwd() / path_value,
-        backend_dir / path_value,
-        backend_dir.parent / path_value,
-    ]
-    for path in search_paths:
-        if path.exists():
-            return str(path)
-    return path_value
-
-
-cred_path = _resolve_cred_path(raw_cred_path)
-
-if not firebase_admin._apps:
-    cred = credentials.Certificate(cred_path)
-    firebase_admin.initialize_app(cred)
-
-db = firestore.client()
-
-
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import partial, wraps
+try:
+    from .cache import LRUTTLCache
+    from .chat_buffer import ChatWriteBuffer
+    from .metrics import db_operation, record_documents_read
+    from .product_catalog import ProductCatalogIndex
+    from .repository import PURCHASE_TS_FIELD
+    from .settings import load_env
+    from .spend_rollups import ALL_PRODUCTS, ROLLUPS_PER_ORDER, merge_deltas, rollup_deltas, rollup_id, summary_periods
+except ImportError:
+    from infrastructure.cache import LRUTTLCache
+    from infrastructure.chat_buffer import ChatWriteBuffer
+    from infrastructure.metrics import db_operation, record_documents_read
+    from infrastructure.product_catalog import ProductCatalogIndex
+    from infrastructure.repository import PURCHASE_TS_FIELD
+    from infrastructure.settings import load_env
+    from infrastructure.spend_rollups import ALL_PRODUCTS, ROLLUPS_PER_ORDER, merge_deltas, rollup_deltas, rollup_id, summary_periods
+
+load_env()
+
+# Backend de persistencia: "firestore" (por defecto), "sqlite" o "memory"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "firestore").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "hitl_agent.db")
+
+logger = logging.getLogger("firebase_service")
+
+# Segundos máximos esperando el snapshot inicial del catálogo
+CATALOG_READY_TIMEOUT = float(os.getenv("CATALOG_READY_TIMEOUT", "30"))
+
+_repository = None
+_repository_lock = threading.Lock()
+
+_catalog = ProductCatalogIndex()
+# Matriz TF-IDF (numpy); se crea con la primera búsqueda difusa o el warm-up
+_matcher = None
+_catalog_watch = None
+_catalog_lock = threading.Lock()
+
+
+def create_repository(backend=None):
+    backend = (backend or STORAGE_BACKEND).lower()
+    if backend == "firestore":
+        try:
+            from .firestore_repository import FirestoreRepository
+        except ImportError:
+            from infrastructure.firestore_repository import FirestoreRepository
+        return FirestoreRepository()
+    if backend in ("sqlite", "memory"):
+        try:
+            from .sqlite_repository import SQLiteRepository
+        except ImportError:
+            from infrastructure.sqlite_repository import SQLiteRepository
+        return SQLiteRepository(":memory:" if backend == "memory" else SQLITE_PATH)
+    raise ValueError(f"STORAGE_BACKEND no soportado: {backend}")
+
+
+def get_repository():
+    global _repository
+    if _repository is None:
+        with _repository_lock:
+            if _repository is None:
+                _repository = create_repository()
+                logger.info("Backend de persistencia: %s", type(_repository).__name__)
+    return _repository
+
+
+def set_repository(repository):
+    # Cambia el backend en caliente (CI, benchmarks); descarta índice y caché
+    global _repository, _catalog, _matcher
+    stop_product_catalog()
+    with _repository_lock:
+        previous, _repository = _repository, repository
+    with _catalog_lock:
+        _catalog = ProductCatalogIndex()
+        _matcher = None
+    _purchase_order_cache.clear()
+    if previous is not None and previous is not repository:
+        close_chat_buffer()
+        previous.close()
+    return repository
+
+
+def _on_product_changes(upserts, removed_ids):
+    record_documents_read("product_catalog_snapshot", len(upserts) + len(removed_ids))
+    for product_id in removed_ids:
+        _catalog.remove(product_id)
+    for product in upserts:
+        _catalog.upsert(product)
+    _catalog.mark_ready()
+
+
+def start_product_catalog(timeout=CATALOG_READY_TIMEOUT):
+    global _catalog_watch
+    with _catalog_lock:
+        if _catalog_watch is None:
+            repository = get_repository()
+            _catalog_watch = repository.watch_products(_on_product_changes)
+            if not _catalog.wait_ready(timeout):
+                logger.warning("Snapshot inicial del catálogo no llegó; cargando el catálogo completo")
+                _catalog.load(repository.list_products(None))
+            logger.info("Catálogo de productos indexado: %s productos", len(_catalog))
+    return _catalog
+
+
+def stop_product_catalog():
+    global _catalog_watch
+    with _catalog_lock:
+        if _catalog_watch is not None:
+            _catalog_watch()
+            _catalog_watch = None
+
+
+def get_product_catalog():
+    if _catalog_watch is None:
+        start_product_catalog()
+    return _catalog
+
+
+def _get_matcher():
+    global _matcher
+    with _catalog_lock:
+        if _matcher is None:
+            try:
+                from .product_matcher import ProductMatcher
+            except ImportError:
+                from infrastructure.product_matcher import ProductMatcher
+            _matcher = ProductMatcher(_catalog)
+        return _matcher
+
+
+def product_catalog_status():
+    return {"ready": _catalog_watch is not None and _catalog.ready, "products": len(_catalog)}
+
+
+def warm_up_storage():
+    # Paso explícito de arranque: abre el backend, precarga el catálogo y
+    # construye la matriz de búsqueda difusa antes del primer request.
+    get_repository()
+    start_product_catalog()
+    _get_matcher().search("warm-up", k=1)
+    return product_catalog_status()
+
+
+def shutdown_storage():
+    global _repository
+    stop_product_catalog()
+    # Primero el chat pendiente, mientras el backend sigue abierto
+    close_chat_buffer()
+    with _repository_lock:
+        repository, _repository = _repository, None
+    if repository is not None:
+        repository.close()
+
+
+@db_operation
 def save_product(product):
-    db.collection("products").document(product["product_id"]).set(product)
+    get_repository().save_product(product)
+    if _catalog.ready:
+        _catalog.upsert(product)
     return product
 
 
+@db_operation
 def get_product_by_id(product_id):
     if not product_id:
         return None
-    doc = db.collection("products").document(product_id).get()
-    if not doc.exists:
-        return None
-    product = doc.to_dict()
-    if "product_id" not in product:
-        product["product_id"] = doc.id
+    product = get_product_catalog().get_by_id(product_id)
+    if product:
+        return product
+    # Puede haberse creado y aún no llegar por el listener
+    product = get_repository().get_product(product_id)
+    record_documents_read("get_product_by_id", 1)
     return product
 
+
+@db_operation
 def get_product_by_detail(detail):
     if not detail:
         return None
+    return get_product_catalog().get_by_detail(detail)
 
-    detail_clean = str(detail).strip().lower()
-    if not detail_clean:
-        return None
 
-    docs = db.collection("products").stream()
-    exact_match = None
-    partial_matches = []
+@db_operation
+def search_products(detail, k=5, min_score=0.0):
+    # Candidatos rankeados por similitud TF-IDF de n-gramas: [{product, score}]
+    if not detail:
+        return []
+    get_product_catalog()
+    return _get_matcher().search(detail, k=k, min_score=min_score)
 
-    for d in docs:
-        product = d.to_dict()
-        if "product_id" not in product:
-            product["product_id"] = d.id
 
-        product_detail = str(product.get("detail", "")).strip().lower()
-        if product_detail == detail_clean:
-            exact_match = product
-            break
-        if detail_clean in product_detail:
-            partial_matches.append(product)
+@db_operation
+def list_products(limit=100):
+    products = get_repository().list_products(limit)
+    record_documents_read("list_products", max(1, len(products)))
+    return products
 
-    if exact_match:
-        return exact_match
-    if len(partial_matches) == 1:
-        return partial_matches[0]
-    return None
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
 
 
-def list_products(limit=100):
-    docs = db.collection("products").limit(limit).stream()
-    products = []
-    for d in docs:
-        product = d.to_dict()
-        if "product_id" not in product:
-            product["product_id"] = d.id
-        products.append(product)
-    return products
+class InvalidCursorError(ValueError):
+    pass
 
-def save_purchase(order):
-    db.collection("purchase_orders").document(order["id"]).set(order)
-    return order
 
-def list_purchase_orders(user_id=None, date=None, status=None, limit=20):
-    docs = db.collection("purchase_orders").stream()
-    orders = []
+def _parse_datetime(value):
+    if isinstance(value, datetime):
+        parsed = value
+    else:
+        parsed = datetime.fromisoformat(str(value).strip().replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
 
-    for d in docs:
-        order = d.to_dict()
-        if "id" not in order:
-            order["id"] = d.id
 
-        if user_id and order.get("user_id") != user_id:
-            continue
-        if status and order.get("status") != status:
-            continue
-        if date and not str(order.get("purchase_date", "")).startswith(date):
-            continue
+def _date_range(date=None, date_from=None, date_to=None):
+    # `date` (YYYY-MM-DD) equivale al rango [día, día + 1)
+    start = end = None
+    if date:
+        start = _parse_datetime(str(date)[:10])
+        end = start + timedelta(days=1)
+    if date_from:
+        start = _parse_datetime(date_from)
+    if date_to:
+        end = _parse_datetime(date_to)
+        if len(str(date_to).strip()) == 10:
+            end += timedelta(days=1)
+    return start, end
 
-        orders.append(order)
 
-    orders.sort(key=lambda o: str(o.get("purchase_date", "")), reverse=True)
+def _page_size(limit):
     try:
         limit_value = int(limit)
     except (TypeError, ValueError):
-        limit_value = 20
-    return orders[: max(1, limit_value)]
+        limit_value = DEFAULT_PAGE_SIZE
+    return min(max(1, limit_value), MAX_PAGE_SIZE)
+
+
+def _encode_cursor(purchase_ts, order_id):
+    raw = json.dumps({"ts": purchase_ts.isoformat(), "id": order_id})
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_cursor(token):
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+        return _parse_datetime(raw["ts"]), str(raw["id"])
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        raise InvalidCursorError(f"Cursor inválido: {token}") from e
+
+
+def _order_from_record(record):
+    order = dict(record)
+    order.pop(PURCHASE_TS_FIELD, None)
+    order.pop("update_time", None)
+    return order
+
 
+# Caché read-through de consultas de purchase_orders
+PURCHASE_ORDER_CACHE_TTL_SECONDS = float(os.getenv("PURCHASE_ORDER_CACHE_TTL_SECONDS", "30"))
+PURCHASE_ORDER_CACHE_MAX_ENTRIES = int(os.getenv("PURCHASE_ORDER_CACHE_MAX_ENTRIES", "2048"))
+PURCHASE_ORDER_CACHE_MAX_BYTES = int(os.getenv("PURCHASE_ORDER_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+_purchase_order_cache = LRUTTLCache(
+    ttl_seconds=PURCHASE_ORDER_CACHE_TTL_SECONDS,
+    max_entries=PURCHASE_ORDER_CACHE_MAX_ENTRIES,
+    max_bytes=PURCHASE_ORDER_CACHE_MAX_BYTES,
+)
+
+
+def _user_tag(user_id):
+    return ("user", user_id or None)
+
+
+def _order_tag(order_id):
+    return ("order", order_id)
+
+
+def invalidate_purchase_orders(*orders):
+    # Una escritura afecta los listados de su usuario, los listados sin
+    # filtro de usuario y la lectura por id de la propia orden.
+    tags = {_user_tag(None)}
+    for order in orders:
+        tags.add(_user_tag(order.get("user_id")))
+        tags.add(_order_tag(order.get("id")))
+    _purchase_order_cache.invalidate(*tags)
+
+
+def purchase_order_cache_stats():
+    return _purchase_order_cache.stats()
+
+
+def purchase_record(order):
+    # Documento a persistir: la orden pública más su timestamp nativo
+    record = dict(order)
+    if order.get("purchase_date"):
+        record[PURCHASE_TS_FIELD] = _parse_datetime(order["purchase_date"])
+    return record
+
+
+@db_operation
+def save_purchase(order):
+    record = purchase_record(order)
+    get_repository().save_purchase_order(record, rollups=rollup_deltas(record))
+    invalidate_purchase_orders(order)
+    return order
+
+
+def _fetch_purchase_orders(user_id, status, start, end, page_size, cursor):
+    after = _decode_cursor(cursor) if cursor else None
+    records = get_repository().query_purchase_orders(user_id, status, start, end, page_size + 1, after)
+    record_documents_read("query_purchase_orders", max(1, len(records)))
+    next_cursor = None
+    if len(records) > page_size:
+        records = records[:page_size]
+        last = records[-1]
+        next_cursor = _encode_cursor(last[PURCHASE_TS_FIELD], last["id"])
+
+    return {
+        "orders": [_order_from_record(r) for r in records],
+        "next_cursor": next_cursor,
+    }
+
+
+@db_operation
+def query_purchase_orders(
+    user_id=None,
+    date=None,
+    status=None,
+    limit=DEFAULT_PAGE_SIZE,
+    cursor=None,
+    date_from=None,
+    date_to=None,
+):
+    # Filtros, orden y límite se resuelven con índices del backend (ver
+    # firestore.indexes.json y sqlite_repository), así las lecturas escalan con
+    # el tamaño de página y no con la colección.
+    page_size = _page_size(limit)
+    start, end = _date_range(date, date_from, date_to)
+    if cursor:
+        _decode_cursor(cursor)
+    key = ("orders", user_id or None, status or None, start, end, page_size, cursor or None)
+    return _purchase_order_cache.get_or_load(
+        key,
+        (_user_tag(user_id),),
+        lambda: _fetch_purchase_orders(user_id, status, start, end, page_size, cursor),
+    )
+
+
+@db_operation
+def list_purchase_orders(user_id=None, date=None, status=None, limit=DEFAULT_PAGE_SIZE, cursor=None):
+    return query_purchase_orders(
+        user_id=user_id,
+        date=date,
+        status=status,
+        limit=limit,
+        cursor=cursor,
+    )["orders"]
+
+# Exportación masiva: páginas grandes y sin caché (cada página se lee una vez)
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "500"))
+
+
+@db_operation
+def _fetch_export_page(user_id, status, start, end, page_size, after):
+    records = get_repository().query_purchase_orders(user_id, status, start, end, page_size, after)
+    record_documents_read("export_purchase_orders", max(1, len(records)))
+    return records
+
+
+def export_purchase_orders_async(user_id=None, status=None, date=None, date_from=None, date_to=None,
+                                 page_size=EXPORT_PAGE_SIZE):
+    """Itera todas las órdenes del filtro, página a página, como listas de órdenes.
+
+    Valida las fechas de inmediato (ValueError) y después recorre el índice con
+    un cursor por (purchase_ts, id): en memoria hay a lo sumo una página.
+    """
+    start, end = _date_range(date, date_from, date_to)
+    return _export_pages(user_id or None, status or None, start, end, max(1, page_size))
+
+
+async def _export_pages(user_id, status, start, end, page_size):
+    after = None
+    while True:
+        records = await run_in_db_pool(_fetch_export_page, user_id, status, start, end, page_size, after)
+        if records:
+            yield [_order_from_record(r) for r in records]
+        if len(records) < page_size:
+            return
+        after = (records[-1][PURCHASE_TS_FIELD], records[-1]["id"])
+
+
+def _fetch_purchase_order(order_id):
+    record = get_repository().get_purchase_order(order_id)
+    record_documents_read("get_purchase_order_by_id", 1)
+    return _order_from_record(record) if record else None
+
+
+@db_operation
 def get_purchase_order_by_id(order_id):
     if not order_id:
         return None
-    doc = db.collection("purchase_orders").document(order_id).get()
-    if not doc.exists:
+    return _purchase_order_cache.get_or_load(
+        ("order", order_id),
+        (_order_tag(order_id),),
+        lambda: _fetch_purchase_order(order_id),
+    )
+
+@db_operation
+def get_purchase_orders_by_ids(order_ids):
+    # Lectura en lote (un round trip) de las órdenes que existen, en el orden pedido
+    order_ids = list(dict.fromkeys(order_ids))
+    if not order_ids:
+        return []
+    records = {r["id"]: r for r in get_repository().get_purchase_orders(order_ids)}
+    record_documents_read("get_purchase_orders_by_ids", max(1, len(records)))
+    return [_order_from_record(records[order_id]) for order_id in order_ids if order_id in records]
+
+
+@db_operation
+def get_purchase_order_snapshot(order_id):
+    # Lectura fresca (sin caché) con `update_time`, para borrar con precondición
+    if not order_id:
+        return None
+    record = get_repository().get_purchase_order(order_id)
+    record_documents_read("get_purchase_order_snapshot", 1)
+    if not record:
         return None
-    order = doc.to_dict()
-    if "id" not in order:
-        order["id"] = doc.id
+    order = _order_from_record(record)
+    order["update_time"] = record.get("update_time")
     return order
 
-def delete_purchase_order(order_id):
-    order = get_purchase_order_by_id(order_id)
-    if not order:
-        return None
-    db.collection("purchase_orders").document(order_id).delete()
+
+@db_operation
+def delete_purchase_order(snapshot):
+    """Borra la orden leída con get_purchase_order_snapshot en un solo commit.
+
+    No la vuelve a leer: la precondición sobre su `update_time` (o su
+    existencia) hace fallar el borrado con PurchaseOrderConflictError si
+    cambió o la borró otro request, y los agregados no se descuentan dos veces.
+    """
+    order = _order_from_record(snapshot)
+    try:
+        get_repository().delete_purchase_order(
+            order["id"],
+            rollups=rollup_deltas(purchase_record(order), sign=-1),
+            update_time=snapshot.get("update_time"),
+        )
+    finally:
+        invalidate_purchase_orders(order)
     return order
 
-def save_chat(user_id, message):
-    db.collection("sessions").document(user_id).collection("messages").add(message)
+# Vigencia de una aprobación pendiente (ver ttl en firestore.indexes.json)
+APPROVAL_TTL_SECONDS = int(os.getenv("APPROVAL_TTL_SECONDS", "900"))
+# Escrituras que admite un batch de Firestore
+FIRESTORE_BATCH_WRITES = 500
+# Órdenes por aprobación en lote: las órdenes, sus agregados de gasto (hasta
+# ROLLUPS_PER_ORDER por orden si son de días o productos distintos) y el ticket
+# van en un único batch, así que el tope garantiza que el peor caso entra
+BATCH_MAX_ITEMS = min(
+    int(os.getenv("BATCH_MAX_ITEMS", "99")),
+    (FIRESTORE_BATCH_WRITES - 1) // (1 + ROLLUPS_PER_ORDER),
+)
+
+
+@db_operation
+def create_approval_ticket(user_id, payload, approval):
+    # Guarda lo que run_agent ya resolvió (producto, precios, registro objetivo)
+    # para que /execute no tenga que volver a consultarlo.
+    now = datetime.now(timezone.utc)
+    ticket = {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "action": payload.get("action"),
+        "payload": payload,
+        "record": approval.get("record"),
+        "created_at": now,
+        "expires_at": now + timedelta(seconds=APPROVAL_TTL_SECONDS),
+    }
+    get_repository().save_approval_ticket(ticket)
+    return ticket
+
+
+@db_operation
+def get_approval_ticket(ticket_id):
+    if not ticket_id:
+        return None
+    ticket = get_repository().get_approval_ticket(ticket_id)
+    record_documents_read("get_approval_ticket", 1)
+    if not ticket or ticket["expires_at"] <= datetime.now(timezone.utc):
+        return None
+    return ticket
+
+
+@db_operation
+def commit_approval_ticket(ticket, save_orders=(), delete_orders=()):
+    # Un único commit: la escritura de las órdenes, sus agregados de gasto y el
+    # consumo del ticket. La precondición sobre el ticket evita ejecutar dos
+    # veces la misma aprobación. `delete_orders` son las órdenes completas
+    # guardadas en el ticket, para descontarlas de los agregados.
+    if len(save_orders) + len(delete_orders) > BATCH_MAX_ITEMS:
+        raise ValueError(f"Un ticket admite como máximo {BATCH_MAX_ITEMS} órdenes")
+    save_records = [purchase_record(order) for order in save_orders]
+    delete_records = [purchase_record(order) for order in delete_orders]
+    deltas = [delta for record in save_records for delta in rollup_deltas(record)]
+    deltas += [delta for record in delete_records for delta in rollup_deltas(record, sign=-1)]
+    rollups = merge_deltas(deltas)
+    writes = len(save_records) + len(delete_records) + len(rollups) + 1
+    if writes > FIRESTORE_BATCH_WRITES:
+        raise ValueError(
+            f"El ticket requiere {writes} escrituras (órdenes, agregados y ticket); "
+            f"un batch admite {FIRESTORE_BATCH_WRITES}"
+        )
+    try:
+        get_repository().commit_approval_ticket(
+            ticket,
+            save_orders=save_records,
+            delete_order_ids=[record["id"] for record in delete_records],
+            rollups=rollups,
+        )
+    finally:
+        invalidate_purchase_orders(*save_orders, *delete_orders)
+
+
+def _summary_periods(date=None, month=None, date_from=None, date_to=None):
+    # Sin filtros: el mes en curso (UTC)
+    if date:
+        day = _parse_datetime(str(date)[:10]).date()
+        return summary_periods(day, day), day, day
+    if date_from or date_to:
+        start = _parse_datetime(str(date_from or date_to)[:10]).date()
+        end = _parse_datetime(str(date_to or date_from)[:10]).date()
+        return summary_periods(start, end), start, end
+    if month:
+        start = _parse_datetime(f"{str(month)[:7]}-01").date()
+    else:
+        start = datetime.now(timezone.utc).date().replace(day=1)
+    end = (start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    return summary_periods(start, end), start, end
+
+
+@db_operation
+def get_spend_summary(user_id, product_id=None, date=None, month=None, date_from=None, date_to=None):
+    # Gasto desde los agregados materializados: una lectura en lote de a lo
+    # sumo un documento por mes completo o día suelto del rango, sin importar
+    # cuántas órdenes haya.
+    periods, start, end = _summary_periods(date, month, date_from, date_to)
+    ids = [rollup_id(user_id, product_id, period) for _, period in periods]
+    rollups = get_repository().get_spend_rollups(ids)
+    record_documents_read("get_spend_summary", max(1, len(rollups)))
+    breakdown = []
+    for (granularity, period), rollup_key in zip(periods, ids):
+        rollup = rollups.get(rollup_key)
+        if rollup and rollup.get("count"):
+            breakdown.append({
+                "granularity": granularity,
+                "period": period,
+                "count": int(rollup["count"]),
+                "total_amount": round(float(rollup.get("total_amount") or 0), 2),
+            })
+    return {
+        "user_id": user_id,
+        "product_id": product_id or ALL_PRODUCTS,
+        "date_from": start.isoformat(),
+        "date_to": end.isoformat(),
+        "count": sum(item["count"] for item in breakdown),
+        "total_amount": round(sum(item["total_amount"] for item in breakdown), 2),
+        "breakdown": breakdown,
+    }
+
+
+CHAT_HISTORY_LIMIT = int(os.getenv("CHAT_HISTORY_LIMIT", "50"))
+
+
+def _message_from_record(record):
+    message = dict(record)
+    for field in ("created_at", "persisted_at"):
+        if isinstance(message.get(field), datetime):
+            message[field] = message[field].isoformat()
+    return message
+
+
+# Write-behind del chat: se escribe por usuario en batches al juntar
+# CHAT_FLUSH_SIZE mensajes o a los CHAT_FLUSH_INTERVAL_MS del más antiguo.
+# Una caída del proceso puede perder hasta ese intervalo de mensajes.
+CHAT_FLUSH_SIZE = int(os.getenv("CHAT_FLUSH_SIZE", "20"))
+CHAT_FLUSH_INTERVAL_MS = int(os.getenv("CHAT_FLUSH_INTERVAL_MS", "200"))
+CHAT_BUFFER_MAX_PENDING = int(os.getenv("CHAT_BUFFER_MAX_PENDING", "10000"))
+
+_chat_buffer = None
+_chat_buffer_lock = threading.Lock()
+
+
+@db_operation
+def _write_chat_messages(user_id, records):
+    get_repository().add_chat_messages(user_id, records)
+
+
+def get_chat_buffer():
+    global _chat_buffer
+    if _chat_buffer is None:
+        with _chat_buffer_lock:
+            if _chat_buffer is None:
+                _chat_buffer = ChatWriteBuffer(
+                    _write_chat_messages,
+                    flush_size=CHAT_FLUSH_SIZE,
+                    flush_interval=CHAT_FLUSH_INTERVAL_MS / 1000,
+                    max_pending=CHAT_BUFFER_MAX_PENDING,
+                )
+    return _chat_buffer
+
+
+def flush_chat_buffer(timeout=10.0):
+    return _chat_buffer.flush(timeout) if _chat_buffer is not None else True
+
+
+def close_chat_buffer(timeout=10.0):
+    global _chat_buffer
+    with _chat_buffer_lock:
+        buffer, _chat_buffer = _chat_buffer, None
+    return buffer.close(timeout) if buffer is not None else True
+
+
+def chat_buffer_stats():
+    if _chat_buffer is None:
+        return {"depth": 0, "users": 0, "in_flight": 0, "oldest_age_seconds": 0}
+    return _chat_buffer.stats()
+
 
-def get_chat_history(user_id):
-    docs = db.collection("sessions").document(user_id).collection("messages").stream()
-    return [d.to_dict() for d in docs]
+def save_chat(user_id, message):
+    # No bloquea: el mensaje queda en el buffer y se persiste en segundo plano
+    return get_chat_buffer().add(user_id, message)
+
+
+@db_operation
+def get_chat_history(user_id, limit=CHAT_HISTORY_LIMIT, before=None):
+    # Devuelve los `limit` mensajes más recientes (anteriores a `before`) en
+    # orden cronológico; `before` es el created_at del mensaje más antiguo ya leído.
+    # Incluye los mensajes del buffer que todavía no llegaron a la BD.
+    limit = max(1, int(limit))
+    before = _parse_datetime(before) if before else None
+    buffered = _chat_buffer.pending(user_id) if _chat_buffer is not None else []
+    pending = [record for record in buffered if before is None or record["created_at"] < before]
+    records = get_repository().get_chat_messages(user_id, limit, before) if len(pending) < limit else []
+    record_documents_read("get_chat_history", max(1, len(records)))
+    # Un batch recién escrito puede aparecer en ambas fuentes
+    pending_seqs = {record["seq"] for record in pending}
+    stored = [r for r in reversed(records) if r.get("seq") not in pending_seqs]
+    return [_message_from_record(r) for r in (stored + pending)[-limit:]]
+
+
+@db_operation
+def clear_chat_history(user_id):
+    discarded = _chat_buffer.discard(user_id) if _chat_buffer is not None else 0
+    deleted = get_repository().clear_chat_messages(user_id)
+    record_documents_read("clear_chat_history", max(1, deleted))
+    return deleted + discarded
+
+
+# Los backends son bloqueantes: las versiones async delegan en un pool
+# acotado para no detener el event loop de uvicorn.
+FIRESTORE_MAX_WORKERS = int(os.getenv("FIRESTORE_MAX_WORKERS", "32"))
+_db_executor = ThreadPoolExecutor(max_workers=FIRESTORE_MAX_WORKERS, thread_name_prefix="firestore")
+
+
+async def run_in_db_pool(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # Se copia el contexto para que las métricas por request sigan al hilo
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_db_executor, partial(context.run, func, *args, **kwargs))
+
+
+def _async_version(func):
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_in_db_pool(func, *args, **kwargs)
+    wrapper.__name__ = f"{func.__name__}_async"
+    return wrapper
+
+
+save_product_async = _async_version(save_product)
+get_product_by_id_async = _async_version(get_product_by_id)
+save_purchase_async = _async_version(save_purchase)
+query_purchase_orders_async = _async_version(query_purchase_orders)
+list_purchase_orders_async = _async_version(list_purchase_orders)
+get_purchase_order_by_id_async = _async_version(get_purchase_order_by_id)
+get_purchase_orders_by_ids_async = _async_version(get_purchase_orders_by_ids)
+get_purchase_order_snapshot_async = _async_version(get_purchase_order_snapshot)
+delete_purchase_order_async = _async_version(delete_purchase_order)
+get_chat_history_async = _async_version(get_chat_history)
+clear_chat_history_async = _async_version(clear_chat_history)
+create_approval_ticket_async = _async_version(create_approval_ticket)
+get_approval_ticket_async = _async_version(get_approval_ticket)
+commit_approval_ticket_async = _async_version(commit_approval_ticket)
+get_spend_summary_async = _async_version(get_spend_summary)
+
+
+def _catalog_ready():
+    return _catalog_watch is not None and _catalog.ready
+
+
+async def get_product_by_detail_async(detail):
+    # Con el catálogo cargado es una búsqueda en memoria; la carga perezosa
+    # (hasta CATALOG_READY_TIMEOUT) va al pool para no bloquear el event loop
+    if _catalog_ready():
+        return get_product_by_detail(detail)
+    return await run_in_db_pool(get_product_by_detail, detail)
+
+
+async def search_products_async(detail, k=5, min_score=0.0):
+    # Igual, y además la primera construcción de la matriz TF-IDF (segundos
+    # con catálogos grandes) corre en el pool; las siguientes son en segundo plano
+    if _catalog_ready() and _matcher is not None and _matcher.ready:
+        return search_products(detail, k=k, min_score=min_score)
+    return await run_in_db_pool(search_products, detail, k=k, min_score=min_score)
@@ -0,0 +1,323 @@
+import os
+import threading
+from functools import wraps
+from pathlib import Path
+
+import firebase_admin
+from firebase_admin import credentials, firestore
+from google.api_core import exceptions as google_exceptions
+try:
+    from .metrics import record_round_trips
+    from .repository import (
+        PURCHASE_TS_FIELD,
+        ApprovalTicketConflictError,
+        PurchaseOrderConflictError,
+        StorageRepository,
+    )
+except ImportError:
+    from infrastructure.metrics import record_round_trips
+    from infrastructure.repository import (
+        PURCHASE_TS_FIELD,
+        ApprovalTicketConflictError,
+        PurchaseOrderConflictError,
+        StorageRepository,
+    )
+
+_client_lock = threading.Lock()
+
+# Errores de Firestore cuando falla una precondición (exists / update_time)
+_PRECONDITION_ERRORS = (
+    google_exceptions.FailedPrecondition,
+    google_exceptions.NotFound,
+    google_exceptions.AlreadyExists,
+)
+
+
+def _resolve_cred_path(path_value):
+    candidate = Path(path_value)
+    if candidate.is_absolute() and candidate.exists():
+        return str(candidate)
+
+    backend_dir = Path(__file__).resolve().parents[1]
+    search_paths = [
+        Path.cwd() / path_value,
+        backend_dir / path_value,
+        backend_dir.parent / path_value,
+    ]
+    for path in search_paths:
+        if path.exists():
+            return str(path)
+    return path_value
+
+
+def firestore_client():
+    # Usar la variable de entorno FIREBASE_KEY_PATH definida en .env
+    with _client_lock:
+        if not firebase_admin._apps:
+            cred_path = _resolve_cred_path(os.getenv("FIREBASE_KEY_PATH", "firebase_key.json"))
+            firebase_admin.initialize_app(credentials.Certificate(cred_path))
+        return firestore.client()
+
+
+def _product_from_doc(doc):
+    product = doc.to_dict()
+    if "product_id" not in product:
+        product["product_id"] = doc.id
+    return product
+
+
+def _record_from_doc(doc):
+    record = doc.to_dict()
+    if "id" not in record:
+        record["id"] = doc.id
+    return record
+
+
+def _round_trip(func):
+    # Métodos que hacen exactamente una RPC (ver firestore_round_trips_per_request)
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        record_round_trips(func.__name__)
+        return func(*args, **kwargs)
+    return wrapper
+
+
+class FirestoreRepository(StorageRepository):
+    """Implementación sobre Cloud Firestore (ver firestore.indexes.json)."""
+
+    def __init__(self, client=None):
+        self._client = client
+
+    @property
+    def db(self):
+        # El cliente se crea con el primer uso, no al importar el módulo
+        if self._client is None:
+            self._client = firestore_client()
+        return self._client
+
+    # -- productos --
+
+    def watch_products(self, on_changes):
+        # El listener entrega todo el catálogo en el primer snapshot y luego
+        # solo los cambios, así que el índice nunca requiere volver a escanear.
+        def on_snapshot(col_snapshot, changes, read_time):
+            upserts, removed = [], []
+            for change in changes:
+                if change.type.name == "REMOVED":
+                    removed.append(change.document.id)
+                else:
+                    upserts.append(_product_from_doc(change.document))
+            on_changes(upserts, removed)
+
+        watch = self.db.collection("products").on_snapshot(on_snapshot)
+        return watch.unsubscribe
+
+    @_round_trip
+    def get_product(self, product_id):
+        doc = self.db.collection("products").document(product_id).get()
+        return _product_from_doc(doc) if doc.exists else None
+
+    @_round_trip
+    def save_product(self, product):
+        self.db.collection("products").document(product["product_id"]).set(product)
+
+    @_round_trip
+    def list_products(self, limit):
+        query = self.db.collection("products")
+        if limit:
+            query = query.limit(limit)
+        return [_product_from_doc(d) for d in query.stream()]
+
+    @_round_trip
+    def product_content_hashes(self):
+        # Solo se lee el campo content_hash de cada producto
+        docs = self.db.collection("products").select(["content_hash"]).stream()
+        return {d.id: (d.to_dict() or {}).get("content_hash") for d in docs}
+
+    @_round_trip
+    def write_batch(self, collection, docs, id_field):
+        batch = self.db.batch()
+        for doc in docs:
+            batch.set(self.db.collection(collection).document(str(doc[id_field])), doc)
+        batch.commit()
+
+    # -- órdenes de compra --
+
+    def _apply_rollups(self, batch, rollups):
+        # Increment es atómico en el servidor: escrituras concurrentes sobre el
+        # mismo agregado no se pisan y no hace falta leerlo antes.
+        collection = self.db.collection("spend_rollups")
+        for delta in rollups:
+            fields = {k: v for k, v in delta.items() if k not in ("id", "count", "total_amount")}
+            fields["count"] = firestore.Increment(delta["count"])
+            fields["total_amount"] = firestore.Increment(delta["total_amount"])
+            batch.set(collection.document(delta["id"]), fields, merge=True)
+
+    @_round_trip
+    def save_purchase_order(self, record, rollups=()):
+        # create() lleva la precondición exists=False: nunca pisa otra orden
+        batch = self.db.batch()
+        batch.create(self.db.collection("purchase_orders").document(record["id"]), record)
+        self._apply_rollups(batch, rollups)
+        try:
+            batch.commit()
+        except _PRECONDITION_ERRORS as e:
+            raise PurchaseOrderConflictError(f"Ya existe una orden con id {record['id']}") from e
+
+    @_round_trip
+    def get_purchase_order(self, order_id):
+        doc = self.db.collection("purchase_orders").document(order_id).get()
+        if not doc.exists:
+            return None
+        record = _record_from_doc(doc)
+        record["update_time"] = doc.update_time
+        return record
+
+    @_round_trip
+    def get_purchase_orders(self, order_ids):
+        references = [self.db.collection("purchase_orders").document(order_id) for order_id in order_ids]
+        return [_record_from_doc(d) for d in self.db.get_all(references) if d.exists]
+
+    @_round_trip
+    def delete_purchase_order(self, order_id, rollups=(), update_time=None):
+        # Reutiliza la lectura previa: la precondición reemplaza releer la orden
+        if update_time is not None:
+            option = self.db.write_option(last_update_time=update_time)
+        else:
+            option = self.db.write_option(exists=True)
+        batch = self.db.batch()
+        batch.delete(self.db.collection("purchase_orders").document(order_id), option=option)
+        self._apply_rollups(batch, rollups)
+        try:
+            batch.commit()
+        except _PRECONDITION_ERRORS as e:
+            raise PurchaseOrderConflictError(f"La orden {order_id} cambió o ya fue eliminada") from e
+
+    @_round_trip
+    def query_purchase_orders(self, user_id, status, start, end, limit, after=None):
+        query = self.db.collection("purchase_orders")
+        if user_id:
+            query = query.where(filter=firestore.FieldFilter("user_id", "==", user_id))
+        if status:
+            query = query.where(filter=firestore.FieldFilter("status", "==", status))
+        if start:
+            query = query.where(filter=firestore.FieldFilter(PURCHASE_TS_FIELD, ">=", start))
+        if end:
+            query = query.where(filter=firestore.FieldFilter(PURCHASE_TS_FIELD, "<", end))
+
+        query = query.order_by(PURCHASE_TS_FIELD, direction=firestore.Query.DESCENDING)
+        query = query.order_by("__name__", direction=firestore.Query.DESCENDING)
+        if after:
+            query = query.start_after({PURCHASE_TS_FIELD: after[0], "__name__": after[1]})
+        return [_record_from_doc(d) for d in query.limit(limit).stream()]
+
+    # -- tickets de aprobación --
+
+    def _approval_tickets(self):
+        return self.db.collection("approval_tickets")
+
+    @_round_trip
+    def save_approval_ticket(self, ticket):
+        self._approval_tickets().document(ticket["id"]).set(ticket)
+
+    @_round_trip
+    def get_approval_ticket(self, ticket_id):
+        doc = self._approval_tickets().document(ticket_id).get()
+        if not doc.exists:
+            return None
+        ticket = doc.to_dict()
+        ticket["update_time"] = doc.update_time
+        return ticket
+
+    @_round_trip
+    def commit_approval_ticket(self, ticket, save_orders=(), delete_order_ids=(), rollups=()):
+        # Un único commit: la escritura de las órdenes y el consumo del ticket. La
+        # precondición sobre el ticket evita ejecutar dos veces la misma aprobación;
+        # las de las órdenes, descontar de los agregados una orden ya borrada.
+        orders = self.db.collection("purchase_orders")
+        batch = self.db.batch()
+        for record in save_orders:
+            batch.create(orders.document(record["id"]), record)
+        for order_id in delete_order_ids:
+            batch.delete(orders.document(order_id), option=self.db.write_option(exists=True))
+        self._apply_rollups(batch, rollups)
+        batch.delete(
+            self._approval_tickets().document(ticket["id"]),
+            option=self.db.write_option(last_update_time=ticket["update_time"]),
+        )
+        try:
+            batch.commit()
+        except _PRECONDITION_ERRORS as e:
+            raise ApprovalTicketConflictError(
+                f"La aprobación {ticket['id']} ya fue ejecutada o sus órdenes cambiaron"
+            ) from e
+
+    # -- agregados de gasto --
+
+    @_round_trip
+    def get_spend_rollups(self, rollup_ids):
+        collection = self.db.collection("spend_rollups")
+        docs = self.db.get_all([collection.document(rollup_id) for rollup_id in rollup_ids])
+        return {d.id: d.to_dict() for d in docs if d.exists}
+
+    def replace_spend_rollups(self, rollups):
+        collection = self.db.collection("spend_rollups")
+        wanted = {rollup["id"] for rollup in rollups}
+        # Primero los valores nuevos (set completo), luego los agregados sobrantes
+        for start in range(0, len(rollups), 500):
+            batch = self.db.batch()
+            for rollup in rollups[start:start + 500]:
+                batch.set(collection.document(rollup["id"]), {k: v for k, v in rollup.items() if k != "id"})
+            batch.commit()
+            record_round_trips("replace_spend_rollups")
+        stale = [d.reference for d in collection.select([]).stream() if d.id not in wanted]
+        record_round_trips("replace_spend_rollups")
+        for start in range(0, len(stale), 500):
+            batch = self.db.batch()
+            for reference in stale[start:start + 500]:
+                batch.delete(reference)
+            batch.commit()
+            record_round_trips("replace_spend_rollups")
+
+    # -- chat --
+
+    def _chat_messages(self, user_id):
+        return self.db.collection("sessions").document(user_id).collection("messages")
+
+    @_round_trip
+    def add_chat_messages(self, user_id, records):
+        # El id es el seq con ceros a la izquierda: ordena igual que el
+        # historial y un reintento del batch sobrescribe en vez de duplicar.
+        messages = self._chat_messages(user_id)
+        batch = self.db.batch()
+        for record in records:
+            batch.set(
+                messages.document(f"{record['seq']:020d}"),
+                {**record, "persisted_at": firestore.SERVER_TIMESTAMP},
+            )
+        batch.commit()
+
+    @_round_trip
+    def get_chat_messages(self, user_id, limit, before=None):
+        query = self._chat_messages(user_id).order_by("created_at", direction=firestore.Query.DESCENDING)
+        if before:
+            query = query.start_after({"created_at": before})
+        return [d.to_dict() for d in query.limit(limit).stream()]
+
+    def clear_chat_messages(self, user_id):
+        deleted = 0
+        while True:
+            docs = list(self._chat_messages(user_id).limit(500).stream())
+            record_round_trips("clear_chat_messages")
+            if not docs:
+                return deleted
+            batch = self.db.batch()
+            for d in docs:
+                batch.delete(d.reference)
+            batch.commit()
+            record_round_trips("clear_chat_messages")
+            deleted += len(docs)
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
@@ -0,0 +1,135 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import threading
+from datetime import datetime, timezone
+try:
+    from .settings import load_env
+except ImportError:
+    from infrastructure.settings import load_env
+
+load_env()
+
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("LOG_FILE")
+# Tamaño máximo de cada campo del registro (mensaje y extras)
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", "2000"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Muestreo de líneas DEBUG por ruta, p. ej. "/chat=0.1,/execute=1"
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+
+_SECRET_PATTERNS = [
+    re.compile(r"sk-[A-Za-z0-9_\-]{16,}"),
+    re.compile(r"-----BEGIN [A-Z ]*PRIVATE KEY-----.*?-----END [A-Z ]*PRIVATE KEY-----", re.DOTALL),
+    re.compile(r"(?i)((?:api[_-]?key|authorization|password|private_key|secret)['\"]?\s*[:=]\s*['\"]?)[^'\",\s}]+"),
+]
+_STANDARD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+_setup_lock = threading.Lock()
+_listener = None
+
+
+def redact(text):
+    for secret in filter(None, [os.getenv("OPENAI_API_KEY")]):
+        text = text.replace(secret, "[REDACTED]")
+    for pattern in _SECRET_PATTERNS:
+        text = pattern.sub(lambda m: (m.group(1) if m.groups() else "") + "[REDACTED]", text)
+    return text
+
+
+def _cap(text):
+    if len(text) <= LOG_MAX_FIELD_CHARS:
+        return text
+    return f"{text[:LOG_MAX_FIELD_CHARS]}…(+{len(text) - LOG_MAX_FIELD_CHARS} chars)"
+
+
+class JsonFormatter(logging.Formatter):
+    # Registro compacto de una línea; corre en el hilo escritor, no en el request
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": _cap(redact(record.getMessage())),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and not key.startswith("_"):
+                entry[key] = value if isinstance(value, (int, float, bool)) or value is None else _cap(redact(str(value)))
+        if record.exc_info:
+            entry["exc"] = _cap(redact(self.formatException(record.exc_info)))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RouteSamplingFilter(logging.Filter):
+    # Deja pasar solo una fracción de las líneas DEBUG de cada ruta
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        rate = self.rates.get(getattr(record, "route", None), 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler formatea el mensaje en el hilo que loguea; aquí solo se
+    # encola el registro y el formateo queda para el hilo escritor.
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Bajo saturación se descarta antes que bloquear el request
+            pass
+
+
+def parse_sample_rates(raw):
+    rates = {}
+    for item in filter(None, (part.strip() for part in raw.split(","))):
+        route, _, rate = item.partition("=")
+        try:
+            rates[route.strip()] = float(rate)
+        except ValueError:
+            continue
+    return rates
+
+
+def setup_logging():
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return _listener
+
+        formatter = JsonFormatter()
+        handlers = [logging.StreamHandler(sys.stderr)]
+        if LOG_FILE:
+            handlers.append(logging.FileHandler(LOG_FILE, encoding="utf-8"))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        queue_handler = _LazyQueueHandler(log_queue)
+        queue_handler.addFilter(RouteSamplingFilter(parse_sample_rates(LOG_SAMPLE_RATES)))
+
+        root = logging.getLogger()
+        root.handlers = [queue_handler]
+        root.setLevel(LOG_LEVEL)
+
+        _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+        return _listener
@@ -0,0 +1,222 @@
+import asyncio
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+
+# Buckets en segundos para latencias de requests, etapas y operaciones de BD
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250, 500, 1000)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_registry = []
+_callbacks = []
+_registry_lock = threading.Lock()
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    )
+    return "{" + escaped + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.labelnames, key, [("le", _format_value(float(bound)))])
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labelnames, key, [("le", "+Inf")])
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+def register_gauge_callback(name, documentation, labelname, callback):
+    # Gauges calculados al exportar: `callback` devuelve {valor_label: número}
+    with _registry_lock:
+        _callbacks.append((name, documentation, labelname, callback))
+
+
+def render():
+    lines = []
+    with _registry_lock:
+        metrics = list(_registry)
+        callbacks = list(_callbacks)
+    for metric in metrics:
+        lines.extend(metric.collect())
+    for name, documentation, labelname, callback in callbacks:
+        lines.append(f"# HELP {name} {documentation}")
+        lines.append(f"# TYPE {name} gauge")
+        for label, value in sorted(callback().items()):
+            lines.append(f"{name}{_format_labels((labelname,), (label,))} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Latencia de requests HTTP por ruta", ("route", "method", "status")
+)
+STAGE_LATENCY = Histogram(
+    "agent_stage_duration_seconds", "Latencia de cada etapa de run_agent", ("stage",)
+)
+DB_LATENCY = Histogram(
+    "firestore_operation_duration_seconds", "Latencia de cada función de firebase_service", ("operation",)
+)
+DB_DOCUMENTS_READ = Counter(
+    "firestore_documents_read_total", "Documentos de Firestore leídos por operación", ("operation",)
+)
+REQUEST_DOCUMENTS_READ = Histogram(
+    "firestore_documents_read_per_request", "Documentos de Firestore leídos por request", ("route",),
+    buckets=COUNT_BUCKETS,
+)
+DB_ROUND_TRIPS = Counter(
+    "firestore_round_trips_total", "RPCs a Firestore por método del repositorio", ("operation",)
+)
+REQUEST_ROUND_TRIPS = Histogram(
+    "firestore_round_trips_per_request", "RPCs a Firestore por request", ("route",), buckets=COUNT_BUCKETS
+)
+CHAT_RESPONSES = Counter(
+    "chat_responses_total", "Respuestas de /chat por tipo (OK o APPROVAL_REQUIRED)", ("route", "status")
+)
+LLM_TOKENS = Counter(
+    "llm_tokens_total", "Tokens consumidos en OpenAI según response.usage", ("model", "type")
+)
+CHAT_BUFFER_MESSAGES = Counter(
+    "chat_buffer_messages_total", "Mensajes de chat del buffer write-behind por resultado", ("outcome",)
+)
+CHAT_BUFFER_FLUSH_SIZE = Histogram(
+    "chat_buffer_flush_size", "Mensajes por batch escrito desde el buffer de chat", buckets=COUNT_BUCKETS
+)
+ADMISSION_REJECTIONS = Counter(
+    "admission_rejections_total", "Turnos de chat rechazados por el control de admisión", ("reason",)
+)
+
+
+# Lecturas y round trips del request en curso. Es un objeto mutable para que
+# los hilos del pool de Firestore (que reciben una copia del contexto)
+# acumulen sobre el mismo request.
+_request_io = contextvars.ContextVar("request_io", default=None)
+
+
+def start_request_io():
+    io = {"reads": 0, "round_trips": 0}
+    _request_io.set(io)
+    return io
+
+
+def record_documents_read(operation, count):
+    if not count:
+        return
+    DB_DOCUMENTS_READ.inc(count, operation=operation)
+    io = _request_io.get()
+    if io is not None:
+        io["reads"] += count
+
+
+def record_round_trips(operation, count=1):
+    DB_ROUND_TRIPS.inc(count, operation=operation)
+    io = _request_io.get()
+    if io is not None:
+        io["round_trips"] += count
+
+
+def timed(histogram, **labels):
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with histogram.time(**labels):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def db_operation(func):
+    return timed(DB_LATENCY, operation=func.__name__)(func)
@@ -0,0 +1,127 @@
+import threading
+
+
+# Tamaño de los n-gramas del índice de coincidencias parciales
+NGRAM_SIZE = 3
+
+
+def normalize_detail(value):
+    return str(value or "").strip().lower()
+
+
+def _ngrams(text):
+    return {text[i:i + NGRAM_SIZE] for i in range(len(text) - NGRAM_SIZE + 1)}
+
+
+class ProductCatalogIndex:
+    """Índice en memoria del catálogo de productos.
+
+    Mantiene un hash exacto por `detail` normalizado, un índice de trigramas
+    para coincidencias parciales y el acceso directo por `product_id`.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._ready = threading.Event()
+        self._by_id = {}
+        self._normalized = {}
+        self._by_detail = {}
+        self._by_ngram = {}
+        # Se incrementa con cada cambio; lo usan los índices derivados
+        self.version = 0
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def mark_ready(self):
+        self._ready.set()
+
+    def wait_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def load(self, products):
+        with self._lock:
+            for product in products:
+                self.upsert(product)
+        self.mark_ready()
+
+    def upsert(self, product):
+        product_id = product.get("product_id")
+        if not product_id:
+            return
+        with self._lock:
+            self.remove(product_id)
+            detail = normalize_detail(product.get("detail"))
+            self._by_id[product_id] = dict(product)
+            self._normalized[product_id] = detail
+            self._by_detail.setdefault(detail, set()).add(product_id)
+            for gram in _ngrams(detail):
+                self._by_ngram.setdefault(gram, set()).add(product_id)
+            self.version += 1
+
+    def remove(self, product_id):
+        with self._lock:
+            if self._by_id.pop(product_id, None) is None:
+                return
+            detail = self._normalized.pop(product_id)
+            self._discard(self._by_detail, detail, product_id)
+            for gram in _ngrams(detail):
+                self._discard(self._by_ngram, gram, product_id)
+            self.version += 1
+
+    @staticmethod
+    def _discard(index, key, product_id):
+        ids = index.get(key)
+        if ids is None:
+            return
+        ids.discard(product_id)
+        if not ids:
+            del index[key]
+
+    def snapshot(self):
+        # (versión, [(product_id, detail normalizado)]) para reconstruir índices derivados
+        with self._lock:
+            return self.version, list(self._normalized.items())
+
+    def get_by_id(self, product_id):
+        with self._lock:
+            product = self._by_id.get(product_id)
+            return dict(product) if product else None
+
+    def get_by_detail(self, detail):
+        detail_clean = normalize_detail(detail)
+        if not detail_clean:
+            return None
+
+        with self._lock:
+            exact_ids = self._by_detail.get(detail_clean)
+            if exact_ids:
+                # Mismo desempate que el stream de Firestore (orden por id)
+                return dict(self._by_id[min(exact_ids)])
+
+            partial_ids = [
+                product_id for product_id in self._partial_candidates(detail_clean)
+                if detail_clean in self._normalized[product_id]
+            ]
+            if len(partial_ids) == 1:
+                return dict(self._by_id[partial_ids[0]])
+            return None
+
+    def _partial_candidates(self, detail_clean):
+        grams = _ngrams(detail_clean)
+        if not grams:
+            # Consultas más cortas que un trigrama: se revisa el índice en memoria
+            return list(self._normalized)
+
+        postings = []
+        for gram in grams:
+            ids = self._by_ngram.get(gram)
+            if not ids:
+                return []
+            postings.append(ids)
+        postings.sort(key=len)
+        return set.intersection(*postings)
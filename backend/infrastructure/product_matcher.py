@@ -0,0 +1,241 @@
+import logging
+import os
+import threading
+from collections import Counter
+
+import numpy as np
+try:
+    from .product_catalog import normalize_detail
+except ImportError:
+    from infrastructure.product_catalog import normalize_detail
+
+
+logger = logging.getLogger("product_matcher")
+
+NGRAM_SIZE = 3
+# Espacio de features (hashing de n-gramas de caracteres)
+FEATURE_BITS = 20
+FEATURE_MASK = (1 << FEATURE_BITS) - 1
+# Poda de candidatos: los n-gramas más raros de la consulta, hasta sumar
+# MATCH_POSTINGS_RATIO del catálogo en postings, dan un puntaje parcial y sus
+# MATCH_CANDIDATE_ROWS mejores filas; de los demás (comunes) solo se toman sus
+# MATCH_CHAMPIONS filas de mayor peso. Si los postings de la consulta suman
+# menos de MATCH_DENSE_POSTINGS se recorren enteros (es más barato y exacto)
+MATCH_POSTINGS_RATIO = float(os.getenv("MATCH_POSTINGS_RATIO", "0.1"))
+MATCH_CANDIDATE_ROWS = int(os.getenv("MATCH_CANDIDATE_ROWS", "768"))
+MATCH_CHAMPIONS = int(os.getenv("MATCH_CHAMPIONS", "16"))
+MATCH_DENSE_POSTINGS = int(os.getenv("MATCH_DENSE_POSTINGS", "100000"))
+
+
+def _ngram_features(texts):
+    # (fila, feature) por cada n-grama de cada texto; hash() es estable dentro
+    # del proceso, que es la vida útil del índice.
+    rows, features = [], []
+    for row, text in enumerate(texts):
+        padded = f" {text} "
+        for i in range(len(padded) - NGRAM_SIZE + 1):
+            rows.append(row)
+            features.append(hash(padded[i:i + NGRAM_SIZE]) & FEATURE_MASK)
+    return np.asarray(rows, dtype=np.int64), np.asarray(features, dtype=np.int64)
+
+
+def _term_frequencies(rows, features):
+    # Agrupa pares (fila, feature) repetidos con tf sublineal 1 + log(count)
+    if not len(rows):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0)
+    keys, counts = np.unique((rows << FEATURE_BITS) | features, return_counts=True)
+    return keys >> FEATURE_BITS, keys & FEATURE_MASK, 1.0 + np.log(counts)
+
+
+class _TfidfMatrix:
+    """Matriz TF-IDF dispersa, por columnas (feature -> filas) y por filas.
+
+    Las columnas dan los candidatos de una consulta; las filas, su puntaje
+    exacto sin recorrer los postings largos de los n-gramas comunes.
+    """
+
+    def __init__(self, version, items):
+        self.version = version
+        self.product_ids = [product_id for product_id, _ in items]
+        size = len(self.product_ids)
+        rows, features, tf = _term_frequencies(*_ngram_features(detail for _, detail in items))
+
+        self.features, inverse, df = np.unique(features, return_inverse=True, return_counts=True)
+        self.idf = np.log((size + 1) / (df + 1)) + 1.0
+        weights = tf * self.idf[inverse]
+        norms = np.sqrt(np.bincount(rows, weights=weights ** 2, minlength=size))
+        weights = weights / np.where(norms[rows] > 0, norms[rows], 1.0)
+
+        # Por filas: los pares ya vienen ordenados por fila
+        self.row_starts = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=size)))).astype(np.int64)
+        self.row_features = np.ascontiguousarray(inverse, dtype=np.int32)
+        self.row_weights = np.ascontiguousarray(weights, dtype=np.float32)
+
+        # Por columnas, cada lista de postings de mayor a menor peso: sus
+        # primeras filas son las que más aportan con ese n-grama
+        order = np.lexsort((-weights, inverse))
+        self.rows = np.ascontiguousarray(rows[order], dtype=np.int32)
+        self.weights = np.ascontiguousarray(weights[order], dtype=np.float32)
+        self.starts = np.concatenate(([0], np.cumsum(df))).astype(np.int64)
+        self._scratch = threading.local()
+
+    def __len__(self):
+        return len(self.product_ids)
+
+    def _query_terms(self, query):
+        # (feature, peso normalizado) de los n-gramas de la consulta presentes
+        # en el catálogo, del más raro (postings más cortos) al más común
+        padded = f" {query} "
+        counts = Counter(hash(padded[i:i + NGRAM_SIZE]) & FEATURE_MASK for i in range(len(padded) - NGRAM_SIZE + 1))
+        if not counts or not len(self.features):
+            return None, None
+        q_features = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        q_tf = 1.0 + np.log(np.fromiter(counts.values(), dtype=np.float64, count=len(counts)))
+        position = np.minimum(np.searchsorted(self.features, q_features), len(self.features) - 1)
+        known = self.features[position] == q_features
+        position, q_tf = position[known], q_tf[known]
+        if not len(position):
+            return None, None
+        q_weights = q_tf * self.idf[position]
+        q_weights = (q_weights / np.sqrt(np.sum(q_weights ** 2))).astype(np.float32)
+        rarest = np.argsort(self.starts[position + 1] - self.starts[position], kind="stable")
+        return position[rarest], q_weights[rarest]
+
+    def _accumulator(self):
+        # Un acumulador por hilo (las búsquedas corren en el pool), siempre en cero
+        buffer = getattr(self._scratch, "buffer", None)
+        if buffer is None:
+            buffer = self._scratch.buffer = np.zeros(len(self), dtype=np.float32)
+        return buffer
+
+    def _rare_candidates(self, positions, q_weights):
+        # Puntaje parcial con los n-gramas más raros; devuelve las filas de las
+        # MATCH_CANDIDATE_ROWS entradas con mejor parcial
+        lengths = self.starts[positions + 1] - self.starts[positions]
+        offsets = np.cumsum(lengths) - lengths
+        entries = np.arange(lengths.sum()) + np.repeat(self.starts[positions] - offsets, lengths)
+        rows = self.rows[entries]
+        accumulator = self._accumulator()
+        np.add.at(accumulator, rows, self.weights[entries] * np.repeat(q_weights, lengths))
+        # Una fila aparece una vez por cada n-grama raro que comparte: cada
+        # candidato debe ocupar un solo lugar de los MATCH_CANDIDATE_ROWS
+        rows = np.unique(rows)
+        partial = accumulator[rows]
+        accumulator[rows] = 0
+        if len(rows) > MATCH_CANDIDATE_ROWS:
+            rows = rows[np.argpartition(-partial, MATCH_CANDIDATE_ROWS - 1)[:MATCH_CANDIDATE_ROWS]]
+        return rows
+
+    def _row_scores(self, candidates, positions, q_weights):
+        # Similitud coseno exacta de las filas candidatas con la consulta
+        query = np.zeros(len(self.features), dtype=np.float32)
+        query[positions] = q_weights
+        starts = self.row_starts[candidates]
+        lengths = self.row_starts[candidates + 1] - starts
+        offsets = np.cumsum(lengths) - lengths
+        entries = np.arange(lengths.sum()) + np.repeat(starts - offsets, lengths)
+        contributions = query[self.row_features[entries]] * self.row_weights[entries]
+        return np.bincount(np.repeat(np.arange(len(candidates)), lengths), weights=contributions,
+                           minlength=len(candidates))
+
+    def _dense_scores(self, positions, q_weights):
+        # Todo el catálogo: cada n-grama suma su lista de postings (un slice
+        # contiguo, sin filas repetidas) a la fila de puntajes
+        scores = np.zeros(len(self), dtype=np.float32)
+        starts, ends = self.starts[positions], self.starts[positions + 1]
+        for start, end, weight in zip(starts.tolist(), ends.tolist(), q_weights.tolist()):
+            scores[self.rows[start:end]] += self.weights[start:end] * weight
+        return scores
+
+    def top(self, query, k, min_score=0.0):
+        """Los k productos más similares a `query`: (filas, puntajes) de mayor a menor.
+
+        Solo se puntúan candidatos: las filas con mejor puntaje parcial en los
+        n-gramas más raros y, de cada n-grama común, sus MATCH_CHAMPIONS filas
+        de mayor peso. Los n-gramas comunes igual cuentan en el puntaje
+        (exacto) de cada candidato. Si la consulta tiene pocos postings en
+        total se puntúa el catálogo entero.
+        """
+        empty = np.zeros(0, dtype=np.int64), np.zeros(0)
+        positions, q_weights = self._query_terms(query)
+        if positions is None or k <= 0:
+            return empty
+
+        lengths = self.starts[positions + 1] - self.starts[positions]
+        if int(lengths.sum()) <= MATCH_DENSE_POSTINGS:
+            candidates = None
+            scores = self._dense_scores(positions, q_weights)
+        else:
+            rare = max(1, int(np.searchsorted(np.cumsum(lengths), len(self) * MATCH_POSTINGS_RATIO, side="right")))
+            parts = [self._rare_candidates(positions[:rare], q_weights[:rare])]
+            for start in self.starts[positions[rare:]].tolist():
+                parts.append(self.rows[start:start + MATCH_CHAMPIONS])
+            candidates = np.unique(np.concatenate(parts))
+            scores = self._row_scores(candidates, positions, q_weights)
+
+        top = min(k, len(scores))
+        best = np.argpartition(-scores, top - 1)[:top]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        best = best[scores[best] > min_score]
+        return (best if candidates is None else candidates[best]), scores[best]
+
+
+class ProductMatcher:
+    """Búsqueda difusa top-k sobre el catálogo indexado en memoria.
+
+    La matriz se reconstruye en segundo plano cuando cambia el catálogo; mientras
+    tanto se sigue respondiendo con la versión anterior.
+    """
+
+    def __init__(self, catalog):
+        self._catalog = catalog
+        self._lock = threading.Lock()
+        self._matrix = None
+        self._rebuilding = False
+
+    @property
+    def ready(self):
+        # Ya hay una matriz: las búsquedas no construyen nada en el hilo que llama
+        return self._matrix is not None
+
+    def _rebuild(self):
+        try:
+            matrix = _TfidfMatrix(*self._catalog.snapshot())
+            with self._lock:
+                self._matrix = matrix
+            logger.info("Matriz TF-IDF del catálogo reconstruida: %s productos", len(matrix))
+        finally:
+            with self._lock:
+                self._rebuilding = False
+
+    def _current(self):
+        with self._lock:
+            matrix = self._matrix
+            stale = matrix is None or matrix.version != self._catalog.version
+            start_background = stale and matrix is not None and not self._rebuilding
+            if start_background:
+                self._rebuilding = True
+        if matrix is None:
+            matrix = _TfidfMatrix(*self._catalog.snapshot())
+            with self._lock:
+                self._matrix = matrix
+        elif start_background:
+            threading.Thread(target=self._rebuild, name="product-matcher", daemon=True).start()
+        return matrix
+
+    def search_batch(self, queries, k=5, min_score=0.0):
+        matrix = self._current()
+        results = []
+        for query in queries:
+            rows, scores = matrix.top(normalize_detail(query), k, min_score)
+            candidates = []
+            for index, score in zip(rows.tolist(), scores.tolist()):
+                product = self._catalog.get_by_id(matrix.product_ids[index])
+                if product:
+                    candidates.append({"product": product, "score": round(score, 4)})
+            results.append(candidates)
+        return results
+
+    def search(self, query, k=5, min_score=0.0):
+        return self.search_batch([query], k=k, min_score=min_score)[0]
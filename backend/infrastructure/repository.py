@@ -0,0 +1,124 @@
+from abc import ABC, abstractmethod
+
+
+# Campo de timestamp nativo usado para filtrar y ordenar purchase_orders
+PURCHASE_TS_FIELD = "purchase_ts"
+
+
+class ApprovalTicketConflictError(Exception):
+    pass
+
+
+class PurchaseOrderConflictError(Exception):
+    pass
+
+
+class StorageRepository(ABC):
+    """Persistencia de productos, órdenes de compra, aprobaciones y chat.
+
+    firebase_service resuelve caché, índices en memoria y métricas encima de
+    esta interfaz; cada implementación solo lee y escribe registros. Las
+    órdenes se guardan con su `purchase_ts` (datetime) y los mensajes de chat
+    y tickets con sus fechas como datetime.
+    """
+
+    # -- productos --
+
+    @abstractmethod
+    def watch_products(self, on_changes):
+        """Entrega el catálogo completo y luego cada cambio a
+        `on_changes(upserts, removed_ids)`. Devuelve una función para dejar de
+        escuchar."""
+
+    @abstractmethod
+    def get_product(self, product_id):
+        pass
+
+    @abstractmethod
+    def save_product(self, product):
+        pass
+
+    @abstractmethod
+    def list_products(self, limit):
+        pass
+
+    @abstractmethod
+    def product_content_hashes(self):
+        """{product_id: content_hash} sin leer el resto de cada producto."""
+
+    @abstractmethod
+    def write_batch(self, collection, docs, id_field):
+        """Upsert atómico de hasta 500 documentos de `products` o `purchase_orders`."""
+
+    # -- órdenes de compra --
+
+    @abstractmethod
+    def save_purchase_order(self, record, rollups=()):
+        """Crea la orden y aplica los incrementos de `rollups` (ver
+        spend_rollups.rollup_deltas) en la misma escritura atómica;
+        PurchaseOrderConflictError si el id ya existe."""
+
+    @abstractmethod
+    def get_purchase_order(self, order_id):
+        """La orden con su `update_time` si el backend lo registra."""
+
+    @abstractmethod
+    def get_purchase_orders(self, order_ids):
+        """Las órdenes existentes entre `order_ids`, leídas en un solo round trip."""
+
+    @abstractmethod
+    def delete_purchase_order(self, order_id, rollups=(), update_time=None):
+        """Borra la orden y aplica `rollups` en una escritura atómica, con
+        precondición en vez de releerla: debe existir y, con `update_time`, no
+        haber cambiado desde esa lectura. Si no, PurchaseOrderConflictError sin
+        escribir nada."""
+
+    @abstractmethod
+    def query_purchase_orders(self, user_id, status, start, end, limit, after=None):
+        """Órdenes por purchase_ts e id descendentes, con `start <= purchase_ts < end`
+        y posteriores a `after` = (purchase_ts, id) si se indica."""
+
+    # -- tickets de aprobación --
+
+    @abstractmethod
+    def save_approval_ticket(self, ticket):
+        pass
+
+    @abstractmethod
+    def get_approval_ticket(self, ticket_id):
+        """El ticket con su `update_time`, que commit_approval_ticket exige sin cambios."""
+
+    @abstractmethod
+    def commit_approval_ticket(self, ticket, save_orders=(), delete_order_ids=(), rollups=()):
+        """Aplica las órdenes, sus agregados de gasto y consume el ticket en una
+        sola escritura atómica; ApprovalTicketConflictError si el ticket ya fue
+        consumido, si alguna orden a borrar ya no existe o si alguna a crear ya
+        existe."""
+
+    # -- agregados de gasto --
+
+    @abstractmethod
+    def get_spend_rollups(self, rollup_ids):
+        """{id: agregado} de los ids existentes, leídos en un solo round trip."""
+
+    @abstractmethod
+    def replace_spend_rollups(self, rollups):
+        """Reemplaza todos los agregados por `rollups` (valores absolutos)."""
+
+    # -- chat --
+
+    @abstractmethod
+    def add_chat_messages(self, user_id, records):
+        """Escribe los mensajes en una sola escritura atómica, con el `seq` de
+        cada uno como id y `persisted_at` con la hora del servidor."""
+
+    @abstractmethod
+    def get_chat_messages(self, user_id, limit, before=None):
+        """Los `limit` mensajes más recientes anteriores a `before`, del más nuevo al más viejo."""
+
+    @abstractmethod
+    def clear_chat_messages(self, user_id):
+        """Borra el historial y devuelve cuántos mensajes eliminó."""
+
+    def close(self):
+        pass
@@ -0,0 +1,17 @@
+import threading
+
+from dotenv import load_dotenv
+
+
+_loaded = False
+_lock = threading.Lock()
+
+
+def load_env():
+    # Un solo load_dotenv por proceso; cada módulo que lee variables al
+    # importarse lo llama primero, sin importar el punto de entrada.
+    global _loaded
+    with _lock:
+        if not _loaded:
+            load_dotenv()
+            _loaded = True
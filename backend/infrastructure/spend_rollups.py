@@ -0,0 +1,93 @@
+from calendar import monthrange
+from datetime import date as date_type, timedelta, timezone
+from urllib.parse import quote
+
+
+# Agregados de gasto materializados (colección `spend_rollups`): un documento
+# por usuario, producto y día o mes con `count` y `total_amount`. Cada orden
+# suma en cuatro: su producto y "todos los productos" (ALL_PRODUCTS), por día y
+# por mes. Se actualizan en la misma escritura atómica que la orden.
+
+ALL_PRODUCTS = "*"
+# Agregados que toca como máximo una orden (rollup_deltas)
+ROLLUPS_PER_ORDER = 4
+DAY = "day"
+MONTH = "month"
+# Días máximos de un rango consultado (se descompone en meses completos y días)
+MAX_RANGE_DAYS = 366
+
+
+def rollup_id(user_id, product_id, period):
+    # Ids de documento de Firestore no admiten "/"
+    parts = (user_id or "", product_id or ALL_PRODUCTS, period)
+    return "|".join(quote(str(part), safe="@.+-_*") for part in parts)
+
+
+def _delta(user_id, product_id, granularity, period, count, total_amount):
+    return {
+        "id": rollup_id(user_id, product_id, period),
+        "user_id": user_id,
+        "product_id": product_id or ALL_PRODUCTS,
+        "granularity": granularity,
+        "period": period,
+        "count": count,
+        "total_amount": total_amount,
+    }
+
+
+def rollup_deltas(record, sign=1):
+    """Incrementos de los agregados para una orden persistida (con purchase_ts aware).
+
+    `sign=-1` para una orden eliminada.
+    """
+    ts = record.get("purchase_ts")
+    if ts is None:
+        return []
+    # Días y meses en UTC, igual que los filtros de fecha de purchase_orders
+    ts = ts.astimezone(timezone.utc)
+    user_id = record.get("user_id")
+    amount = sign * float(record.get("total_amount") or 0)
+    periods = ((DAY, ts.strftime("%Y-%m-%d")), (MONTH, ts.strftime("%Y-%m")))
+    products = [ALL_PRODUCTS]
+    if record.get("product_id"):
+        products.append(record["product_id"])
+    return [
+        _delta(user_id, product_id, granularity, period, sign, amount)
+        for product_id in products
+        for granularity, period in periods
+    ]
+
+
+def merge_deltas(deltas):
+    # Un lote de órdenes del mismo día escribe cada agregado una sola vez
+    merged = {}
+    for delta in deltas:
+        current = merged.get(delta["id"])
+        if current is None:
+            merged[delta["id"]] = dict(delta)
+        else:
+            current["count"] += delta["count"]
+            current["total_amount"] += delta["total_amount"]
+    for delta in merged.values():
+        delta["total_amount"] = round(delta["total_amount"], 2)
+    return list(merged.values())
+
+
+def summary_periods(start, end):
+    """Períodos (granularidad, período) que cubren exactamente [start, end] en días:
+    los meses completos como un agregado mensual y los extremos día por día."""
+    if end < start:
+        raise ValueError("date_to no puede ser anterior a date_from")
+    if (end - start).days >= MAX_RANGE_DAYS:
+        raise ValueError(f"El rango admite como máximo {MAX_RANGE_DAYS} días")
+    periods = []
+    current = start
+    while current <= end:
+        last_day = date_type(current.year, current.month, monthrange(current.year, current.month)[1])
+        if current.day == 1 and last_day <= end:
+            periods.append((MONTH, current.strftime("%Y-%m")))
+            current = last_day + timedelta(days=1)
+        else:
+            periods.append((DAY, current.strftime("%Y-%m-%d")))
+            current += timedelta(days=1)
+    return periods
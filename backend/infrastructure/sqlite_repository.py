@@ -0,0 +1,398 @@
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+try:
+    from .product_catalog import normalize_detail
+    from .repository import ApprovalTicketConflictError, PurchaseOrderConflictError, StorageRepository
+except ImportError:
+    from infrastructure.product_catalog import normalize_detail
+    from infrastructure.repository import ApprovalTicketConflictError, PurchaseOrderConflictError, StorageRepository
+
+
+# Campos datetime de los registros; se guardan como ISO UTC (ordenable como texto)
+_DATETIME_FIELDS = ("purchase_ts", "created_at", "expires_at", "persisted_at")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    product_id TEXT PRIMARY KEY,
+    detail_norm TEXT NOT NULL,
+    content_hash TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS products_detail_norm ON products (detail_norm);
+
+CREATE TABLE IF NOT EXISTS purchase_orders (
+    id TEXT PRIMARY KEY,
+    user_id TEXT,
+    status TEXT,
+    purchase_ts TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS purchase_orders_user_ts ON purchase_orders (user_id, purchase_ts, id);
+CREATE INDEX IF NOT EXISTS purchase_orders_status_ts ON purchase_orders (status, purchase_ts, id);
+CREATE INDEX IF NOT EXISTS purchase_orders_user_status_ts ON purchase_orders (user_id, status, purchase_ts, id);
+CREATE INDEX IF NOT EXISTS purchase_orders_ts ON purchase_orders (purchase_ts, id);
+
+CREATE TABLE IF NOT EXISTS approval_tickets (
+    id TEXT PRIMARY KEY,
+    expires_at TEXT NOT NULL,
+    update_time TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS approval_tickets_expires ON approval_tickets (expires_at);
+
+CREATE TABLE IF NOT EXISTS chat_messages (
+    user_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    created_at TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (user_id, seq)
+);
+CREATE INDEX IF NOT EXISTS chat_messages_user_created ON chat_messages (user_id, created_at, seq);
+
+CREATE TABLE IF NOT EXISTS spend_rollups (
+    id TEXT PRIMARY KEY,
+    user_id TEXT,
+    product_id TEXT NOT NULL,
+    granularity TEXT NOT NULL,
+    period TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    total_amount REAL NOT NULL
+);
+"""
+
+
+def _migrate_chat_messages(conn):
+    # Archivos creados cuando chat_messages numeraba sus filas con un seq
+    # AUTOINCREMENT propio: la tabla se rehace con el seq de cada mensaje
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'chat_messages'").fetchone()
+    if not row or "AUTOINCREMENT" not in row[0]:
+        return False
+    conn.execute("DROP INDEX IF EXISTS chat_messages_user_created")
+    conn.execute("ALTER TABLE chat_messages RENAME TO chat_messages_autoincrement")
+    return True
+
+
+def _ts(value):
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).isoformat(timespec="microseconds")
+
+
+def _dumps(record):
+    return json.dumps(
+        record, ensure_ascii=False, default=lambda v: _ts(v) if isinstance(v, datetime) else str(v)
+    )
+
+
+def _loads(raw):
+    record = json.loads(raw)
+    for field in _DATETIME_FIELDS:
+        if isinstance(record.get(field), str):
+            record[field] = datetime.fromisoformat(record[field])
+    return record
+
+
+class SQLiteRepository(StorageRepository):
+    """Implementación sobre SQLite para despliegues de un nodo y CI.
+
+    Con un archivo se usa WAL y una conexión por hilo: las lecturas corren en
+    paralelo y las escrituras se serializan. `path=":memory:"` usa una única
+    conexión compartida.
+    """
+
+    def __init__(self, path, busy_timeout_ms=5000):
+        self.path = path
+        self._memory = path == ":memory:"
+        self._busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        self._connections = []
+        self._write_lock = threading.RLock()
+        self._watchers = []
+        self._shared = self._connect() if self._memory else None
+        with self._write_lock:
+            conn = self._connection()
+            migrate = _migrate_chat_messages(conn)
+            conn.executescript(_SCHEMA)
+            if migrate:
+                conn.executescript(
+                    """
+                    INSERT OR IGNORE INTO chat_messages (user_id, seq, created_at, data)
+                        SELECT user_id, COALESCE(json_extract(data, '$.seq'), seq), created_at, data
+                        FROM chat_messages_autoincrement;
+                    DROP TABLE chat_messages_autoincrement;
+                    """
+                )
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute(f"PRAGMA busy_timeout = {int(self._busy_timeout_ms)}")
+        if not self._memory:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+        self._connections.append(conn)
+        return conn
+
+    def _connection(self):
+        if self._shared is not None:
+            return self._shared
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    @contextmanager
+    def _reading(self):
+        with self._write_lock if self._memory else nullcontext():
+            yield self._connection()
+
+    @contextmanager
+    def _transaction(self):
+        with self._write_lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    # -- productos --
+
+    def _notify(self, upserts):
+        for on_changes in list(self._watchers):
+            on_changes(upserts, [])
+
+    def watch_products(self, on_changes):
+        with self._write_lock:
+            on_changes(self.list_products(None), [])
+            self._watchers.append(on_changes)
+        return lambda: self._watchers.remove(on_changes)
+
+    def get_product(self, product_id):
+        with self._reading() as conn:
+            row = conn.execute("SELECT data FROM products WHERE product_id = ?", (product_id,)).fetchone()
+        return _loads(row[0]) if row else None
+
+    def _upsert_products(self, conn, products):
+        conn.executemany(
+            "INSERT OR REPLACE INTO products (product_id, detail_norm, content_hash, data) VALUES (?, ?, ?, ?)",
+            [
+                (p["product_id"], normalize_detail(p.get("detail")), p.get("content_hash"), _dumps(p))
+                for p in products
+            ],
+        )
+
+    def save_product(self, product):
+        with self._transaction() as conn:
+            self._upsert_products(conn, [product])
+        self._notify([dict(product)])
+
+    def list_products(self, limit):
+        sql = "SELECT data FROM products ORDER BY product_id"
+        params = ()
+        if limit:
+            sql += " LIMIT ?"
+            params = (int(limit),)
+        with self._reading() as conn:
+            return [_loads(raw) for raw, in conn.execute(sql, params)]
+
+    def product_content_hashes(self):
+        with self._reading() as conn:
+            return dict(conn.execute("SELECT product_id, content_hash FROM products"))
+
+    def _upsert_orders(self, conn, records, replace=True):
+        # replace=False: un id existente hace fallar la transacción (IntegrityError)
+        verb = "INSERT OR REPLACE" if replace else "INSERT"
+        conn.executemany(
+            f"{verb} INTO purchase_orders (id, user_id, status, purchase_ts, data) VALUES (?, ?, ?, ?, ?)",
+            [
+                (r["id"], r.get("user_id"), r.get("status"), _ts(r.get("purchase_ts")), _dumps(r))
+                for r in records
+            ],
+        )
+
+    def write_batch(self, collection, docs, id_field):
+        docs = [dict(doc, **{id_field: str(doc[id_field])}) for doc in docs]
+        with self._transaction() as conn:
+            if collection == "products":
+                self._upsert_products(conn, docs)
+            elif collection == "purchase_orders":
+                self._upsert_orders(conn, docs)
+            else:
+                raise ValueError(f"Colección no soportada: {collection}")
+        if collection == "products":
+            self._notify(docs)
+
+    # -- órdenes de compra --
+
+    def save_purchase_order(self, record, rollups=()):
+        try:
+            with self._transaction() as conn:
+                self._upsert_orders(conn, [record], replace=False)
+                self._apply_rollups(conn, rollups)
+        except sqlite3.IntegrityError as e:
+            raise PurchaseOrderConflictError(f"Ya existe una orden con id {record['id']}") from e
+
+    def get_purchase_order(self, order_id):
+        with self._reading() as conn:
+            row = conn.execute("SELECT data FROM purchase_orders WHERE id = ?", (order_id,)).fetchone()
+        return _loads(row[0]) if row else None
+
+    def get_purchase_orders(self, order_ids):
+        order_ids = list(order_ids)
+        if not order_ids:
+            return []
+        placeholders = ",".join("?" * len(order_ids))
+        with self._reading() as conn:
+            rows = conn.execute(f"SELECT data FROM purchase_orders WHERE id IN ({placeholders})", order_ids)
+            return [_loads(raw) for raw, in rows]
+
+    def delete_purchase_order(self, order_id, rollups=(), update_time=None):
+        # Las órdenes no se modifican: basta con exigir que siga existiendo
+        with self._transaction() as conn:
+            if not conn.execute("DELETE FROM purchase_orders WHERE id = ?", (order_id,)).rowcount:
+                raise PurchaseOrderConflictError(f"La orden {order_id} cambió o ya fue eliminada")
+            self._apply_rollups(conn, rollups)
+
+    def query_purchase_orders(self, user_id, status, start, end, limit, after=None):
+        # Cada combinación de filtros tiene un índice que termina en (purchase_ts, id)
+        clauses, params = [], []
+        if user_id:
+            clauses.append("user_id = ?")
+            params.append(user_id)
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        if start:
+            clauses.append("purchase_ts >= ?")
+            params.append(_ts(start))
+        if end:
+            clauses.append("purchase_ts < ?")
+            params.append(_ts(end))
+        if after:
+            clauses.append("(purchase_ts, id) < (?, ?)")
+            params.extend([_ts(after[0]), after[1]])
+        sql = "SELECT data FROM purchase_orders"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY purchase_ts DESC, id DESC LIMIT ?"
+        params.append(int(limit))
+        with self._reading() as conn:
+            return [_loads(raw) for raw, in conn.execute(sql, params)]
+
+    # -- tickets de aprobación --
+
+    def save_approval_ticket(self, ticket):
+        now = _ts(datetime.now(timezone.utc))
+        with self._transaction() as conn:
+            # Equivalente a la política TTL de Firestore
+            conn.execute("DELETE FROM approval_tickets WHERE expires_at <= ?", (now,))
+            conn.execute(
+                "INSERT OR REPLACE INTO approval_tickets (id, expires_at, update_time, data) VALUES (?, ?, ?, ?)",
+                (ticket["id"], _ts(ticket["expires_at"]), now, _dumps(ticket)),
+            )
+
+    def get_approval_ticket(self, ticket_id):
+        with self._reading() as conn:
+            row = conn.execute(
+                "SELECT data, update_time FROM approval_tickets WHERE id = ?", (ticket_id,)
+            ).fetchone()
+        if not row:
+            return None
+        ticket = _loads(row[0])
+        ticket["update_time"] = row[1]
+        return ticket
+
+    def commit_approval_ticket(self, ticket, save_orders=(), delete_order_ids=(), rollups=()):
+        with self._transaction() as conn:
+            consumed = conn.execute(
+                "DELETE FROM approval_tickets WHERE id = ? AND update_time = ?",
+                (ticket["id"], ticket["update_time"]),
+            ).rowcount
+            if not consumed:
+                raise ApprovalTicketConflictError(f"La aprobación {ticket['id']} ya fue ejecutada")
+            try:
+                if save_orders:
+                    self._upsert_orders(conn, save_orders, replace=False)
+            except sqlite3.IntegrityError as e:
+                raise ApprovalTicketConflictError(f"Las órdenes de la aprobación {ticket['id']} ya existen") from e
+            for order_id in delete_order_ids:
+                if not conn.execute("DELETE FROM purchase_orders WHERE id = ?", (order_id,)).rowcount:
+                    raise ApprovalTicketConflictError(
+                        f"Las órdenes de la aprobación {ticket['id']} cambiaron o ya fueron eliminadas"
+                    )
+            self._apply_rollups(conn, rollups)
+
+    # -- agregados de gasto --
+
+    _ROLLUP_COLUMNS = ("id", "user_id", "product_id", "granularity", "period", "count", "total_amount")
+
+    def _apply_rollups(self, conn, rollups):
+        conn.executemany(
+            "INSERT INTO spend_rollups (id, user_id, product_id, granularity, period, count, total_amount) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET "
+            "count = count + excluded.count, total_amount = total_amount + excluded.total_amount",
+            [tuple(delta[column] for column in self._ROLLUP_COLUMNS) for delta in rollups],
+        )
+
+    def get_spend_rollups(self, rollup_ids):
+        rollup_ids = list(rollup_ids)
+        if not rollup_ids:
+            return {}
+        placeholders = ",".join("?" * len(rollup_ids))
+        with self._reading() as conn:
+            rows = conn.execute(
+                f"SELECT {', '.join(self._ROLLUP_COLUMNS)} FROM spend_rollups WHERE id IN ({placeholders})",
+                rollup_ids,
+            ).fetchall()
+        return {row[0]: dict(zip(self._ROLLUP_COLUMNS[1:], row[1:])) for row in rows}
+
+    def replace_spend_rollups(self, rollups):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM spend_rollups")
+            self._apply_rollups(conn, rollups)
+
+    # -- chat --
+
+    def add_chat_messages(self, user_id, records):
+        # (user_id, seq) es la clave: un reintento del flush no duplica mensajes
+        persisted_at = datetime.now(timezone.utc)
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO chat_messages (user_id, seq, created_at, data) VALUES (?, ?, ?, ?)",
+                [
+                    (
+                        user_id,
+                        record["seq"],
+                        _ts(record["created_at"]),
+                        _dumps({**record, "persisted_at": persisted_at}),
+                    )
+                    for record in records
+                ],
+            )
+
+    def get_chat_messages(self, user_id, limit, before=None):
+        sql = "SELECT data FROM chat_messages WHERE user_id = ?"
+        params = [user_id]
+        if before:
+            sql += " AND created_at < ?"
+            params.append(_ts(before))
+        sql += " ORDER BY created_at DESC, seq DESC LIMIT ?"
+        params.append(int(limit))
+        with self._reading() as conn:
+            return [_loads(raw) for raw, in conn.execute(sql, params)]
+
+    def clear_chat_messages(self, user_id):
+        with self._transaction() as conn:
+            return conn.execute("DELETE FROM chat_messages WHERE user_id = ?", (user_id,)).rowcount
+
+    def close(self):
+        for conn in self._connections:
+            conn.close()
+        self._connections.clear()
@@ -1,93 +1,679 @@
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 try:
-    from ..application.agent import run_agent
+    from ..application.agent import run_agent, stream_agent, fast_path_stats, decision_cache_stats, warm_up_agent
+    from ..application.memory import build_context
+    from ..infrastructure.admission import AdmissionRejected, llm_admission
+    from ..infrastructure.logging_pipeline import setup_logging
+    from ..infrastructure.repository import ApprovalTicketConflictError, PurchaseOrderConflictError
+    from ..infrastructure.settings import load_env
+    from ..infrastructure.metrics import (
+        CHAT_RESPONSES,
+        CONTENT_TYPE,
+        REQUEST_DOCUMENTS_READ,
+        REQUEST_LATENCY,
+        REQUEST_ROUND_TRIPS,
+        STAGE_LATENCY,
+        register_gauge_callback,
+        render,
+        start_request_io,
+    )
     from ..infrastructure.firebase_service import (
-        save_purchase,
+        save_purchase_async,
         save_chat,
-        delete_purchase_order,
-        get_purchase_order_by_id,
-        get_product_by_id,
-        get_product_by_detail,
+        chat_buffer_stats,
+        get_chat_history_async,
+        clear_chat_history_async,
+        create_approval_ticket_async,
+        get_approval_ticket_async,
+        commit_approval_ticket_async,
+        get_spend_summary_async,
+        delete_purchase_order_async,
+        get_purchase_order_snapshot_async,
+        get_product_by_id_async,
+        get_product_by_detail_async,
+        warm_up_storage,
+        shutdown_storage,
+        product_catalog_status,
+        run_in_db_pool,
+        query_purchase_orders,
+        export_purchase_orders_async,
+        purchase_order_cache_stats,
+        InvalidCursorError,
     )
 except ImportError:
-    from application.agent import run_agent
+    from application.agent import run_agent, stream_agent, fast_path_stats, decision_cache_stats, warm_up_agent
+    from application.memory import build_context
+    from infrastructure.admission import AdmissionRejected, llm_admission
+    from infrastructure.logging_pipeline import setup_logging
+    from infrastructure.repository import ApprovalTicketConflictError, PurchaseOrderConflictError
+    from infrastructure.settings import load_env
+    from infrastructure.metrics import (
+        CHAT_RESPONSES,
+        CONTENT_TYPE,
+        REQUEST_DOCUMENTS_READ,
+        REQUEST_LATENCY,
+        REQUEST_ROUND_TRIPS,
+        STAGE_LATENCY,
+        register_gauge_callback,
+        render,
+        start_request_io,
+    )
     from infrastructure.firebase_service import (
-        save_purchase,
+        save_purchase_async,
         save_chat,
-        delete_purchase_order,
-        get_purchase_order_by_id,
-        get_product_by_id,
-        get_product_by_detail,
+        chat_buffer_stats,
+        get_chat_history_async,
+        clear_chat_history_async,
+        create_approval_ticket_async,
+        get_approval_ticket_async,
+        commit_approval_ticket_async,
+        get_spend_summary_async,
+        delete_purchase_order_async,
+        get_purchase_order_snapshot_async,
+        get_product_by_id_async,
+        get_product_by_detail_async,
+        warm_up_storage,
+        shutdown_storage,
+        product_catalog_status,
+        run_in_db_pool,
+        query_purchase_orders,
+        export_purchase_orders_async,
+        purchase_order_cache_stats,
+        InvalidCursorError,
     )
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
+from typing import Optional
+import asyncio
+import csv
+import io
+import json
+import logging
+import os
+import time
 import uuid
+import zlib
 
-app = FastAPI(title="HITL Agent Enterprise")
 
+load_env()
+
+# Warm-up al arrancar (catálogo, matriz de búsqueda y cliente de OpenAI); con 0
+# se difiere al primer request que lo necesite
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "1") != "0"
 
-import logging
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 logger = logging.getLogger("main")
 
+
+async def warm_up():
+    started = time.perf_counter()
+    catalog, _ = await asyncio.gather(run_in_db_pool(warm_up_storage), warm_up_agent())
+    logger.info(
+        "Warm-up completo en %.0f ms (%s productos)", (time.perf_counter() - started) * 1000, catalog["products"]
+    )
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Los clientes se crean aquí y no al importar el módulo
+    setup_logging()
+    if WARMUP_ON_STARTUP:
+        await warm_up()
+    yield
+    await run_in_db_pool(shutdown_storage)
+
+
+app = FastAPI(title="HITL Agent Enterprise", lifespan=lifespan)
+
+
+def _numeric(stats):
+    return {key: value for key, value in stats.items() if isinstance(value, (int, float))}
+
+
+register_gauge_callback(
+    "purchase_order_cache", "Estadísticas del caché de órdenes de compra", "stat",
+    lambda: _numeric(purchase_order_cache_stats()),
+)
+register_gauge_callback(
+    "chat_write_buffer", "Profundidad y estado del buffer write-behind del chat", "stat",
+    lambda: _numeric(chat_buffer_stats()),
+)
+register_gauge_callback(
+    "agent_fast_path", "Estadísticas del parser de comandos frecuentes", "stat",
+    lambda: _numeric(fast_path_stats()),
+)
+register_gauge_callback(
+    "agent_decision_cache", "Estadísticas del caché de decisiones del modelo", "stat",
+    lambda: _numeric(decision_cache_stats()),
+)
+register_gauge_callback(
+    "llm_admission", "Llamadas al LLM en curso y en cola, y turnos de chat en curso", "stat",
+    lambda: _numeric(llm_admission.stats()),
+)
+
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected(request: Request, exc: AdmissionRejected):
+    logger.warning(
+        "[ADMISSION] %s rechazado (%s)", request.url.path, exc.reason, extra={"route": request.url.path}
+    )
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail, "reason": exc.reason},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+@app.middleware("http")
+async def observe_request(request: Request, call_next):
+    # En respuestas en streaming la latencia, las lecturas y los round trips
+    # cubren hasta el envío de headers; las etapas del agente se miden aparte
+    # en agent_stage_duration_seconds.
+    io = start_request_io()
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Firestore-Round-Trips"] = str(io["round_trips"])
+        return response
+    finally:
+        route = request.scope.get("route")
+        path = route.path if route else "unmatched"
+        REQUEST_LATENCY.observe(
+            time.perf_counter() - started, route=path, method=request.method, status=status
+        )
+        REQUEST_DOCUMENTS_READ.observe(io["reads"], route=path)
+        REQUEST_ROUND_TRIPS.observe(io["round_trips"], route=path)
+
+async def _chat_response(user_id, result):
+    if result["type"] == "UNSAFE":
+        approval = result.get("approval", {})
+        ticket = await create_approval_ticket_async(user_id, result["payload"], approval)
+        return {
+            "status":"APPROVAL_REQUIRED",
+            "ticket_id": ticket["id"],
+            "expires_at": ticket["expires_at"].isoformat(),
+            "payload":result["payload"],
+            "approval": approval
+        }
+    response = {"status":"OK","message":result["content"]}
+    if result.get("candidates"):
+        response["candidates"] = result["candidates"]
+    return response
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+def _incoming_message(data):
+    # Los clientes envían solo el mensaje nuevo; `messages` se acepta por compatibilidad
+    message = data.get("message")
+    if message is None and data.get("messages"):
+        message = data["messages"][-1]
+    if isinstance(message, str):
+        message = {"role": "user", "content": message}
+    if not isinstance(message, dict) or not message.get("content"):
+        raise HTTPException(422, "message es obligatorio")
+    return {"role": message.get("role", "user"), "content": message["content"]}
+
+
+def _assistant_message(response):
+    if response["status"] == "APPROVAL_REQUIRED":
+        approval = response.get("approval") or {}
+        content = (
+            f"Acción pendiente de aprobación humana: {approval.get('action')}\n```json\n"
+            + json.dumps(approval.get("record") or response["payload"], ensure_ascii=False, default=str)
+            + "\n```"
+        )
+    else:
+        content = response.get("message") or ""
+    return {"role": "assistant", "content": content}
+
+
+def _validate_turn(data):
+    # Antes del control de admisión: un body inválido es 422, no un turno
+    if not data.get("user_id"):
+        raise HTTPException(422, "user_id es obligatorio")
+    _incoming_message(data)
+
+
+def _rejected_message(exc):
+    # Si la cola del modelo rechaza el turno después de guardar el mensaje del
+    # usuario, el historial registra el rechazo en lugar de quedar sin respuesta
+    return {"role": "assistant", "content": f"No se pudo responder este mensaje: {exc.detail}"}
+
+
+async def _prepare_turn(data):
+    # La memoria de la sesión vive en el backend: se carga el historial
+    # persistido y se arma una ventana de contexto acotada por tokens.
+    user_id = data["user_id"]
+    message = _incoming_message(data)
+    with STAGE_LATENCY.time(stage="context_window"):
+        history = await get_chat_history_async(user_id)
+        save_chat(user_id, message)
+        return user_id, build_context(history, message)
+
+
 @app.post("/chat")
 async def chat(data:dict):
-    logger.info(f"[REQUEST] /chat: {data}")
+    logger.debug("[REQUEST] /chat: %s", data, extra={"route": "/chat"})
+    _validate_turn(data)
+    try:
+        llm_admission.check(data["user_id"])
+        async with llm_admission.user_turn(data["user_id"]):
+            user_id, messages = await _prepare_turn(data)
+
+            try:
+                result = await run_agent(messages, user_id=user_id)
+            except AdmissionRejected as e:
+                save_chat(user_id, _rejected_message(e))
+                raise
+
+            response = await _chat_response(user_id, result)
+            save_chat(user_id, _assistant_message(response))
+        CHAT_RESPONSES.inc(route="/chat", status=response["status"])
+        logger.debug("[RESPONSE] /chat: %s", response, extra={"route": "/chat"})
+        logger.info("[RESPONSE] /chat status=%s", response["status"], extra={"route": "/chat", "user_id": user_id})
+        return response
+
+    except (HTTPException, AdmissionRejected):
+        raise
+    except Exception as e:
+        logger.error("[ERROR] /chat: %s", e, extra={"route": "/chat"})
+        raise HTTPException(500,str(e))
+
+
+@app.post("/chat/stream")
+async def chat_stream(data:dict):
+    # Server-Sent Events: `delta` por cada fragmento de texto del asistente y un
+    # `final` con la misma respuesta que /chat (OK o APPROVAL_REQUIRED).
+    logger.debug("[REQUEST] /chat/stream: %s", data, extra={"route": "/chat/stream"})
+    _validate_turn(data)
+    # Los rechazos se deciden antes de abrir el stream para responder 429/503
+    # con Retry-After; el turno se registra dentro del generador, que es el
+    # único que sabe cuándo termina.
+    llm_admission.check(data["user_id"])
+
+    async def events():
+        try:
+            async with llm_admission.user_turn(data["user_id"]):
+                user_id, messages = await _prepare_turn(data)
+                try:
+                    async for result in stream_agent(messages, user_id=user_id):
+                        if result["type"] == "DELTA":
+                            yield _sse("delta", {"content": result["content"]})
+                            continue
+                        response = await _chat_response(user_id, result)
+                        CHAT_RESPONSES.inc(route="/chat/stream", status=response["status"])
+                        logger.debug("[RESPONSE] /chat/stream: %s", response, extra={"route": "/chat/stream"})
+                        logger.info(
+                            "[RESPONSE] /chat/stream status=%s", response["status"],
+                            extra={"route": "/chat/stream", "user_id": user_id},
+                        )
+                        yield _sse("final", response)
+                        save_chat(user_id, _assistant_message(response))
+                except AdmissionRejected as e:
+                    save_chat(user_id, _rejected_message(e))
+                    raise
+        except AdmissionRejected as e:
+            # Cola del modelo agotada (o carrera con otro turno del usuario)
+            yield _sse("error", {"detail": e.detail, "status": e.status_code, "retry_after": e.retry_after})
+        except Exception as e:
+            logger.error("[ERROR] /chat/stream: %s", e, extra={"route": "/chat/stream"})
+            yield _sse("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/chat/history")
+async def chat_history(user_id: str, limit: int = 50, before: Optional[str] = None):
+    try:
+        messages = await get_chat_history_async(user_id, limit=limit, before=before)
+    except ValueError:
+        raise HTTPException(422, "before debe ser un timestamp ISO 8601")
+    next_before = messages[0].get("created_at") if len(messages) >= limit else None
+    return {"messages": messages, "next_before": next_before}
+
+
+@app.delete("/chat/history")
+async def delete_chat_history(user_id: str):
+    deleted = await clear_chat_history_async(user_id)
+    return {"status": "OK", "deleted": deleted}
+
+
+@app.get("/purchase_orders")
+def purchase_orders(
+    user_id: Optional[str] = None,
+    status: Optional[str] = None,
+    date: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+):
+    try:
+        return query_purchase_orders(
+            user_id=user_id,
+            status=status,
+            date=date,
+            date_from=date_from,
+            date_to=date_to,
+            limit=limit,
+            cursor=cursor,
+        )
+    except InvalidCursorError as e:
+        raise HTTPException(422, str(e))
+    except ValueError:
+        raise HTTPException(422, "Las fechas deben tener formato YYYY-MM-DD o ISO 8601")
+
+
+EXPORT_CSV_FIELDS = (
+    "id", "purchase_date", "user_id", "product_id", "detail", "quantity",
+    "unit_price", "total_amount", "status", "justification",
+)
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv; charset=utf-8"}
+
+
+def _export_chunks(pages, fmt):
+    # Una página serializada por chunk: la memoria no crece con el total exportado
+    async def chunks():
+        if fmt == "csv":
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=EXPORT_CSV_FIELDS, extrasaction="ignore")
+            writer.writeheader()
+            yield buffer.getvalue().encode()
+        try:
+            async for orders in pages:
+                if fmt == "csv":
+                    buffer.seek(0)
+                    buffer.truncate()
+                    writer.writerows(orders)
+                    yield buffer.getvalue().encode()
+                else:
+                    yield "".join(
+                        json.dumps(order, ensure_ascii=False, default=str) + "\n" for order in orders
+                    ).encode()
+        except Exception as e:
+            # Los headers ya se enviaron: el cliente ve el archivo truncado
+            logger.error("[ERROR] /purchase_orders/export: %s", e, extra={"route": "/purchase_orders/export"})
+            raise
+    return chunks()
+
+
+async def _gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)  # 31: formato gzip
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+@app.get("/purchase_orders/export")
+async def export_purchase_orders(
+    export_format: str = Query("ndjson", alias="format"),
+    gzip: bool = False,
+    user_id: Optional[str] = None,
+    status: Optional[str] = None,
+    date: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+):
+    # Extracto completo para auditoría, leído con cursor y enviado por páginas
+    if export_format not in EXPORT_FORMATS:
+        raise HTTPException(422, f"format debe ser uno de: {', '.join(EXPORT_FORMATS)}")
     try:
-        messages = data["messages"]
-        user_id = data["user_id"]
+        pages = export_purchase_orders_async(
+            user_id=user_id, status=status, date=date, date_from=date_from, date_to=date_to
+        )
+    except ValueError:
+        raise HTTPException(422, "Las fechas deben tener formato YYYY-MM-DD o ISO 8601")
+    logger.info(
+        "[EXPORT] purchase_orders format=%s gzip=%s user_id=%s status=%s", export_format, gzip, user_id, status,
+        extra={"route": "/purchase_orders/export"},
+    )
+
+    chunks = _export_chunks(pages, export_format)
+    filename = f"purchase_orders.{export_format}"
+    media_type = EXPORT_FORMATS[export_format]
+    if gzip:
+        chunks = _gzip_chunks(chunks)
+        filename += ".gz"
+        media_type = "application/gzip"
+    return StreamingResponse(
+        chunks,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+def _new_purchase_order(user_id, order_fields):
+    return {
+        "id": str(uuid.uuid4()),
+        "purchase_date": datetime.now(timezone.utc).isoformat(),
+        "user_id": user_id,
+        **order_fields,
+        "status": "EXECUTED"
+    }
+
+
+# Respuesta del usuario a la aprobación, con el mismo texto que muestra el
+# frontend: el historial del backend no queda en "pendiente de aprobación"
+_APPROVED_MESSAGE = {"role": "user", "content": "Confirmo la ejecución de la acción crítica."}
+_REJECTED_MESSAGE = {"role": "user", "content": "No apruebo esta acción crítica."}
+_CANCELLED_MESSAGE = {
+    "role": "assistant",
+    "content": "Acción cancelada. No se realizó ningún cambio en la base de datos.",
+}
 
-        save_chat(user_id, messages[-1])
 
-        result = run_agent(messages, user_id=user_id)
+def _save_resolution(user_id, user_message, assistant_message):
+    save_chat(user_id, user_message)
+    save_chat(user_id, assistant_message)
 
-        if result["type"] == "UNSAFE":
+
+def _created_message(order):
+    return {
+        "role": "assistant",
+        "content": (
+            f"Orden ejecutada tras aprobación humana: `{order['id']}` "
+            f"({order['quantity']} x {order['detail']}, total {order['total_amount']})."
+        )
+    }
+
+
+def _deleted_message(order_id):
+    return {
+        "role": "assistant",
+        "content": f"Orden eliminada tras aprobación humana: `{order_id}`."
+    }
+
+
+def _created_batch_message(orders, total_amount):
+    lines = [f"{len(orders)} órdenes ejecutadas tras aprobación humana (total {total_amount}):"]
+    lines.extend(
+        f"- `{order['id']}` ({order['quantity']} x {order['detail']}, total {order['total_amount']})"
+        for order in orders
+    )
+    return {"role": "assistant", "content": "\n".join(lines)}
+
+
+def _deleted_batch_message(order_ids):
+    return {
+        "role": "assistant",
+        "content": f"{len(order_ids)} órdenes eliminadas tras aprobación humana: "
+        + ", ".join(f"`{order_id}`" for order_id in order_ids) + ".",
+    }
+
+
+async def _execute_ticket(user_id, ticket_id):
+    # El ticket ya trae el producto resuelto y el registro objetivo: ejecutar
+    # la aprobación es un solo commit, sin lecturas del catálogo.
+    ticket = await get_approval_ticket_async(ticket_id)
+    if not ticket:
+        raise HTTPException(404, f"La aprobación {ticket_id} no existe o expiró")
+    if ticket["user_id"] != user_id:
+        raise HTTPException(403, "La aprobación pertenece a otro usuario")
+
+    payload = ticket["payload"]
+    try:
+        if ticket["action"] == "CREATE_PURCHASE_ORDERS_BATCH":
+            # Una aprobación, un commit atómico para todas las órdenes del lote
+            justification = payload.get("justification", "")
+            purchase_orders = [
+                _new_purchase_order(user_id, {"justification": justification, **item}) for item in payload["items"]
+            ]
+            await commit_approval_ticket_async(ticket, save_orders=purchase_orders)
             response = {
-                "status":"APPROVAL_REQUIRED",
-                "payload":result["payload"],
-                "approval": result.get("approval", {})
+                "status": "EXECUTED",
+                "action": "CREATE_PURCHASE_ORDERS_BATCH",
+                "purchase_orders": purchase_orders,
+                "total_amount": payload.get("total_amount"),
             }
-            logger.info(f"[RESPONSE] /chat: {response}")
-            return response
+            logger.info(
+                "[DB] purchase_orders registrados en lote: %s", len(purchase_orders),
+                extra={"route": "/execute", "user_id": user_id},
+            )
+            _save_resolution(
+                user_id, _APPROVED_MESSAGE, _created_batch_message(purchase_orders, payload.get("total_amount"))
+            )
+        elif ticket["action"] == "DELETE_PURCHASE_ORDERS_BATCH":
+            order_ids = payload["purchase_order_ids"]
+            deleted_orders = (ticket["record"] or {}).get("orders", [])
+            await commit_approval_ticket_async(ticket, delete_orders=deleted_orders)
+            response = {
+                "status": "EXECUTED",
+                "action": "DELETE_PURCHASE_ORDERS_BATCH",
+                "deleted_purchase_orders": deleted_orders,
+            }
+            logger.info(
+                "[DB] purchase_orders eliminados en lote: %s", len(order_ids),
+                extra={"route": "/execute", "user_id": user_id},
+            )
+            _save_resolution(user_id, _APPROVED_MESSAGE, _deleted_batch_message(order_ids))
+        elif ticket["action"] == "DELETE_PURCHASE_ORDER":
+            order_id = payload["purchase_order_id"]
+            await commit_approval_ticket_async(ticket, delete_orders=[{**(ticket["record"] or {}), "id": order_id}])
+            response = {
+                "status": "EXECUTED",
+                "action": "DELETE_PURCHASE_ORDER",
+                "deleted_purchase_order": ticket["record"]
+            }
+            logger.info("[DB] purchase_orders eliminado: %s", order_id, extra={"route": "/execute", "user_id": user_id})
+            _save_resolution(user_id, _APPROVED_MESSAGE, _deleted_message(order_id))
+        else:
+            purchase_order = _new_purchase_order(
+                user_id,
+                {k: v for k, v in payload.items() if k != "action"},
+            )
+            await commit_approval_ticket_async(ticket, save_orders=[purchase_order])
+            response = {
+                "status":"EXECUTED",
+                "action": "CREATE_PURCHASE_ORDER",
+                "purchase_order": purchase_order
+            }
+            logger.info("[DB] purchase_orders registrado: %s", purchase_order["id"], extra={"route": "/execute", "user_id": user_id})
+            _save_resolution(user_id, _APPROVED_MESSAGE, _created_message(purchase_order))
+    except ApprovalTicketConflictError as e:
+        raise HTTPException(409, str(e))
+    except ValueError as e:
+        raise HTTPException(422, str(e))
 
-        response = {"status":"OK","message":result["content"]}
-        logger.info(f"[RESPONSE] /chat: {response}")
-        return response
+    logger.debug("[RESPONSE] /execute: %s", response, extra={"route": "/execute"})
+    return response
 
-    except Exception as e:
-        logger.error(f"[ERROR] /chat: {e}")
-        raise HTTPException(500,str(e))
+
+@app.get("/spend/summary")
+async def spend_summary(
+    user_id: str,
+    product_id: Optional[str] = None,
+    date: Optional[str] = None,
+    month: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+):
+    try:
+        return await get_spend_summary_async(
+            user_id, product_id=product_id, date=date, month=month, date_from=date_from, date_to=date_to
+        )
+    except ValueError as e:
+        raise HTTPException(422, f"Período inválido: {e}")
+
+
+@app.get("/cache/stats")
+def cache_stats():
+    return {"purchase_orders": purchase_order_cache_stats()}
+
+
+@app.get("/agent/stats")
+def agent_stats():
+    return {
+        **fast_path_stats(),
+        "decision_cache": decision_cache_stats(),
+        "admission": llm_admission.stats(),
+    }
+
+
+@app.get("/ready")
+def ready():
+    # Readiness para el balanceador: 503 hasta que el catálogo esté indexado
+    status = product_catalog_status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
+@app.get("/metrics")
+def metrics():
+    return Response(render(), media_type=CONTENT_TYPE)
 
 
 @app.post("/execute")
 async def execute(data:dict):
-    logger.info(f"[REQUEST] /execute: {data}")
+    logger.debug("[REQUEST] /execute: %s", data, extra={"route": "/execute"})
     try:
         user_id = data.get("user_id")
         if not user_id:
             raise HTTPException(422, "user_id es obligatorio para ejecutar la compra")
 
+        if data.get("ticket_id"):
+            return await _execute_ticket(user_id, data["ticket_id"])
+
+        # Compatibilidad: payload completo enviado por el cliente
         action = data.get("action", "CREATE_PURCHASE_ORDER")
+        if action.endswith("_BATCH"):
+            raise HTTPException(422, "Las acciones en lote se ejecutan solo con ticket_id")
 
         if action == "DELETE_PURCHASE_ORDER":
             order_id = data.get("purchase_order_id")
             if not order_id:
                 raise HTTPException(422, "purchase_order_id es obligatorio para eliminar")
 
-            existing_order = get_purchase_order_by_id(order_id)
-            if not existing_order:
+            # Dos round trips: la lectura (sin caché) y un commit que reutiliza
+            # esa lectura como precondición en vez de volver a consultarla
+            snapshot = await get_purchase_order_snapshot_async(order_id)
+            if not snapshot:
                 raise HTTPException(404, f"No existe orden con id {order_id}")
-            if existing_order.get("user_id") and existing_order.get("user_id") != user_id:
+            if snapshot.get("user_id") and snapshot.get("user_id") != user_id:
                 raise HTTPException(403, "No puedes eliminar una orden de otro usuario")
 
-            deleted_order = delete_purchase_order(order_id)
+            try:
+                deleted_order = await delete_purchase_order_async(snapshot)
+            except PurchaseOrderConflictError as e:
+                raise HTTPException(409, str(e))
             response = {
                 "status": "EXECUTED",
                 "action": "DELETE_PURCHASE_ORDER",
                 "deleted_purchase_order": deleted_order
             }
-            logger.info(f"[DB] purchase_orders eliminado: {deleted_order}")
-            logger.info(f"[RESPONSE] /execute: {response}")
+            logger.info("[DB] purchase_orders eliminado: %s", order_id, extra={"route": "/execute", "user_id": user_id})
+            _save_resolution(user_id, _APPROVED_MESSAGE, _deleted_message(order_id))
+            logger.debug("[RESPONSE] /execute: %s", response, extra={"route": "/execute"})
             return response
 
         order_data = {
@@ -96,9 +682,9 @@ async def execute(data:dict):
         }
         product_id = order_data.get("product_id")
         detail = order_data.get("detail")
-        product = get_product_by_id(product_id) if product_id else None
+        product = await get_product_by_id_async(product_id) if product_id else None
         if not product and detail:
-            product = get_product_by_detail(detail)
+            product = await get_product_by_detail_async(detail)
         if not product:
             raise HTTPException(
                 422,
@@ -113,29 +699,48 @@ async def execute(data:dict):
             raise HTTPException(422, "quantity debe ser mayor a 0")
 
         unit_price = float(product.get("price", 0))
-        purchase_order = {
-            "id": str(uuid.uuid4()),
-            "purchase_date": datetime.now(timezone.utc).isoformat(),
-            "user_id": user_id,
+        purchase_order = _new_purchase_order(user_id, {
             **order_data,
             "product_id": product["product_id"],
             "detail": product.get("detail", ""),
             "unit_price": unit_price,
             "quantity": quantity,
             "total_amount": round(quantity * unit_price, 2),
-            "status": "EXECUTED"
-        }
-        saved_order = save_purchase(purchase_order)
+        })
+        saved_order = await save_purchase_async(purchase_order)
         response = {
             "status":"EXECUTED",
             "action": "CREATE_PURCHASE_ORDER",
             "purchase_order": saved_order
         }
-        logger.info(f"[DB] purchase_orders registrado: {saved_order}")
-        logger.info(f"[RESPONSE] /execute: {response}")
+        logger.info("[DB] purchase_orders registrado: %s", saved_order["id"], extra={"route": "/execute", "user_id": user_id})
+        _save_resolution(user_id, _APPROVED_MESSAGE, _created_message(saved_order))
+        logger.debug("[RESPONSE] /execute: %s", response, extra={"route": "/execute"})
         return response
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"[ERROR] /execute: {e}")
+        logger.error("[ERROR] /execute: %s", e, extra={"route": "/execute"})
         raise HTTPException(500,str(e))
+
+
+@app.post("/reject")
+async def reject(data:dict):
+    # El usuario rechazó la acción: se consume el ticket (ya no puede
+    # ejecutarse) y el historial registra el rechazo. Un ticket vencido no
+    # tiene nada que consumir, pero el rechazo igual se registra.
+    logger.debug("[REQUEST] /reject: %s", data, extra={"route": "/reject"})
+    user_id = data.get("user_id")
+    if not user_id:
+        raise HTTPException(422, "user_id es obligatorio para rechazar la acción")
+    ticket = await get_approval_ticket_async(data.get("ticket_id"))
+    if ticket:
+        if ticket["user_id"] != user_id:
+            raise HTTPException(403, "La aprobación pertenece a otro usuario")
+        try:
+            await commit_approval_ticket_async(ticket)
+        except ApprovalTicketConflictError as e:
+            raise HTTPException(409, str(e))
+    _save_resolution(user_id, _REJECTED_MESSAGE, _CANCELLED_MESSAGE)
+    logger.info("[RESPONSE] /reject ticket=%s", data.get("ticket_id"), extra={"route": "/reject", "user_id": user_id})
+    return {"status": "REJECTED", "ticket_id": ticket["id"] if ticket else None}
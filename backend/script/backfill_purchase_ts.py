@@ -0,0 +1,53 @@
+import argparse
+from pathlib import Path
+import sys
+
+
+CURRENT_DIR = Path(__file__).resolve().parent
+BACKEND_DIR = CURRENT_DIR.parent
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from infrastructure.firebase_service import PURCHASE_TS_FIELD, _parse_datetime  # noqa: E402
+from infrastructure.firestore_repository import firestore_client  # noqa: E402
+
+
+# Límite de operaciones por batch de Firestore
+MAX_BATCH_SIZE = 500
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Agrega purchase_ts (timestamp) a purchase_orders creadas antes de existir el campo."
+    )
+    parser.add_argument("--batch_size", type=int, default=MAX_BATCH_SIZE, help="Documentos por batch")
+    args = parser.parse_args()
+
+    # Migración propia de Firestore: en SQLite purchase_ts siempre se guarda
+    db = firestore_client()
+    batch_size = min(max(1, args.batch_size), MAX_BATCH_SIZE)
+    batch = db.batch()
+    pending = 0
+    updated = 0
+
+    for doc in db.collection("purchase_orders").stream():
+        order = doc.to_dict()
+        if order.get(PURCHASE_TS_FIELD) or not order.get("purchase_date"):
+            continue
+        batch.update(doc.reference, {PURCHASE_TS_FIELD: _parse_datetime(order["purchase_date"])})
+        pending += 1
+        if pending == batch_size:
+            batch.commit()
+            updated += pending
+            batch = db.batch()
+            pending = 0
+
+    if pending:
+        batch.commit()
+        updated += pending
+
+    print(f"Updated {updated} purchase_orders with {PURCHASE_TS_FIELD}.")
+
+
+if __name__ == "__main__":
+    main()
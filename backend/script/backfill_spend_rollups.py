@@ -0,0 +1,56 @@
+import argparse
+from pathlib import Path
+import sys
+import time
+
+
+CURRENT_DIR = Path(__file__).resolve().parent
+BACKEND_DIR = CURRENT_DIR.parent
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from infrastructure.firebase_service import PURCHASE_TS_FIELD, get_repository  # noqa: E402
+from infrastructure.spend_rollups import merge_deltas, rollup_deltas  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Reconstruye spend_rollups desde purchase_orders. Requiere purchase_ts en todas "
+            "las órdenes (ver backfill_purchase_ts.py)."
+        )
+    )
+    parser.add_argument("--page_size", type=int, default=500, help="Órdenes leídas por página")
+    parser.add_argument("--dry_run", action="store_true", help="Solo calcula, no escribe")
+    args = parser.parse_args()
+
+    # Lo ejecutado durante la reconstrucción puede quedar fuera: correrlo con
+    # /execute detenido o volver a correrlo después.
+    started = time.perf_counter()
+    repository = get_repository()
+    totals = {}
+    orders = 0
+    after = None
+    while True:
+        records = repository.query_purchase_orders(None, None, None, None, args.page_size, after)
+        for record in records:
+            for delta in rollup_deltas(record):
+                current = totals.setdefault(delta["id"], {**delta, "count": 0, "total_amount": 0.0})
+                current["count"] += delta["count"]
+                current["total_amount"] += delta["total_amount"]
+        orders += len(records)
+        if len(records) < args.page_size:
+            break
+        after = (records[-1][PURCHASE_TS_FIELD], records[-1]["id"])
+
+    rollups = merge_deltas(totals.values())
+    if not args.dry_run:
+        repository.replace_spend_rollups(rollups)
+    print(
+        f"{'Calculated' if args.dry_run else 'Rebuilt'} {len(rollups)} spend_rollups from {orders} "
+        f"purchase_orders in {time.perf_counter() - started:.1f}s."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import argparse
+import time
+from pathlib import Path
+import sys
+
+
+CURRENT_DIR = Path(__file__).resolve().parent
+BACKEND_DIR = CURRENT_DIR.parent
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+from infrastructure.bulk_loader import (  # noqa: E402
+    DEFAULT_MAX_RETRIES,
+    DEFAULT_WORKERS,
+    MAX_BATCH_SIZE,
+    load_products,
+    load_purchase_orders,
+    read_records,
+)
+from infrastructure.firebase_service import list_products  # noqa: E402
+from script.seed import random_purchase  # noqa: E402
+from script.seed_products import random_product  # noqa: E402
+
+
+def progress_printer(interval=1.0):
+    last = {"at": 0.0}
+
+    def report(stats):
+        now = time.perf_counter()
+        if now - last["at"] >= interval:
+            last["at"] = now
+            print(f"[progress] {stats.summary()}", flush=True)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Carga masiva de products o purchase_orders con batches paralelos."
+    )
+    parser.add_argument("kind", choices=["products", "purchase_orders"])
+    parser.add_argument("--file", help="Archivo de entrada .csv o .ndjson/.jsonl")
+    parser.add_argument("--n", type=int, default=0, help="Cantidad de registros aleatorios a generar")
+    parser.add_argument("--user_id", help="Owner user_id para purchase_orders aleatorias")
+    parser.add_argument("--batch_size", type=int, default=MAX_BATCH_SIZE, help="Documentos por batch (máx. 500)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Batches en paralelo")
+    parser.add_argument("--max_retries", type=int, default=DEFAULT_MAX_RETRIES, help="Reintentos por batch")
+    args = parser.parse_args()
+
+    if bool(args.file) == bool(args.n):
+        raise ValueError("Indica --file o --n (uno de los dos)")
+
+    if args.file:
+        records = read_records(args.file)
+    elif args.kind == "products":
+        records = (random_product(i) for i in range(1, args.n + 1))
+    else:
+        if not args.user_id:
+            raise ValueError("--user_id es obligatorio para generar purchase_orders")
+        products = list_products(limit=500)
+        if not products:
+            raise ValueError("No hay productos en la colección 'products'. Ejecuta seed_products primero.")
+        records = (random_purchase(args.user_id, products) for _ in range(args.n))
+
+    options = {
+        "batch_size": args.batch_size,
+        "workers": args.workers,
+        "max_retries": args.max_retries,
+        "progress": progress_printer(),
+    }
+    loader = load_products if args.kind == "products" else load_purchase_orders
+    stats = loader(records, **options)
+    print(f"Bulk load {args.kind} finished: {stats.summary()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+
+CURRENT_DIR = Path(__file__).resolve().parent
+BACKEND_DIR = CURRENT_DIR.parent
+
+# Presupuesto de importación de la app (ms); se supera => exit code 1
+DEFAULT_BUDGET_MS = 600
+
+
+def _parse_importtime(stderr):
+    # Cada línea: "import time: self [us] | cumulative | <espacios>módulo".
+    # Python imprime a los hijos antes que al padre, con dos espacios por nivel.
+    nodes = []
+    pending = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        node = {
+            "module": name.strip(),
+            "self_ms": int(self_us) / 1000,
+            "cumulative_ms": int(cumulative_us) / 1000,
+            "children": pending.pop(depth + 1, []),
+        }
+        pending.setdefault(depth, []).append(node)
+        nodes.append(node)
+    return nodes
+
+
+def measure(module):
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BACKEND_DIR,
+        env={**os.environ, "PYTHONPATH": str(BACKEND_DIR)},
+        capture_output=True,
+        text=True,
+    )
+    process_ms = (time.perf_counter() - started) * 1000
+    if result.returncode != 0:
+        raise RuntimeError(f"No se pudo importar {module}:\n{result.stderr[-2000:]}")
+    target = next(node for node in reversed(_parse_importtime(result.stderr)) if node["module"] == module)
+    return target, process_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Reporte de tiempo de importación (cold start) del backend con python -X importtime."
+    )
+    parser.add_argument("--module", default="presentation.api")
+    parser.add_argument("--budget_ms", type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument("--runs", type=int, default=3, help="Se reporta la corrida más rápida")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--json", dest="json_path", help="Guardar el reporte como JSON")
+    args = parser.parse_args()
+
+    runs = [measure(args.module) for _ in range(max(1, args.runs))]
+    target, process_ms = min(runs, key=lambda run: run[0]["cumulative_ms"])
+    heaviest = sorted(target["children"], key=lambda node: node["cumulative_ms"], reverse=True)[:args.top]
+
+    report = {
+        "module": args.module,
+        "import_ms": round(target["cumulative_ms"], 1),
+        "process_ms": round(process_ms, 1),
+        "budget_ms": args.budget_ms,
+        "within_budget": target["cumulative_ms"] <= args.budget_ms,
+        "heaviest_imports": [
+            {"module": node["module"], "cumulative_ms": round(node["cumulative_ms"], 1)} for node in heaviest
+        ],
+    }
+
+    print(f"{args.module}: {report['import_ms']} ms (proceso completo {report['process_ms']} ms, "
+          f"presupuesto {args.budget_ms:.0f} ms)")
+    for node in report["heaviest_imports"]:
+        print(f"  {node['cumulative_ms']:>8.1f} ms  {node['module']}")
+    if args.json_path:
+        Path(args.json_path).write_text(json.dumps(report, indent=2))
+    if not report["within_budget"]:
+        print("Cold start fuera de presupuesto", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
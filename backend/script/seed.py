@@ -4,17 +4,14 @@ import uuid
 from datetime import datetime, timezone
 from pathlib import Path
 import sys
-from dotenv import load_dotenv
 
 CURRENT_DIR = Path(__file__).resolve().parent
 BACKEND_DIR = CURRENT_DIR.parent
 if str(BACKEND_DIR) not in sys.path:
     sys.path.insert(0, str(BACKEND_DIR))
 
-from infrastructure.firebase_service import save_purchase, list_products  # noqa: E402
-
-# Cargar variables de entorno
-load_dotenv()
+from infrastructure.bulk_loader import load_purchase_orders  # noqa: E402
+from infrastructure.firebase_service import list_products  # noqa: E402
 
 JUSTIFICATIONS = [
     "Reposición de inventario.",
@@ -57,10 +54,8 @@ def main():
     if not products:
         raise ValueError("No hay productos en la colección 'products'. Ejecuta seed_products primero.")
 
-    for _ in range(args.n):
-        order = random_purchase(args.user_id, products)
-        save_purchase(order)
-    print(f"Inserted {args.n} purchase_orders for user_id={args.user_id}.")
+    stats = load_purchase_orders(random_purchase(args.user_id, products) for _ in range(args.n))
+    print(f"Inserted {stats.written} purchase_orders for user_id={args.user_id}.")
 
 if __name__ == "__main__":
     main()
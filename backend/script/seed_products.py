@@ -3,18 +3,13 @@ import random
 from pathlib import Path
 import sys
 
-from dotenv import load_dotenv
-
 
 CURRENT_DIR = Path(__file__).resolve().parent
 BACKEND_DIR = CURRENT_DIR.parent
 if str(BACKEND_DIR) not in sys.path:
     sys.path.insert(0, str(BACKEND_DIR))
 
-from infrastructure.firebase_service import save_product  # noqa: E402
-
-
-load_dotenv()
+from infrastructure.bulk_loader import load_products  # noqa: E402
 
 
 ADJECTIVES = [
@@ -67,10 +62,9 @@ def main():
     if args.n <= 0:
         raise ValueError("--n debe ser mayor a 0")
 
-    for i in range(1, args.n + 1):
-        save_product(random_product(i))
+    stats = load_products(random_product(i) for i in range(1, args.n + 1))
 
-    print(f"Inserted {args.n} products into 'products' collection.")
+    print(f"Inserted {stats.written} products into 'products' collection ({stats.skipped} unchanged).")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# Los módulos se importan como en `python main.py` (desde backend/) y sin
+# servicios externos: almacenamiento en memoria
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+# Cada turno llega al modelo falso: sin caché de decisiones entre tests
+os.environ.setdefault("AGENT_DECISION_CACHE", "0")
@@ -0,0 +1,43 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from application import agent
+from benchmark.fake_openai import create_fake_openai_app, fake_openai_client
+from infrastructure.admission import llm_admission
+from presentation import api
+
+
+LLM_LATENCY = 0.2
+CONCURRENT_CHATS = 8
+
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    fake = create_fake_openai_app(latency=LLM_LATENCY)
+    monkeypatch.setattr(agent, "client", fake_openai_client(fake))
+    return fake
+
+
+def test_concurrent_chats_overlap_llm_latency(fake_llm):
+    # Con el modelo y el storage async, N turnos de usuarios distintos esperan
+    # al LLM a la vez: el total ronda una latencia, no N
+    assert llm_admission.max_concurrency >= CONCURRENT_CHATS
+
+    async def run():
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+            started = time.perf_counter()
+            responses = await asyncio.gather(*[
+                client.post("/chat", json={"user_id": f"user-{i}", "message": "hola, ¿qué puedes hacer?"})
+                for i in range(CONCURRENT_CHATS)
+            ])
+            return time.perf_counter() - started, responses
+
+    elapsed, responses = asyncio.run(run())
+
+    assert [r.status_code for r in responses] == [200] * CONCURRENT_CHATS
+    assert fake_llm.state.requests == CONCURRENT_CHATS
+    assert elapsed < CONCURRENT_CHATS * LLM_LATENCY / 2
@@ -0,0 +1,132 @@
+import os
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from enterprise_utils import RetryBudget, retry
+
+
+API_BASE = os.getenv("API_BASE", "http://localhost:8000")
+# (connect, read) en segundos; en streaming el read timeout es entre fragmentos
+API_CONNECT_TIMEOUT = float(os.getenv("API_CONNECT_TIMEOUT", "3.05"))
+API_READ_TIMEOUT = float(os.getenv("API_READ_TIMEOUT", "60"))
+API_MAX_ATTEMPTS = int(os.getenv("API_MAX_ATTEMPTS", "3"))
+API_POOL_SIZE = int(os.getenv("API_POOL_SIZE", "10"))
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+# 503 lo emite el backend antes de procesar el request: se puede reintentar
+# incluso en POST. 429 en /chat indica otro turno del mismo usuario en curso
+# (doble envío), así que igual que 502/504 solo se reintenta si es idempotente.
+REJECTED_STATUSES = {429, 503}
+GATEWAY_STATUSES = {502, 504}
+
+
+class RetryableResponse(Exception):
+    def __init__(self, response):
+        super().__init__(f"HTTP {response.status_code} en {response.request.method} {response.url}")
+        self.response = response
+        self.retry_after = _retry_after_seconds(response)
+
+
+def _retry_after_seconds(response):
+    value = response.headers.get("Retry-After")
+    if not value:
+        return 0
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return 0
+
+
+def _connection_refused(error):
+    if not isinstance(error, requests.ConnectionError) or not error.args:
+        return False
+    reason = getattr(error.args[0], "reason", error.args[0])
+    return isinstance(reason, NewConnectionError)
+
+
+class BackendClient:
+    """Cliente HTTP del backend con conexiones keep-alive reutilizadas.
+
+    Una sola instancia por proceso de Streamlit (ver `st.cache_resource` en
+    app.py); `requests.Session` comparte su pool entre los hilos de sesión.
+    """
+
+    def __init__(
+        self,
+        base_url=API_BASE,
+        timeout=(API_CONNECT_TIMEOUT, API_READ_TIMEOUT),
+        max_attempts=API_MAX_ATTEMPTS,
+        pool_size=API_POOL_SIZE,
+        budget=None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.budget = budget or RetryBudget()
+        self.session = requests.Session()
+        # Los reintentos los maneja este cliente, no urllib3
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @staticmethod
+    def _retryable(idempotent):
+        def check(error):
+            if isinstance(error, RetryableResponse):
+                status = error.response.status_code
+                return status == 503 or (idempotent and status in {429} | GATEWAY_STATUSES)
+            # Sin conexión establecida el request nunca llegó al backend
+            if isinstance(error, requests.ConnectTimeout) or _connection_refused(error):
+                return True
+            if isinstance(error, (requests.ConnectionError, requests.ReadTimeout)):
+                return idempotent
+            return False
+        return check
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        check = self._retryable(idempotent)
+
+        rejected = []
+
+        @retry(max_attempts=self.max_attempts, retryable=check, budget=self.budget)
+        def send():
+            # La respuesta rechazada se cierra recién al reintentar: si no hay
+            # más intentos (o presupuesto) se devuelve abierta y su cuerpo se
+            # puede leer, también con stream=True
+            while rejected:
+                rejected.pop().close()
+            response = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+            if response.status_code in REJECTED_STATUSES | GATEWAY_STATUSES:
+                error = RetryableResponse(response)
+                if check(error):
+                    rejected.append(response)
+                    raise error
+            return response
+
+        try:
+            return send()
+        except RetryableResponse as e:
+            # Sin más intentos: se devuelve la última respuesta del backend
+            return e.response
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def stream(self, path, **kwargs):
+        # POST con stream=True; usar como context manager para liberar la conexión
+        return self.request("POST", path, stream=True, **kwargs)
@@ -1,8 +1,32 @@
 import streamlit as st
-import requests
 import json
 
-API="http://localhost:8000"
+from api_client import API_BASE, BackendClient
+from chat_view import make_message, render_history, render_orders
+
+
+@st.cache_resource
+def get_backend_client():
+    # Un cliente (y su pool keep-alive) por proceso, compartido entre sesiones
+    return BackendClient(API_BASE)
+
+
+backend = get_backend_client()
+
+
+def iter_sse(resp):
+    # Parser mínimo de Server-Sent Events: produce (evento, data JSON)
+    resp.encoding = "utf-8"
+    event, data = "message", []
+    for line in resp.iter_lines(chunk_size=None, decode_unicode=True):
+        if not line:
+            if data:
+                yield event, json.loads("\n".join(data))
+            event, data = "message", []
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data.append(line[len("data:"):].strip())
 
 st.markdown(
     """
@@ -36,21 +60,27 @@ if "payload" not in st.session_state:
     st.session_state.payload = None
 if "approval" not in st.session_state:
     st.session_state.approval = None
+if "ticket_id" not in st.session_state:
+    st.session_state.ticket_id = None
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
 
 user=st.text_input("User email")
 
 if st.button("Limpiar chat"):
+    if user:
+        try:
+            backend.delete("/chat/history", params={"user_id": user})
+        except Exception as e:
+            st.error(f"Error limpiando el historial del backend: {e}")
     st.session_state.chat_history = []
     st.session_state.state = "CHAT"
     st.session_state.payload = None
     st.session_state.approval = None
+    st.session_state.ticket_id = None
     st.rerun()
 
-for message in st.session_state.chat_history:
-    with st.chat_message(message["role"]):
-        st.markdown(message["content"])
+render_history(st.session_state.chat_history)
 
 if st.session_state.state=="APPROVAL":
     payload_data = st.session_state.payload or {}
@@ -62,16 +92,23 @@ if st.session_state.state=="APPROVAL":
     st.warning(f"Acción crítica: {action}")
     st.write("Impacto:")
     st.info(impact)
-    st.write("Registro objetivo:")
-    if record:
-        st.json(record)
+    batch_rows = (record or {}).get("items") or (record or {}).get("orders")
+    if batch_rows:
+        # Lote: una sola aprobación para todos los registros
+        st.write(f"Registros objetivo ({record.get('count', len(batch_rows))}):")
+        render_orders(batch_rows, key="approval_rows")
+        st.metric("Total", f"{float(record.get('total_amount') or 0):,.2f}")
     else:
-        st.json(payload_data)
+        st.write("Registro objetivo:")
+        if record:
+            st.json(record)
+        else:
+            st.json(payload_data)
 
     col1, col2 = st.columns(2)
     if col1.button("Sí", use_container_width=True, type="primary"):
         st.session_state.chat_history.append(
-            {"role": "user", "content": "Confirmo la ejecución de la acción crítica."}
+            make_message("user", "Confirmo la ejecución de la acción crítica.")
         )
         payload = payload_data
         if isinstance(payload, str):
@@ -81,48 +118,64 @@ if st.session_state.state=="APPROVAL":
                 st.error("El payload de aprobación no es JSON válido.")
                 st.stop()
 
-        execute_payload = {"user_id": user, **payload}
-        resp = requests.post(f"{API}/execute", json=execute_payload)
+        if st.session_state.ticket_id:
+            # El backend ya guardó la aprobación resuelta; basta con el ticket
+            execute_payload = {"user_id": user, "ticket_id": st.session_state.ticket_id}
+        else:
+            execute_payload = {"user_id": user, **payload}
+        try:
+            resp = backend.post("/execute", json=execute_payload)
+        except Exception as e:
+            st.error(f"Error llamando al backend: {e}")
+            st.stop()
         if resp.ok:
             data = resp.json()
+            # Las órdenes van como tabla, no como JSON dentro del markdown
             if "purchase_order" in data:
-                st.session_state.chat_history.append(
-                    {
-                        "role": "assistant",
-                        "content": "Orden ejecutada y registrada:\n```json\n"
-                        + json.dumps(data["purchase_order"], ensure_ascii=False, indent=2)
-                        + "\n```",
-                    }
+                message = make_message("assistant", "Orden ejecutada y registrada:", orders=[data["purchase_order"]])
+            elif "purchase_orders" in data:
+                message = make_message(
+                    "assistant",
+                    f"{len(data['purchase_orders'])} órdenes ejecutadas y registradas "
+                    f"(total {data.get('total_amount')}):",
+                    orders=data["purchase_orders"],
                 )
-            elif "deleted_purchase_order" in data:
-                st.session_state.chat_history.append(
-                    {
-                        "role": "assistant",
-                        "content": "Orden eliminada:\n```json\n"
-                        + json.dumps(data["deleted_purchase_order"], ensure_ascii=False, indent=2)
-                        + "\n```",
-                    }
+            elif "deleted_purchase_orders" in data:
+                message = make_message(
+                    "assistant",
+                    f"{len(data['deleted_purchase_orders'])} órdenes eliminadas:",
+                    orders=data["deleted_purchase_orders"],
                 )
+            elif "deleted_purchase_order" in data:
+                message = make_message("assistant", "Orden eliminada:", orders=[data["deleted_purchase_order"]])
             else:
-                st.session_state.chat_history.append(
-                    {"role": "assistant", "content": "Orden ejecutada correctamente."}
-                )
+                message = make_message("assistant", "Orden ejecutada correctamente.")
+            st.session_state.chat_history.append(message)
             st.session_state.state = "CHAT"
             st.session_state.payload = None
             st.session_state.approval = None
+            st.session_state.ticket_id = None
             st.rerun()
         else:
             st.error(f"Error al ejecutar: {resp.status_code} - {resp.text}")
     if col2.button("No", use_container_width=True, type="secondary"):
+        # El backend consume el ticket y guarda el rechazo en el historial
+        try:
+            resp = backend.post("/reject", json={"user_id": user, "ticket_id": st.session_state.ticket_id})
+        except Exception as e:
+            st.error(f"Error llamando al backend: {e}")
+            st.stop()
+        if not resp.ok:
+            st.error(f"Error al rechazar: {resp.status_code} - {resp.text}")
+            st.stop()
+        st.session_state.chat_history.append(make_message("user", "No apruebo esta acción crítica."))
         st.session_state.chat_history.append(
-            {"role": "user", "content": "No apruebo esta acción crítica."}
-        )
-        st.session_state.chat_history.append(
-            {"role": "assistant", "content": "Acción cancelada. No se realizó ningún cambio en la base de datos."}
+            make_message("assistant", "Acción cancelada. No se realizó ningún cambio en la base de datos.")
         )
         st.session_state.state = "CHAT"
         st.session_state.payload = None
         st.session_state.approval = None
+        st.session_state.ticket_id = None
         st.rerun()
 
 prompt = st.chat_input("Escribe tu mensaje")
@@ -131,40 +184,67 @@ if prompt:
         st.error("Ingresa primero el User email.")
         st.stop()
 
-    st.session_state.chat_history.append({"role": "user", "content": prompt})
-    messages = [
-        {"role": m["role"], "content": m["content"]}
-        for m in st.session_state.chat_history
-        if m["role"] in {"user", "assistant"}
-    ]
+    st.session_state.chat_history.append(make_message("user", prompt))
+
+    with st.chat_message("user"):
+        st.markdown(prompt)
+
+    final_events = {}
+
+    def assistant_deltas():
+        with backend.stream("/chat/stream", json={"user_id": user, "message": prompt}) as resp:
+            if resp.status_code in (429, 503):
+                # Rechazo del control de admisión del backend (o de un proxy,
+                # que puede responder sin JSON)
+                try:
+                    body = resp.json()
+                except ValueError:
+                    body = None
+                final_events["error"] = {
+                    "detail": (body.get("detail") if isinstance(body, dict) else None)
+                    or f"HTTP {resp.status_code}: el servicio no está disponible",
+                    "retry_after": resp.headers.get("Retry-After"),
+                }
+                return
+            resp.raise_for_status()
+            for event, data in iter_sse(resp):
+                if event == "delta":
+                    yield data.get("content", "")
+                else:
+                    final_events[event] = data
 
     try:
-        res = requests.post(
-            f"{API}/chat",
-            json={"user_id": user, "messages": messages}
-        ).json()
+        with st.chat_message("assistant"):
+            streamed_text = st.write_stream(assistant_deltas())
     except Exception as e:
         st.error(f"Error llamando al backend: {e}")
         st.stop()
 
+    if "error" in final_events:
+        error = final_events["error"]
+        retry_hint = f" Reintenta en {error['retry_after']} s." if error.get("retry_after") else ""
+        st.error(f"Error llamando al backend: {error.get('detail')}{retry_hint}")
+        st.stop()
+
+    res = final_events.get("final", {})
+
     if res.get("status")=="APPROVAL_REQUIRED":
         st.session_state.payload = res["payload"]
+        st.session_state.ticket_id = res.get("ticket_id")
         st.session_state.approval = res.get("approval")
         st.session_state.state = "APPROVAL"
         st.session_state.chat_history.append(
-            {
-                "role": "assistant",
-                "content": "Se requiere aprobación humana para continuar. Revisa impacto y registro objetivo, luego responde Sí o No.",
-            }
+            make_message(
+                "assistant",
+                "Se requiere aprobación humana para continuar. Revisa impacto y registro objetivo, luego responde Sí o No.",
+            )
         )
     elif res.get("status")=="OK":
         st.session_state.state = "CHAT"
         st.session_state.chat_history.append(
-            {"role": "assistant", "content": res.get("message", "")}
+            make_message("assistant", res.get("message") or streamed_text or "")
         )
     else:
-        st.session_state.chat_history.append(
-            {"role": "assistant", "content": f"Respuesta inesperada: {res}"}
-        )
+        st.session_state.chat_history.append(make_message("assistant", f"Respuesta inesperada: {res}"))
 
     st.rerun()
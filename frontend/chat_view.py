@@ -0,0 +1,92 @@
+import json
+import math
+import os
+import re
+
+import streamlit as st
+
+
+# Mensajes que se dibujan en cada rerun; los anteriores solo a pedido
+CHAT_VISIBLE_MESSAGES = int(os.getenv("CHAT_VISIBLE_MESSAGES", "12"))
+# Filas por página de las tablas de órdenes
+ORDERS_PAGE_SIZE = int(os.getenv("ORDERS_PAGE_SIZE", "20"))
+
+_JSON_BLOCK = re.compile(r"```json\n(.*?)\n```", re.DOTALL)
+
+
+def _table_rows(value):
+    # Lista de objetos (p. ej. órdenes) u objeto plano: filas de una tabla
+    if isinstance(value, list) and value and all(isinstance(item, dict) for item in value):
+        return value
+    if isinstance(value, dict) and value and not any(isinstance(v, (dict, list)) for v in value.values()):
+        return [value]
+    return None
+
+
+def split_content(content):
+    """Divide un mensaje en segmentos ("markdown", texto) y ("table", filas).
+
+    Los bloques ```json con órdenes se muestran como tabla; el resto queda en
+    markdown tal cual.
+    """
+    segments = []
+    position = 0
+    for match in _JSON_BLOCK.finditer(content or ""):
+        try:
+            rows = _table_rows(json.loads(match.group(1)))
+        except json.JSONDecodeError:
+            rows = None
+        if rows is None:
+            continue
+        text = content[position:match.start()].strip()
+        if text:
+            segments.append(("markdown", text))
+        segments.append(("table", rows))
+        position = match.end()
+    text = (content or "")[position:].strip()
+    if text or not segments:
+        segments.append(("markdown", text))
+    return segments
+
+
+def make_message(role, content, orders=None):
+    # Los segmentos se calculan una sola vez, al agregar el mensaje al historial
+    segments = split_content(content)
+    if orders:
+        segments.append(("table", list(orders)))
+    return {"role": role, "content": content, "segments": segments}
+
+
+def render_orders(rows, key):
+    if len(rows) <= ORDERS_PAGE_SIZE:
+        st.dataframe(rows, use_container_width=True, hide_index=True)
+        return
+    pages = math.ceil(len(rows) / ORDERS_PAGE_SIZE)
+    page = st.number_input(f"Página (de {pages})", min_value=1, max_value=pages, value=1, key=key)
+    start = (page - 1) * ORDERS_PAGE_SIZE
+    end = min(start + ORDERS_PAGE_SIZE, len(rows))
+    st.dataframe(rows[start:end], use_container_width=True, hide_index=True)
+    st.caption(f"Filas {start + 1}–{end} de {len(rows)}")
+
+
+def render_message(message, key):
+    if "segments" not in message:
+        # Mensajes agregados antes de existir los segmentos
+        message["segments"] = split_content(message.get("content"))
+    with st.chat_message(message["role"]):
+        for index, (kind, value) in enumerate(message["segments"]):
+            if kind == "table":
+                render_orders(value, key=f"{key}_{index}")
+            else:
+                st.markdown(value)
+
+
+def render_history(history):
+    """Dibuja los últimos CHAT_VISIBLE_MESSAGES mensajes; los anteriores no se
+    dibujan (ni cuestan en el rerun) salvo que el usuario los pida."""
+    hidden = max(0, len(history) - CHAT_VISIBLE_MESSAGES)
+    if hidden and st.toggle(f"Mostrar {hidden} mensajes anteriores", key="show_older_messages"):
+        for index in range(hidden):
+            render_message(history[index], key=f"message_{index}")
+    for index in range(hidden, len(history)):
+        render_message(history[index], key=f"message_{index}")
@@ -1,4 +1,9 @@
+import atexit
 import logging
+import logging.handlers
+import queue
+import random
+import threading
 import time
 from functools import wraps
 
@@ -7,34 +12,85 @@ from functools import wraps
 # Configuración de logging compatible con Streamlit
 logger = logging.getLogger("HITL-Enterprise-Frontend")
 logger.setLevel(logging.INFO)
+# Sin propagar al root: evita que otro handler repita cada línea
+logger.propagate = False
 
-# Evitar agregar múltiples handlers si ya existen
+# Streamlit re-ejecuta el script en cada interacción: el listener se crea una
+# sola vez por proceso y la escritura a disco ocurre en su hilo de fondo.
 if not logger.handlers:
     formatter = logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s")
     file_handler = logging.FileHandler("app_audit.log")
     file_handler.setFormatter(formatter)
     stream_handler = logging.StreamHandler()
     stream_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
-    logger.addHandler(stream_handler)
+    log_queue = queue.Queue(maxsize=10000)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler)
+    _listener.start()
+    atexit.register(_listener.stop)
 
-def retry(max_attempts=3, delay=2):
+def backoff_delay(attempt, base=0.25, cap=8.0):
+    # Backoff exponencial con "full jitter": uniforme entre 0 y base * 2^intento
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RetryBudget:
+    """Limita los reintentos a una fracción de las llamadas del proceso.
+
+    Cada llamada deposita `ratio` fichas y cada reintento gasta una; así, si el
+    backend está caído, los reintentos no multiplican la carga.
+    """
+
+    def __init__(self, ratio=0.2, min_tokens=10, max_tokens=100):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = float(min_tokens)
+        self._lock = threading.Lock()
+
+    def record_request(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def try_spend(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+def _is_transient(error):
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+
+def retry(max_attempts=3, delay=0.25, max_delay=8.0, retryable=_is_transient, budget=None):
+    # Reintenta solo errores que `retryable` acepta. Si la excepción trae
+    # `retry_after` (segundos), se espera al menos eso.
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            attempts = 0
-            while attempts < max_attempts:
+            if budget:
+                budget.record_request()
+            for attempt in range(max_attempts):
                 try:
                     return func(*args, **kwargs)
                 except Exception as e:
-                    logger.error(f"Error: {e}. Intento {attempts+1}/{max_attempts}")
-                    attempts += 1
-                    time.sleep(delay)
-            logger.critical(f"Fallo permanente en {func.__name__}")
-            raise
+                    last_attempt = attempt + 1 >= max_attempts
+                    if last_attempt or not retryable(e):
+                        if last_attempt and retryable(e):
+                            logger.critical("Fallo permanente en %s tras %s intentos: %s", func.__name__, max_attempts, e)
+                        raise
+                    if budget and not budget.try_spend():
+                        logger.error("Presupuesto de reintentos agotado en %s: %s", func.__name__, e)
+                        raise
+                    wait = max(backoff_delay(attempt, delay, max_delay), getattr(e, "retry_after", 0) or 0)
+                    logger.warning(
+                        "Error: %s. Intento %s/%s; reintento en %.2fs", e, attempt + 1, max_attempts, wait
+                    )
+                    time.sleep(wait)
         return wrapper
     return decorator
 
 # Auditoría simple
 def audit_action(user, action, payload=None):
-    logger.info(f"AUDIT | user={user} | action={action} | payload={payload}")
+    logger.info("AUDIT | user=%s | action=%s | payload=%s", user, action, payload)